@@ -1,21 +1,40 @@
 # app.py - Updated Photobooth Backend with Static File Serving
 import os
 import io
+import sys
 import uuid
 import base64
+import json
+import logging
+import sqlite3
+import hashlib
+import asyncio
+import shutil
+import tempfile
+import threading
+import time
+import random
+import cProfile
 import numpy as np
 from datetime import datetime
-from typing import List, Optional
-from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field, asdict
+from functools import lru_cache
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from PIL import Image, ImageFilter, ImageEnhance, ImageDraw, ImageFont
-import chromadb
-from chromadb.utils import embedding_functions
+from pydantic import BaseModel
+from PIL import Image, UnidentifiedImageError, ImageFilter, ImageDraw, ImageFont, ImageStat
+
+logger = logging.getLogger(__name__)
 
 # Create FastAPI app
 app = FastAPI(title="Photobooth API", version="1.0.0")
@@ -35,22 +54,1626 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Setup templates for HTML serving
 templates = Jinja2Templates(directory="templates")
 
-# Vector database setup
-chroma_client = chromadb.PersistentClient(path="./photobooth_db")
-# Using default embedding function for image features
-embedding_function = embedding_functions.DefaultEmbeddingFunction()
+# Storage locations (override with environment variables)
+DB_PATH = os.environ.get("PHOTOBOOTH_DB_PATH", "./photobooth_db")
+BLOB_PATH = os.environ.get("PHOTOBOOTH_BLOB_PATH", "./photobooth_blobs")
+SESSION_INDEX_PATH = os.environ.get("PHOTOBOOTH_SESSION_INDEX", "./photobooth_sessions.sqlite3")
+HASH_INDEX_PATH = os.environ.get("PHOTOBOOTH_HASH_INDEX", "./photobooth_hashes.jsonl")
+JOB_DB_PATH = os.environ.get("PHOTOBOOTH_JOB_DB", "./photobooth_jobs.sqlite3")
+
+# Web worker processes serving the app (uvicorn --workers reads the same variable);
+# several need PHOTOBOOTH_STORE=local, since ChromaDB can't be shared between processes
+WEB_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+
+# CPU-bound image work runs in a worker pool ("process" or "thread"), by default
+# splitting the cores between the web workers
+WORKER_POOL_KIND = os.environ.get("PHOTOBOOTH_WORKER_POOL", "process")
+WORKER_COUNT = int(os.environ.get("PHOTOBOOTH_WORKERS", max(1, (os.cpu_count() or 1) // WEB_WORKERS)))
+WORKER_QUEUE_DEPTH = int(os.environ.get("PHOTOBOOTH_WORKER_QUEUE_DEPTH", WORKER_COUNT * 4))
+WORKER_JOB_TIMEOUT = float(os.environ.get("PHOTOBOOTH_WORKER_TIMEOUT", "60"))
+MAX_BATCH_FILES = int(os.environ.get("PHOTOBOOTH_MAX_BATCH_FILES", "50"))
+
+# Background jobs (photostrips): how many run at once, and how long finished jobs are kept
+STRIP_JOB_WORKERS = int(os.environ.get("PHOTOBOOTH_STRIP_JOB_WORKERS", max(1, WORKER_COUNT // 2)))
+JOB_RETENTION_HOURS = float(os.environ.get("PHOTOBOOTH_JOB_RETENTION_HOURS", "24"))
+
+# Session retention: sessions untouched for longer than the TTL are deleted (0 = kept forever), and the
+# least recently used are evicted while storage is over budget (0 = unlimited). Every interval the index
+# is rebuilt once this share of it is deleted records, and unreferenced blobs older than the grace are removed
+SESSION_TTL_HOURS = float(os.environ.get("PHOTOBOOTH_SESSION_TTL_HOURS", "0"))
+STORAGE_BUDGET_BYTES = int(float(os.environ.get("PHOTOBOOTH_STORAGE_BUDGET_MB", "0")) * 1024 * 1024)
+RETENTION_INTERVAL = float(os.environ.get("PHOTOBOOTH_RETENTION_INTERVAL", "300"))
+COMPACT_TOMBSTONE_RATIO = float(os.environ.get("PHOTOBOOTH_COMPACT_TOMBSTONE_RATIO", "0.2"))
+ORPHAN_GRACE_SECONDS = float(os.environ.get("PHOTOBOOTH_ORPHAN_GRACE_SECONDS", "3600"))
+
+# Uploads are downscaled at decode time to at most this many pixels on the longest edge (0 = off);
+# preserving originals keeps the untouched upload bytes for archival
+MAX_WORKING_EDGE = int(os.environ.get("PHOTOBOOTH_MAX_WORKING_EDGE", "2048"))
+PRESERVE_ORIGINALS = os.environ.get("PHOTOBOOTH_PRESERVE_ORIGINALS", "0") == "1"
+
+# Filter chains run in row strips of about this many pixels on larger images (0 = never tile)
+FILTER_TILE_PIXELS = int(os.environ.get("PHOTOBOOTH_FILTER_TILE_PIXELS", str(4 * 1024 * 1024)))
+
+# Estimated decode memory allowed across concurrent uploads; larger uploads wait their turn
+INGEST_MEMORY_BUDGET = int(os.environ.get("PHOTOBOOTH_INGEST_MEMORY_MB", "1024")) * 1024 * 1024
+
+# Live filter preview over WebSocket: frame size, rate and the share of one CPU core per connection
+PREVIEW_MAX_EDGE = int(os.environ.get("PHOTOBOOTH_PREVIEW_MAX_EDGE", "640"))
+PREVIEW_MAX_FPS = float(os.environ.get("PHOTOBOOTH_PREVIEW_MAX_FPS", "15"))
+PREVIEW_CPU_SHARE = float(os.environ.get("PHOTOBOOTH_PREVIEW_CPU_SHARE", "0.5"))
+PREVIEW_JPEG_QUALITY = int(os.environ.get("PHOTOBOOTH_PREVIEW_JPEG_QUALITY", "75"))
+PREVIEW_MAX_FRAME_BYTES = 2 * 1024 * 1024
+
+# Output encoding: default format when the client states no preference, and speed/size profile
+OUTPUT_FORMAT = os.environ.get("PHOTOBOOTH_OUTPUT_FORMAT", "png")
+ENCODING_PROFILE = os.environ.get("PHOTOBOOTH_ENCODING_PROFILE", "balanced")
+
+# Downscaled renditions served by /get-image/{id}?size=..., by longest edge in pixels
+DERIVATIVE_SIZES = {"thumb": 256, "preview": 1024}
+EAGER_DERIVATIVES = os.environ.get("PHOTOBOOTH_EAGER_DERIVATIVES", "0") == "1"
+
+# In-memory cache sizes (entries)
+STRIP_THUMBNAIL_CACHE_SIZE = int(os.environ.get("PHOTOBOOTH_STRIP_THUMBNAIL_CACHE", "256"))
+STRIP_RESULT_CACHE_SIZE = int(os.environ.get("PHOTOBOOTH_STRIP_RESULT_CACHE", "1024"))
+SEARCH_CACHE_SIZE = int(os.environ.get("PHOTOBOOTH_SEARCH_CACHE", "1024"))
+
+# Queries (image ids plus vectors) accepted by one POST /search-similar/batch
+SEARCH_MAX_QUERIES = int(os.environ.get("PHOTOBOOTH_SEARCH_MAX_QUERIES", "100"))
+
+# Near-duplicate uploads: "link" reuses the stored image, "reject" refuses it, "off" stores it
+DEDUP_MODE = os.environ.get("PHOTOBOOTH_DEDUP_MODE", "link")
+DEDUP_THRESHOLD = int(os.environ.get("PHOTOBOOTH_DEDUP_THRESHOLD", "4"))  # max differing hash bits
+DEDUP_MIN_SIMILARITY = float(os.environ.get("PHOTOBOOTH_DEDUP_MIN_SIMILARITY", "0.95"))
+
+# Image descriptors used as embeddings, concatenated in this order
+DESCRIPTOR_NAMES = [
+    name.strip() for name in os.environ.get("PHOTOBOOTH_DESCRIPTORS", "hsv_hist,luma_grid,phash").split(",")
+    if name.strip()
+]
+
+# Where records and embeddings live: "chroma" (ChromaDB, HNSW index) or "local"
+# (float32 matrix + SQLite, exact search; suits up to a few hundred thousand photos)
+STORE_BACKEND = os.environ.get("PHOTOBOOTH_STORE", "chroma")
+LOCAL_STORE_PATH = os.environ.get("PHOTOBOOTH_LOCAL_STORE_PATH", "./photobooth_store")
+LOCAL_STORE_COMPACT_RATIO = float(os.environ.get("PHOTOBOOTH_LOCAL_STORE_COMPACT_RATIO", "0.25"))
+
+# Attach ChromaDB's text embedding model (MiniLM, downloaded on first use) to the collection;
+# not needed for image search, which always supplies its own embeddings
+TEXT_EMBEDDINGS = os.environ.get("PHOTOBOOTH_TEXT_EMBEDDINGS", "0") == "1"
+# Open the database in the background at startup instead of on the first request that needs it
+WARM_STORAGE = os.environ.get("PHOTOBOOTH_WARM_STORAGE", "1") == "1"
+
+# Requests slower than this (ms) may have a cProfile dump written (0 = off);
+# only a sampled fraction of requests is profiled, one at a time
+PROFILE_THRESHOLD_MS = float(os.environ.get("PHOTOBOOTH_PROFILE_THRESHOLD_MS", "0"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PHOTOBOOTH_PROFILE_SAMPLE_RATE", "0.1"))
+PROFILE_DIR = os.environ.get("PHOTOBOOTH_PROFILE_DIR", "./photobooth_profiles")
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style, keyed by label values"""
+    
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...], labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.labels = labels
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            # Bucket counts, then sum and count
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            pairs = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+            counts = values[:-2] + [values[-1]]
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = ",".join(pairs + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {count}")
+            suffix = "{" + ",".join(pairs) + "}" if pairs else ""
+            lines.append(f"{self.name}_sum{suffix} {values[-2]}")
+            lines.append(f"{self.name}_count{suffix} {values[-1]}")
+        return lines
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 5e7, 1e8)
+
+METRICS = {
+    "request": Histogram("photobooth_request_duration_seconds", "Request latency", LATENCY_BUCKETS, ("route", "status")),
+    "stage": Histogram("photobooth_stage_duration_seconds", "Time per request stage", LATENCY_BUCKETS, ("route", "stage")),
+    "chroma": Histogram("photobooth_chroma_call_duration_seconds", "ChromaDB call latency", LATENCY_BUCKETS, ("op",)),
+    "bytes_in": Histogram("photobooth_upload_bytes", "Uploaded image size", BYTE_BUCKETS),
+    "bytes_out": Histogram("photobooth_stored_bytes", "Encoded image size as stored", BYTE_BUCKETS, ("kind",)),
+    "megapixels": Histogram("photobooth_image_megapixels", "Image size", (0.3, 1, 2, 4, 8, 12, 24, 50, 100), ("kind",)),
+    "compaction": Histogram("photobooth_compaction_duration_seconds", "Time per retention compaction",
+                            (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)),
+}
+
+class RequestTimer:
+    """Stage durations collected while serving one request"""
+    
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+    
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+    
+    def server_timing(self) -> str:
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items())
+
+_request_timer: ContextVar[Optional[RequestTimer]] = ContextVar("request_timer", default=None)
+
+def record_stages(stages: Dict[str, float]):
+    """Add stage durations (seconds) to the current request, e.g. those measured in a worker"""
+    timer = _request_timer.get()
+    if timer is not None:
+        for stage, seconds in stages.items():
+            timer.add(stage, seconds)
+
+@contextmanager
+def timed_stage(stage: str):
+    """Time a block as a stage of the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stages({stage: time.perf_counter() - started})
+
+@contextmanager
+def timed_chroma(op: str):
+    """Time a ChromaDB call, as a request stage and in the Chroma latency histogram"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        METRICS["chroma"].observe(elapsed, op=op)
+        record_stages({f"chroma_{op}": elapsed})
 
-# Create or get collection
 try:
-    collection = chroma_client.create_collection(
-        name="photo_collection",
-        embedding_function=embedding_function
-    )
-except:
-    collection = chroma_client.get_collection(
-        name="photo_collection",
-        embedding_function=embedding_function
-    )
+    import fcntl
+except ImportError:
+    # Windows: locks only coordinate threads, so run a single web worker there
+    fcntl = None
+
+class ProcessLock:
+    """Advisory lock on a file, shared between processes and re-entrant within one
+
+    Any number of processes may hold it shared, or one exclusively. Inside
+    a process, threads take turns, and nested holds reuse the outer one (a
+    shared hold can't be upgraded in place).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a+b")
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._exclusive = False
+
+    @contextmanager
+    def hold(self, exclusive: bool = True):
+        """Hold the lock; yields True when this call took it rather than an enclosing one"""
+        with self._lock:
+            first = self._depth == 0
+            if first:
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                self._exclusive = exclusive
+            elif exclusive and not self._exclusive:
+                raise RuntimeError(f"Exclusive lock on {self.path} requested inside a shared one")
+            self._depth += 1
+            try:
+                yield first
+            finally:
+                self._depth -= 1
+                if first and fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def claim(self) -> bool:
+        """Take the lock exclusively for the life of the process; False if another process holds it"""
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """SQLite connection shared by threads and safe to open from several processes
+
+    WAL lets readers in other web workers carry on while one writes, and
+    writers wait for each other instead of failing with "database is locked".
+    """
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+# Vector database setup
+COLLECTION_NAME = "photo_collection"
+# Descriptors are L2-normalized, so cosine distance gives 1 - distance as similarity
+COLLECTION_METADATA = {"hnsw:space": "cosine"}
+
+class PhotoStore:
+    """Records of images and photostrips: embeddings, documents and metadata
+
+    The methods follow the subset of ChromaDB's collection API the app
+    uses, with the same argument names and result shapes, so routes work
+    unchanged against any backend. ``where`` filters support equality and
+    ``$eq``/``$ne``/``$gt``/``$gte``/``$lt``/``$lte``/``$in``/``$nin`` on
+    metadata keys, combined with ``$and``/``$or``.
+    """
+    backend = ""
+    # Whether ``compact`` is safe while the server keeps writing
+    compacts_online = True
+
+    def __init__(self):
+        self._listeners: List[Callable] = []
+
+    def on_change(self, callback: Callable):
+        """Register ``callback(ids)`` to run after every write
+
+        ``ids`` lists the records added, updated or deleted, or is None
+        when every record was replaced.
+        """
+        self._listeners.append(callback)
+        return callback
+
+    def _changed(self, ids: Optional[List[str]]):
+        for callback in self._listeners:
+            callback(ids)
+
+    def sync(self):
+        """Pick up writes made by other processes, notifying ``on_change`` listeners of them"""
+
+    def add(self, ids: List[str], embeddings, documents: List[str], metadatas: List[dict]):
+        raise NotImplementedError
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Tuple[str, ...] = ("metadatas", "documents")) -> dict:
+        raise NotImplementedError
+    
+    @property
+    def distance_space(self) -> str:
+        """How ``query`` measures distance; similarities assume cosine"""
+        return "cosine"
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[dict] = None,
+              include: Tuple[str, ...] = ("metadatas", "distances")) -> dict:
+        raise NotImplementedError
+
+    def update(self, ids: List[str], metadatas: List[dict]):
+        """Merge metadata into records; a None value removes that key"""
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]):
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def replace_all(self, chunks) -> int:
+        """Replace every record with those from ``chunks`` of (ids, embeddings, documents, metadatas)
+
+        The old records stay readable until the new set is complete, so
+        ``chunks`` may be generated from this store's own ``get``.
+        """
+        raise NotImplementedError
+
+    def compact(self) -> int:
+        """Reclaim space left by deleted records; returns the number reclaimed"""
+        return 0
+
+    def tombstone_ratio(self) -> float:
+        """Share of the index taken by deleted records that ``compact`` would reclaim"""
+        return 0.0
+
+    def paged(self, chunk_size: int, include: Tuple[str, ...] = ("metadatas",)):
+        """Yield every record ``chunk_size`` at a time, as ``get`` results"""
+        offset = 0
+        while True:
+            chunk = self.get(limit=chunk_size, offset=offset, include=include)
+            if not chunk["ids"]:
+                return
+            yield chunk
+            offset += len(chunk["ids"])
+
+    @property
+    def max_batch_size(self) -> int:
+        return 5000
+
+class ChromaPhotoStore(PhotoStore):
+    """PhotoStore backed by a persistent ChromaDB collection (HNSW index)
+
+    Every write supplies its own embeddings, so the text embedding model is
+    only attached when ``text_embeddings`` is set. ChromaDB keeps its index
+    in memory per process, so the store is claimed by one process at a time.
+    Compaction copies the collection, so writes made meanwhile would be lost;
+    it only runs from the offline maintenance commands.
+    """
+    backend = "chroma"
+    compacts_online = False
+
+    def __init__(self, path: str, name: str = COLLECTION_NAME, metadata: dict = COLLECTION_METADATA,
+                 text_embeddings: bool = False):
+        import chromadb
+        super().__init__()
+        self.name = name
+        self.metadata = metadata
+        self.text_embeddings = text_embeddings
+        os.makedirs(path, exist_ok=True)
+        # ChromaDB only marks deleted vectors in its HNSW index, so count them
+        # to know when a rebuild is worthwhile
+        self._tombstones_path = os.path.join(path, "photobooth_tombstones")
+        self._owner = ProcessLock(os.path.join(path, "photobooth.lock"))
+        if not self._owner.claim():
+            raise RuntimeError(
+                f"The ChromaDB store at {path} is open in another process. It can't be shared between"
+                " web workers; run one worker or use PHOTOBOOTH_STORE=local"
+            )
+        self.client = chromadb.PersistentClient(path=path)
+        self._recover_replace()
+        try:
+            self.collection = self.client.create_collection(
+                name=name,
+                embedding_function=self.embedding_function(),
+                metadata=metadata
+            )
+        except Exception:
+            self.collection = self.client.get_collection(name=name, embedding_function=self.embedding_function())
+
+    @property
+    def distance_space(self) -> str:
+        # Collections created before the space was set use ChromaDB's default, l2
+        return (self.collection.metadata or {}).get("hnsw:space", "l2")
+
+    def embedding_function(self):
+        if not self.text_embeddings:
+            return None
+        from chromadb.utils import embedding_functions
+        return embedding_functions.DefaultEmbeddingFunction()
+
+    def add(self, ids, embeddings, documents, metadatas):
+        self.collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        self._changed(ids)
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("metadatas", "documents")):
+        return self.collection.get(ids=ids, where=where, limit=limit, offset=offset, include=list(include))
+
+    def query(self, query_embeddings, n_results=10, where=None, include=("metadatas", "distances")):
+        return self.collection.query(
+            query_embeddings=query_embeddings, n_results=n_results, where=where, include=list(include)
+        )
+
+    def update(self, ids, metadatas):
+        self.collection.update(ids=ids, metadatas=metadatas)
+        self._changed(ids)
+
+    def delete(self, ids):
+        before = self.collection.count()
+        self.collection.delete(ids=ids)
+        self._set_tombstones(self._tombstones() + before - self.collection.count())
+        self._changed(ids)
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def _tombstones(self) -> int:
+        try:
+            with open(self._tombstones_path) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _set_tombstones(self, value: int):
+        with open(self._tombstones_path, "w") as f:
+            f.write(str(value))
+
+    def tombstone_ratio(self) -> float:
+        dead = self._tombstones()
+        return dead / (dead + self.count()) if dead else 0.0
+
+    def compact(self) -> int:
+        """Rebuild the collection, dropping the deleted vectors left in its index"""
+        dead = self._tombstones()
+        if not dead:
+            return 0
+        chunks = (
+            (chunk["ids"], chunk["embeddings"], chunk["documents"], chunk["metadatas"])
+            for chunk in self.paged(self.max_batch_size, include=("embeddings", "documents", "metadatas"))
+        )
+        self.replace_all(chunks)
+        return dead
+
+    def _recover_replace(self):
+        """Finish a ``replace_all`` that was interrupted between its renames
+        
+        Staging is only renamed once it is complete, so with the live
+        collection missing it holds the data; a leftover backup means the
+        new collection is already in place.
+        """
+        names = {c.name for c in self.client.list_collections()}
+        staging_name, backup_name = f"{self.name}_reindex", f"{self.name}_backup"
+        if self.name not in names:
+            restore = staging_name if staging_name in names else backup_name if backup_name in names else None
+            if restore is None:
+                return
+            logger.warning("Restoring collection %s from %s after an interrupted rebuild", self.name, restore)
+            self.client.get_collection(restore).modify(name=self.name)
+            self._set_tombstones(0)
+            names = {c.name for c in self.client.list_collections()}
+        if backup_name in names:
+            self.client.delete_collection(backup_name)
+
+    def replace_all(self, chunks) -> int:
+        # Embedding sizes may change, which an existing collection can't accept,
+        # so fill a fresh collection and rename it into place. The old one is
+        # renamed aside first and dropped last, so a crash at any point
+        # leaves a complete collection for _recover_replace to restore
+        staging_name, backup_name = f"{self.name}_reindex", f"{self.name}_backup"
+        names = [c.name for c in self.client.list_collections()]
+        for leftover in (staging_name, backup_name):
+            if leftover in names:
+                self.client.delete_collection(leftover)
+        staging = self.client.create_collection(
+            name=staging_name,
+            embedding_function=self.embedding_function(),
+            metadata=self.metadata
+        )
+        written = 0
+        for ids, embeddings, documents, metadatas in chunks:
+            if ids:
+                staging.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+                written += len(ids)
+        self.collection.modify(name=backup_name)
+        staging.modify(name=self.name)
+        self.client.delete_collection(backup_name)
+        self.collection = staging
+        self._set_tombstones(0)
+        self._changed(None)
+        return written
+
+    @property
+    def max_batch_size(self) -> int:
+        return self.client.get_max_batch_size()
+
+def _where_sql(where: dict) -> Tuple[str, list]:
+    """Translate a ChromaDB-style ``where`` filter into SQL over JSON metadata"""
+    clauses, params = [], []
+    for key, condition in where.items():
+        if key in ("$and", "$or"):
+            parts = [_where_sql(part) for part in condition]
+            joiner = " AND " if key == "$and" else " OR "
+            # An empty $and matches everything and an empty $or nothing
+            empty = "1" if key == "$and" else "0"
+            clauses.append("(" + (joiner.join(sql for sql, _ in parts) or empty) + ")")
+            params.extend(param for _, part_params in parts for param in part_params)
+            continue
+        if not key.replace("_", "").isalnum():
+            raise ValueError(f"Unsupported metadata key in filter: {key!r}")
+        # The path is inlined (not a parameter) so expression indexes can be used
+        column = f"json_extract(metadata, '$.{key}')"
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, value in condition.items():
+            if op in ("$in", "$nin"):
+                marks = ", ".join("?" * len(value)) or "NULL"
+                if op == "$in":
+                    clauses.append(f"{column} IN ({marks})")
+                else:
+                    clauses.append(f"({column} IS NULL OR {column} NOT IN ({marks}))")
+                params.extend(value)
+                continue
+            sql_op = {"$eq": "=", "$ne": "IS NOT", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}.get(op)
+            if sql_op is None:
+                raise ValueError(f"Unsupported filter operator: {op}")
+            # Like ChromaDB, $ne also matches records without the key
+            clauses.append(f"{column} {sql_op} ?")
+            params.append(value)
+    return " AND ".join(clauses) or "1", params
+
+class LocalPhotoStore(PhotoStore):
+    """PhotoStore in plain files: a float32 embedding matrix plus SQLite metadata
+
+    Embeddings are appended to ``embeddings-<generation>.f32`` and read
+    through a memory map; search is exact, one matrix product over the
+    candidate rows plus ``argpartition`` for the top k. Vectors are stored
+    L2-normalized, so cosine distance is ``1 - dot``. Deletes leave
+    tombstones that ``compact`` squeezes out by writing the next
+    generation of the matrix, which happens automatically once more than
+    ``compact_ratio`` of the rows are dead.
+
+    Several processes (web workers) may open the same store. Reads hold a
+    shared lock on ``store.lock`` and writes an exclusive one; whoever
+    takes the lock first catches up with what other processes committed,
+    remapping the matrix and replaying the ``changes`` log to its
+    ``on_change`` listeners so their caches drop stale entries.
+    """
+    backend = "local"
+
+    # Metadata keys that routes filter on get expression indexes
+    INDEXED_KEYS = ("session_id", "type", "strip_key")
+    # Writes remembered for other processes; one that falls further behind drops all its caches
+    CHANGE_LOG_SIZE = 10000
+
+    def __init__(self, path: str, compact_ratio: float = 0.25):
+        super().__init__()
+        self.path = path
+        self.compact_ratio = compact_ratio
+        os.makedirs(path, exist_ok=True)
+        self._process_lock = ProcessLock(os.path.join(path, "store.lock"))
+        self._conn = connect_sqlite(os.path.join(path, "records.sqlite3"))
+        with self._process_lock.hold():
+            with self._conn:
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS records (
+                        id TEXT PRIMARY KEY,
+                        row INTEGER NOT NULL,
+                        document TEXT,
+                        metadata TEXT NOT NULL,
+                        deleted INTEGER NOT NULL DEFAULT 0
+                    )
+                """)
+                self._conn.execute("CREATE INDEX IF NOT EXISTS records_row ON records (row)")
+                for key in self.INDEXED_KEYS:
+                    self._conn.execute(
+                        f"CREATE INDEX IF NOT EXISTS records_{key} ON records (json_extract(metadata, '$.{key}'))"
+                    )
+                self._conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+                # ids is a JSON list, or NULL when every record was replaced
+                self._conn.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, ids TEXT)")
+            self._load()
+
+    @contextmanager
+    def _locked(self, exclusive: bool = True):
+        """Hold the store lock, first catching up with other processes' writes"""
+        with self._process_lock.hold(exclusive) as first:
+            if first:
+                self._refresh()
+            yield
+
+    def _setting(self, key: str, default=None):
+        row = self._conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_setting(self, key: str, value):
+        self._conn.execute(
+            "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value))
+        )
+
+    def _matrix_path(self, generation: int) -> str:
+        return os.path.join(self.path, f"embeddings-{generation}.f32")
+
+    def _read_state(self):
+        self.dim = self._setting("dim")
+        self.generation = self._setting("generation", 0)
+        self.rows = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM records").fetchone()[0]
+        self.dead = self._conn.execute("SELECT COUNT(*) FROM records WHERE deleted = 1").fetchone()[0]
+
+    def _load(self):
+        """Open the current matrix, dropping anything a crash left half-written
+
+        Call with the store lock held exclusively.
+        """
+        self._read_state()
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        self._seen_change = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+        current = self._matrix_path(self.generation)
+        for name in os.listdir(self.path):
+            if name.startswith("embeddings-") and os.path.join(self.path, name) != current:
+                os.unlink(os.path.join(self.path, name))
+        if self.dim and os.path.exists(current):
+            # Rows appended to the file but never committed to SQLite
+            with open(current, "r+b") as f:
+                f.truncate(self.rows * self.dim * 4)
+        self._remap()
+
+    def _refresh(self):
+        """Catch up with writes other processes committed since this one last looked"""
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return
+        self._data_version = version
+        shape = (self.dim, self.generation, self.rows)
+        self._read_state()
+        if (self.dim, self.generation, self.rows) != shape:
+            self._remap()
+
+        changes = self._conn.execute(
+            "SELECT seq, ids FROM changes WHERE seq > ? ORDER BY seq", (self._seen_change,)
+        ).fetchall()
+        if not changes:
+            return
+        if changes[0][0] != self._seen_change + 1 or any(ids is None for _, ids in changes):
+            # Everything replaced, or writes trimmed from the log before this process saw them
+            self._changed(None)
+        else:
+            self._changed([record_id for _, ids in changes for record_id in json.loads(ids)])
+        self._seen_change = changes[-1][0]
+
+    def _log_change(self, ids: Optional[List[str]]) -> int:
+        """Record a write for other processes inside its transaction; returns its sequence number"""
+        seq = self._conn.execute(
+            "INSERT INTO changes (ids) VALUES (?)", (None if ids is None else json.dumps(ids),)
+        ).lastrowid
+        self._conn.execute("DELETE FROM changes WHERE seq <= ?", (seq - self.CHANGE_LOG_SIZE,))
+        return seq
+
+    def _remap(self):
+        self._matrix = None
+        if self.rows and self.dim:
+            self._matrix = np.memmap(
+                self._matrix_path(self.generation), dtype=np.float32, mode="r", shape=(self.rows, self.dim)
+            )
+
+    def sync(self):
+        with self._locked(exclusive=False):
+            pass
+
+    @staticmethod
+    def _normalize(embeddings) -> np.ndarray:
+        matrix = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def add(self, ids, embeddings, documents, metadatas):
+        if not ids:
+            return
+        matrix = self._normalize(embeddings)
+        with self._locked():
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                with self._conn:
+                    self._set_setting("dim", self.dim)
+            if matrix.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match store dimension {self.dim}")
+
+            existing = self._conn.execute(
+                f"SELECT id FROM records WHERE id IN ({', '.join('?' * len(ids))})", ids
+            ).fetchall()
+            if existing:
+                raise ValueError(f"Record ids already exist: {[row[0] for row in existing]}")
+
+            # Matrix first: rows only become visible once SQLite commits them
+            with open(self._matrix_path(self.generation), "ab") as f:
+                # Rows a writer appended before crashing were never committed
+                f.truncate(self.rows * self.dim * 4)
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO records (id, row, document, metadata) VALUES (?, ?, ?, ?)",
+                    [
+                        (record_id, self.rows + i, document, json.dumps(metadata))
+                        for i, (record_id, document, metadata) in enumerate(zip(ids, documents, metadatas))
+                    ]
+                )
+                seq = self._log_change(ids)
+            self._seen_change = seq
+            self.rows += len(ids)
+            self._remap()
+        self._changed(ids)
+
+    def _select(self, columns: str, ids=None, where=None, limit=None, offset=None) -> list:
+        sql = f"SELECT {columns} FROM records WHERE deleted = 0"
+        params: list = []
+        if ids is not None:
+            sql += f" AND id IN ({', '.join('?' * len(ids)) or 'NULL'})"
+            params.extend(ids)
+        if where:
+            where_clause, where_params = _where_sql(where)
+            sql += f" AND {where_clause}"
+            params.extend(where_params)
+        sql += " ORDER BY row"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([-1 if limit is None else limit, offset or 0])
+        with self._locked(exclusive=False):
+            return self._conn.execute(sql, params).fetchall()
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("metadatas", "documents")):
+        # Held throughout so row numbers and the matrix map stay in step
+        with self._locked(exclusive=False):
+            records = self._select("id, row, document, metadata", ids, where, limit, offset)
+            matrix = self._matrix
+        if ids is not None:
+            # Same order as asked for, like ChromaDB
+            position = {record_id: i for i, record_id in enumerate(ids)}
+            records.sort(key=lambda record: position[record[0]])
+
+        result = {"ids": [record[0] for record in records]}
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(record[3]) for record in records]
+        if "documents" in include:
+            result["documents"] = [record[2] for record in records]
+        if "embeddings" in include:
+            rows = np.array([record[1] for record in records], dtype=np.int64)
+            result["embeddings"] = np.array(matrix[rows]) if len(rows) else np.empty((0, self.dim or 0), np.float32)
+        return result
+
+    def query(self, query_embeddings, n_results=10, where=None, include=("metadatas", "distances")):
+        queries = self._normalize(query_embeddings)
+        fields = [key for key in ("metadatas", "documents", "distances") if key in include]
+        results = {key: [] for key in ["ids"] + fields}
+
+        # Held throughout so a concurrent compaction can't renumber rows mid-query
+        with self._locked(exclusive=False):
+            matrix = self._matrix
+            candidates = None
+            if where or self.dead:
+                candidates = np.array([record[0] for record in self._select("row", where=where)], dtype=np.int64)
+            if matrix is None or (candidates is not None and not len(candidates)):
+                for values in results.values():
+                    values.extend([] for _ in queries)
+                return results
+            if queries.shape[1] != matrix.shape[1]:
+                raise ValueError(f"Query dimension {queries.shape[1]} does not match store dimension {matrix.shape[1]}")
+
+            # One BLAS product scores every candidate for every query. When
+            # the filter keeps most rows, scoring the whole map and masking
+            # the rest is cheaper than gathering the candidates into a copy.
+            if candidates is not None and len(candidates) > matrix.shape[0] // 2:
+                k = min(n_results, len(candidates))
+                scores = queries @ matrix.T
+                excluded = np.ones(matrix.shape[0], dtype=bool)
+                excluded[candidates] = False
+                scores[:, excluded] = -np.inf
+                candidates = None
+            else:
+                block = matrix if candidates is None else matrix[candidates]
+                scores = queries @ block.T
+                k = min(n_results, scores.shape[1])
+
+            ranked = []
+            for query_scores in scores:
+                top = np.argpartition(-query_scores, k - 1)[:k] if k < len(query_scores) else np.arange(k)
+                top = top[np.argsort(-query_scores[top], kind="stable")]
+                ranked.append((top if candidates is None else candidates[top], query_scores[top]))
+
+            wanted = sorted({int(row) for rows, _ in ranked for row in rows})
+            by_row = {}
+            for start in range(0, len(wanted), 500):
+                chunk = wanted[start:start + 500]
+                for record in self._conn.execute(
+                    f"SELECT row, id, document, metadata FROM records WHERE row IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                ):
+                    by_row[record[0]] = record
+
+        for rows, row_scores in ranked:
+            records = [by_row[int(row)] for row in rows]
+            results["ids"].append([record[1] for record in records])
+            if "metadatas" in results:
+                results["metadatas"].append([json.loads(record[3]) for record in records])
+            if "documents" in results:
+                results["documents"].append([record[2] for record in records])
+            if "distances" in results:
+                results["distances"].append([float(1 - score) for score in row_scores])
+        return results
+
+    def update(self, ids, metadatas):
+        with self._locked():
+            with self._conn:
+                for record_id, changes in zip(ids, metadatas):
+                    row = self._conn.execute(
+                        "SELECT metadata FROM records WHERE id = ? AND deleted = 0", (record_id,)
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    metadata = json.loads(row[0])
+                    for key, value in changes.items():
+                        if value is None:
+                            metadata.pop(key, None)
+                        else:
+                            metadata[key] = value
+                    self._conn.execute("UPDATE records SET metadata = ? WHERE id = ?", (json.dumps(metadata), record_id))
+                seq = self._log_change(ids)
+            self._seen_change = seq
+        self._changed(ids)
+
+    def delete(self, ids):
+        with self._locked():
+            with self._conn:
+                deleted = self._conn.executemany(
+                    "UPDATE records SET deleted = 1 WHERE id = ? AND deleted = 0", [(record_id,) for record_id in ids]
+                ).rowcount
+                seq = self._log_change(ids)
+            self._seen_change = seq
+            self.dead += max(0, deleted)
+            if self.rows and self.dead / self.rows > self.compact_ratio:
+                self.compact()
+        self._changed(ids)
+
+    def count(self) -> int:
+        with self._locked(exclusive=False):
+            return self.rows - self.dead
+
+    def tombstone_ratio(self) -> float:
+        with self._locked(exclusive=False):
+            return self.dead / self.rows if self.rows else 0.0
+
+    def compact(self) -> int:
+        """Write the next matrix generation without tombstoned rows"""
+        with self._locked():
+            if not self.dead:
+                return 0
+            live = self._conn.execute("SELECT id, row FROM records WHERE deleted = 0 ORDER BY row").fetchall()
+            generation = self.generation + 1
+            with open(self._matrix_path(generation), "wb") as f:
+                for start in range(0, len(live), 4096):
+                    rows = np.array([row for _, row in live[start:start + 4096]], dtype=np.int64)
+                    f.write(np.ascontiguousarray(self._matrix[rows]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Renumbering and the generation switch commit together; other
+            # processes see the new generation and remap on their next call
+            with self._conn:
+                self._conn.execute("DELETE FROM records WHERE deleted = 1")
+                self._conn.executemany(
+                    "UPDATE records SET row = ? WHERE id = ?",
+                    [(new_row, record_id) for new_row, (record_id, _) in enumerate(live)]
+                )
+                self._set_setting("generation", generation)
+
+            reclaimed = self.dead
+            old_path = self._matrix_path(self.generation)
+            self.generation, self.rows, self.dead = generation, len(live), 0
+            self._remap()
+            if os.path.exists(old_path):
+                # Processes still mapping it keep their copy until they remap
+                os.unlink(old_path)
+            return reclaimed
+
+    def replace_all(self, chunks) -> int:
+        staging_path = f"{self.path.rstrip(os.sep)}.reindex"
+        retired = f"{self.path.rstrip(os.sep)}.old"
+        with self._locked():
+            # Left behind by an interrupted replacement
+            for leftover in (staging_path, retired):
+                if os.path.exists(leftover):
+                    shutil.rmtree(leftover)
+            staging = LocalPhotoStore(staging_path, self.compact_ratio)
+            try:
+                written = 0
+                for ids, embeddings, documents, metadatas in chunks:
+                    if ids:
+                        staging.add(ids, embeddings, documents, metadatas)
+                        written += len(ids)
+            except BaseException:
+                staging.close()
+                shutil.rmtree(staging_path, ignore_errors=True)
+                raise
+            staging.close()
+            self.close()
+            os.replace(self.path, retired)
+            os.replace(staging.path, self.path)
+            shutil.rmtree(retired)
+            self._process_lock = ProcessLock(os.path.join(self.path, "store.lock"))
+            self._conn = connect_sqlite(os.path.join(self.path, "records.sqlite3"))
+            with self._process_lock.hold():
+                self._load()
+        self._changed(None)
+        return written
+
+    def close(self):
+        self._matrix = None
+        self._conn.close()
+
+    @property
+    def max_batch_size(self) -> int:
+        return 50000
+
+def open_photo_store(backend: str) -> PhotoStore:
+    """Open the configured kind of store"""
+    if backend == "chroma":
+        return ChromaPhotoStore(DB_PATH, text_embeddings=TEXT_EMBEDDINGS)
+    if backend == "local":
+        return LocalPhotoStore(LOCAL_STORE_PATH, LOCAL_STORE_COMPACT_RATIO)
+    raise ValueError(f"Unknown store backend: {backend!r} (use 'chroma' or 'local')")
+
+def migrate_store(source: PhotoStore, target: PhotoStore, chunk_size: int = 1000) -> int:
+    """Copy every record from one store into another, which must be empty"""
+    if target.count():
+        raise ValueError(f"Target {target.backend} store is not empty")
+    copied = 0
+    offset = 0
+    while True:
+        page = source.get(include=("embeddings", "documents", "metadatas"), limit=chunk_size, offset=offset)
+        if not page['ids']:
+            break
+        offset += len(page['ids'])
+        target.add(page['ids'], np.asarray(page['embeddings']).tolist(), page['documents'], page['metadatas'])
+        copied += len(page['ids'])
+    return copied
+
+class PhotoStorage:
+    """The configured PhotoStore, opened on first use
+
+    Opening a store (importing chromadb, opening SQLite and the index) is
+    kept off the import path so the server accepts connections straight
+    away; the first caller of ``store`` (or the startup warm-up) opens it
+    and others wait for it. Code on the event loop awaits ``wait_open``
+    first, so the wait never blocks other requests.
+    """
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self.open_seconds: Optional[float] = None
+        # Why stored embeddings can't be compared with new ones, if they can't
+        self.incompatible: Optional[str] = None
+        self._store: Optional[PhotoStore] = None
+        self._on_open: List[Callable] = []
+        self._lock = threading.Lock()
+        self._warming: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._store is not None
+
+    @property
+    def store(self) -> PhotoStore:
+        self.open()
+        return self._store
+
+    def on_open(self, hook: Callable):
+        """Register ``hook(store)`` to run once when storage is first opened"""
+        self._on_open.append(hook)
+        return hook
+
+    def open(self):
+        if self._store is not None:
+            return
+        with self._lock:
+            if self._store is not None:
+                return
+            started = time.perf_counter()
+            store = open_photo_store(self.backend)
+            for hook in self._on_open:
+                hook(store)
+            self._store = store
+            self.open_seconds = time.perf_counter() - started
+
+    async def wait_open(self):
+        """Open, or wait for the warm-up to finish, without blocking the event loop"""
+        if self._store is None:
+            await asyncio.to_thread(self.open)
+
+    def warm(self):
+        """Open in a background thread, unless already open or opening"""
+        if self._store is None and self._warming is None:
+            self._warming = threading.Thread(target=self._warm, name="storage-warmup", daemon=True)
+            self._warming.start()
+
+    def _warm(self):
+        try:
+            self.open()
+        except Exception as e:
+            # The next request that needs storage retries and reports the error
+            logger.warning("Could not open storage: %s", e)
+        finally:
+            self._warming = None
+
+    def status(self) -> dict:
+        return {"backend": self.backend, "ready": self.ready, "open_seconds": self.open_seconds,
+                "incompatible": self.incompatible}
+
+storage = PhotoStorage(STORE_BACKEND)
+
+class BlobWriter:
+    """Stream bytes into the blob store, hashing them as they are written
+    
+    Writes land in a staging file; ``close`` returns the content reference
+    and ``BlobStore.commit`` moves the file into place. Deliberately has no
+    ``fileno`` so PIL encoders write through ``write`` and get hashed.
+    """
+    
+    def __init__(self, staging: str):
+        self._hash = hashlib.sha256()
+        self.size = 0
+        fd, self.staged_path = tempfile.mkstemp(dir=staging, prefix=".tmp-")
+        self._file = os.fdopen(fd, "wb")
+    
+    def write(self, data) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+    
+    def flush(self):
+        self._file.flush()
+    
+    def close(self) -> str:
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        return self._hash.hexdigest()
+
+class BlobStore:
+    """Content-addressed storage for image bytes
+
+    Blobs are named by the SHA-256 of their content and sharded into two
+    levels of directories (``ab/cd/abcd...``). Only the digest is kept in
+    ChromaDB metadata, so metadata reads stay small.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.staging = os.path.join(root, ".staging")
+        os.makedirs(self.staging, exist_ok=True)
+
+    def path(self, ref: str) -> str:
+        """Filesystem path for a blob reference"""
+        if len(ref) != 64 or any(c not in "0123456789abcdef" for c in ref):
+            raise ValueError(f"Invalid blob reference: {ref!r}")
+        return os.path.join(self.root, ref[:2], ref[2:4], ref)
+
+    def exists(self, ref: str) -> bool:
+        return os.path.exists(self.path(ref))
+
+    def writer(self) -> BlobWriter:
+        """Open a staging file to stream a new blob into"""
+        return BlobWriter(self.staging)
+
+    def commit(self, staged_path: str, ref: str) -> str:
+        """Atomically move a closed staging file into place under ``ref``"""
+        target = self.path(ref)
+        if os.path.exists(target):
+            # Identical content is stored once; refresh it so a sweep running
+            # before the new record is saved leaves it alone
+            self.discard(staged_path)
+            self.touch(ref)
+            return ref
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(staged_path, target)
+        return ref
+
+    def discard(self, staged_path: str):
+        """Drop a staging file; a no-op once it has been committed"""
+        try:
+            os.unlink(staged_path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, data: bytes) -> str:
+        """Store bytes and return their reference"""
+        writer = self.writer()
+        try:
+            writer.write(data)
+            return self.commit(writer.staged_path, writer.close())
+        except BaseException:
+            writer.close()
+            self.discard(writer.staged_path)
+            raise
+
+    def get(self, ref: str) -> bytes:
+        with open(self.path(ref), "rb") as f:
+            return f.read()
+
+    def touch(self, ref: str):
+        """Mark a blob as just used, protecting it from ``sweep`` for the grace period"""
+        try:
+            os.utime(self.path(ref))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, live: set, grace_seconds: float) -> Tuple[int, int]:
+        """Delete blobs not in ``live`` and abandoned staging files; returns (files, bytes)
+
+        Files modified within ``grace_seconds`` are kept, since an upload
+        may have committed its blob but not yet saved the record naming it.
+        """
+        cutoff = time.time() - grace_seconds
+        removed = reclaimed = 0
+        candidates = []
+        for first in os.scandir(self.root):
+            if not first.is_dir() or len(first.name) != 2:
+                continue
+            for second in os.scandir(first.path):
+                if second.is_dir():
+                    candidates.extend(entry for entry in os.scandir(second.path) if entry.name not in live)
+        candidates.extend(entry for entry in os.scandir(self.staging) if entry.name.startswith(".tmp-"))
+        for entry in candidates:
+            try:
+                stat = entry.stat()
+                if stat.st_mtime > cutoff:
+                    continue
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            reclaimed += stat.st_size
+        return removed, reclaimed
+
+blob_store = BlobStore(BLOB_PATH)
+
+class DerivativeStore:
+    """Downscaled WebP renditions of stored blobs
+    
+    A derivative is named after its source blob and size, so it never
+    needs invalidating and can be generated lazily on first request.
+    """
+    
+    def __init__(self, blobs: BlobStore, sizes: Dict[str, int]):
+        self.blobs = blobs
+        self.sizes = sizes
+        self.root = os.path.join(blobs.root, "derivatives")
+    
+    def path(self, ref: str, size: str) -> str:
+        self.blobs.path(ref)  # validates the reference
+        return os.path.join(self.root, ref[:2], f"{ref}-{size}.webp")
+    
+    def render(self, image: Image.Image, ref: str, size: str) -> str:
+        """Write the ``size`` derivative of an already decoded source image"""
+        target = self.path(ref, size)
+        if os.path.exists(target):
+            return target
+        
+        edge = self.sizes[size]
+        image = image.copy()
+        # thumbnail() shrinks with Image.reduce first, then a LANCZOS pass over the small image
+        image.thumbnail((edge, edge), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        
+        directory = os.path.dirname(target)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                image.save(tmp, format='WEBP', quality=80, method=4)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return target
+    
+    def ensure(self, ref: str, size: str) -> str:
+        """Path of the derivative, generating it from the source blob if needed"""
+        target = self.path(ref, size)
+        if os.path.exists(target):
+            return target
+        with Image.open(self.blobs.path(ref)) as source:
+            source.draft('RGB', (self.sizes[size], self.sizes[size]))
+            return self.render(source, ref, size)
+    
+    def sweep(self, grace_seconds: float) -> Tuple[int, int]:
+        """Delete derivatives whose source blob is gone; returns (files, bytes)"""
+        if not os.path.isdir(self.root):
+            return 0, 0
+        cutoff = time.time() - grace_seconds
+        removed = reclaimed = 0
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                    if entry.name.startswith(".tmp-"):
+                        if stat.st_mtime > cutoff:
+                            continue
+                    elif self.blobs.exists(entry.name.split("-", 1)[0]):
+                        continue
+                    os.unlink(entry.path)
+                except (FileNotFoundError, ValueError):
+                    continue
+                removed += 1
+                reclaimed += stat.st_size
+        return removed, reclaimed
+
+derivative_store = DerivativeStore(blob_store, DERIVATIVE_SIZES)
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    name: str
+    jpeg_quality: int
+    webp_quality: int
+    webp_method: int  # 0 (fastest) to 6 (smallest)
+    png_compress_level: int
+    optimize: bool
+
+ENCODING_PROFILES: Dict[str, EncodingProfile] = {
+    "fast": EncodingProfile("fast", jpeg_quality=85, webp_quality=80, webp_method=0, png_compress_level=1, optimize=False),
+    "balanced": EncodingProfile("balanced", jpeg_quality=90, webp_quality=85, webp_method=4, png_compress_level=6, optimize=False),
+    "archival": EncodingProfile("archival", jpeg_quality=95, webp_quality=100, webp_method=6, png_compress_level=9, optimize=True),
+}
+
+class ImageEncoder:
+    """Encode images as PNG, JPEG or WebP according to a deployment profile"""
+    
+    # Format name -> (Pillow format, content type)
+    FORMATS = {
+        "png": ("PNG", "image/png"),
+        "jpeg": ("JPEG", "image/jpeg"),
+        "webp": ("WEBP", "image/webp"),
+    }
+    ALIASES = {"jpg": "jpeg"}
+    
+    def __init__(self, profile: EncodingProfile, default_format: str):
+        self.profile = profile
+        self.default_format = self.normalize(default_format)
+    
+    def normalize(self, name: str) -> str:
+        name = name.strip().lower()
+        name = self.ALIASES.get(name, name)
+        if name not in self.FORMATS:
+            raise ValueError(f"Unsupported output format: {name}")
+        return name
+    
+    def negotiate(self, explicit: Optional[str] = None, accept: Optional[str] = None) -> str:
+        """Pick an output format from an explicit choice or an Accept header
+        
+        Only explicitly listed image types count; wildcards fall back to
+        the deployment default.
+        """
+        if explicit:
+            return self.normalize(explicit)
+        
+        best, best_q = None, 0.0
+        by_type = {content_type: name for name, (_, content_type) in self.FORMATS.items()}
+        for part in (accept or "").split(","):
+            media, _, params = part.strip().partition(";")
+            name = by_type.get(media.strip().lower())
+            if name is None:
+                continue
+            q = 1.0
+            for param in params.split(";"):
+                key, _, value = param.strip().partition("=")
+                if key == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if q > best_q:
+                best, best_q = name, q
+        return best or self.default_format
+    
+    def encode(self, image: Image.Image, fmt: str) -> Tuple[bytes, dict]:
+        """Encode an image; returns the bytes and metadata describing the encoding"""
+        buffer = io.BytesIO()
+        encoding = self.encode_to(image, fmt, buffer)
+        return buffer.getvalue(), encoding
+    
+    def encode_to(self, image: Image.Image, fmt: str, buffer) -> dict:
+        """Encode an image into a writable file object; returns the encoding metadata"""
+        pil_format, content_type = self.FORMATS[fmt]
+        profile = self.profile
+        
+        if fmt == "jpeg":
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # JPEG has no alpha: flatten onto white
+                rgba = image.convert('RGBA')
+                image = Image.new('RGB', rgba.size, 'white')
+                image.paste(rgba, mask=rgba.getchannel('A'))
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            quality = profile.jpeg_quality
+            image.save(buffer, format=pil_format, quality=quality, optimize=profile.optimize)
+        elif fmt == "webp":
+            quality = profile.webp_quality
+            image.save(buffer, format=pil_format, quality=quality, method=profile.webp_method,
+                       lossless=quality >= 100)
+        else:
+            quality = profile.png_compress_level
+            image.save(buffer, format=pil_format, compress_level=quality, optimize=profile.optimize)
+        
+        return {
+            'format': fmt,
+            'content_type': content_type,
+            'quality': quality,
+            'encoding_profile': profile.name,
+        }
+
+image_encoder = ImageEncoder(ENCODING_PROFILES[ENCODING_PROFILE], OUTPUT_FORMAT)
+
+def load_image_bytes(metadata: dict) -> Optional[bytes]:
+    """Return stored image bytes for a record (blob store or legacy inline base64)"""
+    if metadata.get('blob_ref'):
+        return blob_store.get(metadata['blob_ref'])
+    if metadata.get('image_data'):
+        return base64.b64decode(metadata['image_data'])
+    return None
+
+def migrate_inline_images(batch_size: int = 100) -> int:
+    """Move legacy base64 ``image_data`` metadata into the blob store
+
+    Records are rewritten in place with a ``blob_ref`` and the inline data
+    removed. Safe to re-run; already migrated records are skipped.
+    """
+    store = storage.store
+    migrated = 0
+    offset = 0
+    while True:
+        page = store.get(include=["metadatas"], limit=batch_size, offset=offset)
+        if not page['ids']:
+            break
+
+        ids, updates = [], []
+        for record_id, metadata in zip(page['ids'], page['metadatas']):
+            if not metadata or not metadata.get('image_data'):
+                continue
+            data = base64.b64decode(metadata['image_data'])
+            ids.append(record_id)
+            updates.append({
+                'blob_ref': blob_store.put(data),
+                'blob_size': len(data),
+                'content_type': 'image/png',
+                'image_data': None,  # None removes the key
+            })
+
+        if ids:
+            store.update(ids=ids, metadatas=updates)
+            migrated += len(ids)
+        offset += len(page['ids'])
+
+    return migrated
+
+def reindex_collection(chunk_size: int = 256) -> int:
+    """Rewrite every embedding with the current descriptors
+    
+    Records are streamed in chunks into a fresh copy of the store
+    (embedding sizes may change, which an existing index can't accept),
+    which then replaces the old one. Run while the server is stopped.
+    """
+    store = storage.store
+    
+    def reindexed_chunks():
+        offset = 0
+        while True:
+            page = store.get(include=["metadatas", "documents"], limit=chunk_size, offset=offset)
+            if not page['ids']:
+                break
+            offset += len(page['ids'])
+            
+            ids, documents, metadatas, inputs = [], [], [], []
+            for record_id, document, metadata in zip(page['ids'], page['documents'], page['metadatas']):
+                img_data = load_image_bytes(metadata)
+                if img_data is None:
+                    logger.warning("Skipping %s: no image data", record_id)
+                    continue
+                inputs.append(VectorImageDatabase.prepare_feature_input(Image.open(io.BytesIO(img_data))))
+                ids.append(record_id)
+                documents.append(document)
+                metadatas.append(dict(metadata, descriptor=descriptor_pipeline.version))
+            
+            if ids:
+                embeddings = VectorImageDatabase.features_from_arrays(np.stack(inputs))
+                yield ids, embeddings.tolist(), documents, metadatas
+    
+    return store.replace_all(reindexed_chunks())
+
+class SessionIndex:
+    """Per-session summaries kept in SQLite and updated on every insert
+
+    Lets ``/list-sessions/`` page through sessions by recency without
+    scanning the photo store. Also holds what retention needs: the bytes
+    each session's images take in the blob store, when it was last read,
+    and its own TTL if one was set.
+    """
+
+    COLUMNS = ('session_id', 'image_count', 'photostrip_count', 'latest_timestamp', 'cover_image_id',
+               'bytes', 'last_access', 'ttl_hours')
+    # Last write or read, whichever is later
+    RECENCY = "MAX(COALESCE(last_access, ''), latest_timestamp)"
+
+    def __init__(self, path: str):
+        self.needs_backfill = not os.path.exists(path)
+        self._conn = connect_sqlite(path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    image_count INTEGER NOT NULL DEFAULT 0,
+                    photostrip_count INTEGER NOT NULL DEFAULT 0,
+                    latest_timestamp TEXT NOT NULL DEFAULT '',
+                    cover_image_id TEXT,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    last_access TEXT,
+                    ttl_hours REAL
+                )
+            """)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+            if "bytes" not in columns:
+                # Index from before retention: add the columns and recount from the store
+                self._conn.execute("ALTER TABLE sessions ADD COLUMN bytes INTEGER NOT NULL DEFAULT 0")
+                self._conn.execute("ALTER TABLE sessions ADD COLUMN last_access TEXT")
+                self._conn.execute("ALTER TABLE sessions ADD COLUMN ttl_hours REAL")
+                self.needs_backfill = True
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_recency ON sessions (latest_timestamp DESC, session_id DESC)"
+            )
+            # Counters shared by web workers, e.g. records deleted since the last blob sweep
+            self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @staticmethod
+    def _summarize(metadatas: List[dict]) -> Dict[str, dict]:
+        """Aggregate record metadata into per-session deltas"""
+        deltas: Dict[str, dict] = {}
+        for metadata in metadatas:
+            session_id = metadata.get('session_id')
+            if not session_id:
+                continue
+            delta = deltas.setdefault(session_id, {
+                'image_count': 0, 'photostrip_count': 0, 'latest_timestamp': '', 'cover_image_id': None, 'bytes': 0
+            })
+            if metadata.get('type') == 'photostrip':
+                delta['photostrip_count'] += 1
+            else:
+                delta['image_count'] += 1
+                if delta['cover_image_id'] is None:
+                    delta['cover_image_id'] = metadata.get('id')
+            delta['latest_timestamp'] = max(delta['latest_timestamp'], metadata.get('timestamp') or '')
+            # Linked duplicates reuse another record's bytes
+            if not metadata.get('duplicate_of'):
+                delta['bytes'] += metadata.get('blob_size') or 0
+            if metadata.get('original_blob_ref'):
+                delta['bytes'] += metadata.get('file_size') or 0
+        return deltas
+
+    def _apply(self, deltas: Dict[str, dict]):
+        self._conn.executemany("""
+            INSERT INTO sessions (session_id, image_count, photostrip_count, latest_timestamp, cover_image_id, bytes)
+            VALUES (:session_id, :image_count, :photostrip_count, :latest_timestamp, :cover_image_id, :bytes)
+            ON CONFLICT (session_id) DO UPDATE SET
+                image_count = image_count + excluded.image_count,
+                photostrip_count = photostrip_count + excluded.photostrip_count,
+                latest_timestamp = MAX(latest_timestamp, excluded.latest_timestamp),
+                cover_image_id = COALESCE(cover_image_id, excluded.cover_image_id),
+                bytes = bytes + excluded.bytes
+        """, [dict(delta, session_id=session_id) for session_id, delta in deltas.items()])
+
+    def record(self, metadatas: List[dict]):
+        """Account for records that were just added to the collection"""
+        with self._lock, self._conn:
+            self._apply(self._summarize(metadatas))
+
+    def rebuild(self, source, batch_size: int = 500) -> int:
+        """Recompute every summary from the collection; returns the session count
+
+        Read times and per-session TTLs of sessions that still have records are kept.
+        """
+        deltas: Dict[str, dict] = {}
+        offset = 0
+        while True:
+            page = source.get(include=["metadatas"], limit=batch_size, offset=offset)
+            if not page['ids']:
+                break
+            for session_id, delta in self._summarize(page['metadatas']).items():
+                total = deltas.setdefault(session_id, delta)
+                if total is not delta:
+                    total['image_count'] += delta['image_count']
+                    total['photostrip_count'] += delta['photostrip_count']
+                    total['latest_timestamp'] = max(total['latest_timestamp'], delta['latest_timestamp'])
+                    total['cover_image_id'] = total['cover_image_id'] or delta['cover_image_id']
+                    total['bytes'] += delta['bytes']
+            offset += len(page['ids'])
+
+        with self._lock, self._conn:
+            self._conn.execute("""
+                UPDATE sessions SET image_count = 0, photostrip_count = 0, latest_timestamp = '',
+                    cover_image_id = NULL, bytes = 0
+            """)
+            self._apply(deltas)
+            self._conn.execute("DELETE FROM sessions WHERE image_count = 0 AND photostrip_count = 0")
+        return len(deltas)
+
+    def forget(self, session_id: str) -> Optional[dict]:
+        """Drop a session's summary; returns it, or None if there was none"""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                f"DELETE FROM sessions WHERE session_id = ? RETURNING {', '.join(self.COLUMNS)}", (session_id,)
+            ).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def touch(self, accessed: Dict[str, str]):
+        """Record read times by session id (ISO timestamps)"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE sessions SET last_access = MAX(COALESCE(last_access, ''), ?) WHERE session_id = ?",
+                [(timestamp, session_id) for session_id, timestamp in accessed.items()]
+            )
+
+    def set_ttl(self, session_id: str, ttl_hours: Optional[float]) -> bool:
+        """Give a session its own TTL (None restores the default); False if the session is unknown"""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE sessions SET ttl_hours = ? WHERE session_id = ?", (ttl_hours, session_id)
+            ).rowcount == 1
+
+    def expired(self, default_ttl_hours: float, now: datetime) -> List[str]:
+        """Sessions not written or read for longer than their TTL (0 = never expires)"""
+        with self._lock:
+            rows = self._conn.execute(f"""
+                SELECT session_id FROM sessions
+                WHERE COALESCE(ttl_hours, ?) > 0
+                    AND julianday({self.RECENCY}) + COALESCE(ttl_hours, ?) / 24.0 < julianday(?)
+            """, (default_ttl_hours, default_ttl_hours, now.isoformat())).fetchall()
+        return [row[0] for row in rows]
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM sessions").fetchone()[0]
+
+    def least_recent(self, limit: int) -> List[Tuple[str, int]]:
+        """(session_id, bytes) of the sessions least recently written or read
+
+        Sessions given a TTL of 0 are kept forever, and deleting those
+        storing nothing frees no space, so neither is listed.
+        """
+        with self._lock:
+            return self._conn.execute(f"""
+                SELECT session_id, bytes FROM sessions WHERE (ttl_hours IS NULL OR ttl_hours > 0) AND bytes > 0
+                ORDER BY {self.RECENCY}, session_id LIMIT ?
+            """, (limit,)).fetchall()
+
+    def add_to_counter(self, name: str, amount: int):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                (name, amount)
+            )
+
+    def take_counter(self, name: str) -> int:
+        """Read a counter and reset it to zero"""
+        with self._lock, self._conn:
+            row = self._conn.execute("DELETE FROM counters WHERE name = ? RETURNING value", (name,)).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def encode_cursor(row: dict) -> str:
+        raw = json.dumps([row['latest_timestamp'], row['session_id']]).encode()
+        return base64.urlsafe_b64encode(raw).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[str, str]:
+        latest_timestamp, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(latest_timestamp), str(session_id)
+
+    def page(self, limit: int, cursor: Optional[str] = None):
+        """Sessions ordered by recency; returns (rows, next_cursor)"""
+        query = f"SELECT {', '.join(self.COLUMNS)} FROM sessions"
+        params: list = []
+        if cursor:
+            query += " WHERE (latest_timestamp, session_id) < (?, ?)"
+            params.extend(self.decode_cursor(cursor))
+        query += " ORDER BY latest_timestamp DESC, session_id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        sessions = [dict(zip(self.COLUMNS, row)) for row in rows[:limit]]
+        for session in sessions:
+            session['latest_timestamp'] = session['latest_timestamp'] or None
+        next_cursor = self.encode_cursor(dict(zip(self.COLUMNS, rows[limit - 1]))) if len(rows) > limit else None
+        return sessions, next_cursor
+
+session_index = SessionIndex(SESSION_INDEX_PATH)
+
+@storage.on_open
+def _backfill_session_index(store):
+    if session_index.needs_backfill and store.count():
+        # First start with an existing store, or an index from an older version: backfill once
+        session_index.rebuild(store)
 
 @dataclass
 class PhotoMetadata:
@@ -61,187 +1684,1799 @@ class PhotoMetadata:
     dimensions: tuple
     file_size: int
 
-class ImageProcessor:
-    """Handle image processing and filter applications"""
-    
-    @staticmethod
-    def apply_vintage_filter(image: Image.Image) -> Image.Image:
-        """Apply a vintage/sepia filter"""
-        # Convert to RGBA if not already
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
-        
-        # Create sepia effect
-        pixels = np.array(image)
-        
-        # Sepia transformation matrix
-        sepia_filter = np.array([
-            [0.393, 0.769, 0.189, 0],
-            [0.349, 0.686, 0.168, 0],
-            [0.272, 0.534, 0.131, 0],
-            [0, 0, 0, 1]
-        ])
-        
-        sepia_img = pixels @ sepia_filter.T
-        sepia_img = np.clip(sepia_img, 0, 255).astype(np.uint8)
-        
-        return Image.fromarray(sepia_img, 'RGBA')
+# Filter chain engine
+#
+# Filters are registered as a sequence of ops:
+#   matrix  - affine colour transform (3x4) applied to RGB; consecutive
+#             matrix ops are folded into one matrix and applied in one pass
+#   lut     - per-channel 256-entry lookup tables (3x256 uint8)
+#   spatial - a PIL operation on the whole image (e.g. blur)
+# A matrix op may instead give ``matrix_fn(mean_rgb) -> 3x4`` when it
+# depends on image statistics (contrast); the mean is propagated through
+# the folded matrix so no extra pass is needed.
+
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114])
+
+@dataclass(eq=False)
+class FilterOp:
+    kind: str  # 'matrix', 'lut' or 'spatial'
+    matrix: Optional[np.ndarray] = None
+    matrix_fn: Optional[Callable[[np.ndarray], np.ndarray]] = None
+    lut: Optional[np.ndarray] = None
+    spatial: Optional[Callable[[Image.Image], Image.Image]] = None
+    halo: int = 0  # rows of context a spatial op reads beyond each output pixel
+
+    def resolve_matrix(self, mean_rgb: np.ndarray) -> np.ndarray:
+        return self.matrix if self.matrix is not None else self.matrix_fn(mean_rgb)
+
+@dataclass(eq=False)
+class FilterSpec:
+    name: str   # name used in requests, e.g. 'bw'
+    label: str  # name recorded in filters_applied, e.g. 'black_white'
+    ops: List[FilterOp]
+    alpha: str = 'keep'  # 'keep', 'add' (ensure alpha), 'opaque' (alpha=255) or 'drop'
+
+FILTER_REGISTRY: Dict[str, FilterSpec] = {}
+
+def register_filter(name: str, ops: List[FilterOp], label: Optional[str] = None, alpha: str = 'keep'):
+    """Register a filter so it can be used in filter chains"""
+    FILTER_REGISTRY[name] = FilterSpec(name=name, label=label or name, ops=list(ops), alpha=alpha)
+    compile_filter_chain.cache_clear()
+
+def matrix_op(matrix) -> FilterOp:
+    """Affine colour op from a 3x3 or 3x4 matrix"""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if matrix.shape == (3, 3):
+        matrix = np.hstack([matrix, np.zeros((3, 1))])
+    return FilterOp(kind='matrix', matrix=matrix)
+
+def saturation_matrix(factor: float) -> np.ndarray:
+    """Blend towards luma, as ImageEnhance.Color does"""
+    return factor * np.eye(3) + (1 - factor) * np.outer(np.ones(3), LUMA_WEIGHTS)
+
+def contrast_op(factor: float) -> FilterOp:
+    """Blend towards mean luma, as ImageEnhance.Contrast does"""
+    def build(mean_rgb: np.ndarray) -> np.ndarray:
+        mean = int(float(LUMA_WEIGHTS @ mean_rgb) + 0.5)
+        return np.hstack([factor * np.eye(3), np.full((3, 1), (1 - factor) * mean)])
+    return FilterOp(kind='matrix', matrix_fn=build)
+
+def _compose(outer: np.ndarray, inner: np.ndarray) -> np.ndarray:
+    """Matrix equivalent to applying ``inner`` then ``outer``"""
+    return np.hstack([outer[:, :3] @ inner[:, :3], outer[:, :3] @ inner[:, 3:] + outer[:, 3:]])
+
+@dataclass(eq=False)
+class CompiledFilterChain:
+    """A filter chain grouped into fused passes over the image"""
+    labels: List[str]
+    # Steps are ('matrices', [FilterOp, ...]), ('lut', FilterOp),
+    # ('spatial', FilterOp) or ('alpha', mode)
+    steps: List[Tuple[str, object]] = field(default_factory=list)
+
+    def apply(self, image: Image.Image, tile_pixels: int = 0) -> Image.Image:
+        """Run the chain; images over ``tile_pixels`` are processed in row strips"""
+        if not self.steps:
+            return image
+        if tile_pixels and image.width * image.height > tile_pixels:
+            return self._apply_tiled(image, tile_pixels)
+        return self._merge(*self._run(image, {}))
+
+    def _run(self, image: Image.Image, folded: Dict[int, np.ndarray], stop: Optional[int] = None):
+        """Run steps (up to ``stop``) on an image; returns its colour and alpha
+
+        ``folded`` holds pre-resolved matrices by step index, otherwise
+        statistics come from ``image`` itself.
+        """
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        rgb, alpha = self._split(image if has_alpha else image.convert('RGB'))
+
+        for index, (kind, payload) in enumerate(self.steps[:stop]):
+            if kind == 'matrices':
+                matrix = folded.get(index)
+                if matrix is None:
+                    matrix = self._fold(payload, lambda: np.array(ImageStat.Stat(rgb).mean))
+                rgb = self._apply_matrix(rgb, matrix)
+            elif kind == 'lut':
+                rgb = rgb.point(payload.lut.reshape(-1).tolist())
+            elif kind == 'spatial':
+                rgb, alpha = self._split(payload.spatial(self._merge(rgb, alpha)))
+            elif kind == 'alpha':
+                if payload == 'drop':
+                    alpha = None
+                elif payload == 'opaque' or (payload == 'add' and alpha is None):
+                    alpha = Image.new('L', rgb.size, 255)
+
+        return rgb, alpha
+
+    def _apply_tiled(self, image: Image.Image, tile_pixels: int) -> Image.Image:
+        """Row-strip execution with peak working memory bound by the strip size
+
+        Strips are widened by the summed halo of the spatial steps so blurs
+        see the same neighbourhood as on the whole image, and whole-image
+        statistics are gathered strip by strip before any matrix that needs
+        them is folded. The result matches the untiled path exactly.
+        """
+        width, height = image.size
+        halo = sum(payload.halo for kind, payload in self.steps if kind == 'spatial')
+        rows = max(1, tile_pixels // width)
+        folded: Dict[int, np.ndarray] = {}
+
+        def strips(stop: Optional[int] = None):
+            for top in range(0, height, rows):
+                bottom = min(top + rows, height)
+                upper, lower = max(0, top - halo), min(height, bottom + halo)
+                rgb, alpha = self._run(image.crop((0, upper, width, lower)), folded, stop)
+                yield top, (0, top - upper, width, bottom - upper), rgb, alpha
+
+        def mean_before(index: int) -> np.ndarray:
+            total = np.zeros(3)
+            for _, core, rgb, _ in strips(index):
+                total += ImageStat.Stat(rgb.crop(core)).sum
+            return total / (width * height)
+
+        for index, (kind, payload) in enumerate(self.steps):
+            if kind == 'matrices':
+                folded[index] = self._fold(payload, lambda: mean_before(index))
+
+        output = None
+        for top, core, rgb, alpha in strips():
+            strip = self._merge(rgb, alpha).crop(core)
+            if output is None:
+                output = Image.new(strip.mode, image.size)
+            output.paste(strip, (0, top))
+        return output
+
+    @staticmethod
+    def _split(image: Image.Image):
+        if image.mode == 'RGB':
+            return image, None
+        image = image.convert('RGBA')
+        return image.convert('RGB'), image.getchannel('A')
+
+    @staticmethod
+    def _merge(rgb: Image.Image, alpha: Optional[Image.Image]) -> Image.Image:
+        if alpha is None:
+            return rgb
+        rgba = rgb.convert('RGBA')
+        rgba.putalpha(alpha)
+        return rgba
+
+    @staticmethod
+    def _fold(ops: List[FilterOp], input_mean: Callable[[], np.ndarray]) -> np.ndarray:
+        """Fold ops into one matrix, propagating the input mean for statistic-dependent ops"""
+        folded = np.hstack([np.eye(3), np.zeros((3, 1))])
+        mean_rgb = None
+        for op in ops:
+            if op.matrix is None and mean_rgb is None:
+                mean_rgb = input_mean()
+            current_mean = None if mean_rgb is None else folded[:, :3] @ mean_rgb + folded[:, 3]
+            folded = _compose(op.resolve_matrix(current_mean), folded)
+        return folded
+
+    @staticmethod
+    def _apply_matrix(rgb: Image.Image, folded: np.ndarray) -> Image.Image:
+        # Channel-independent transforms are cheaper as lookup tables
+        if np.count_nonzero(folded[:, :3] - np.diag(np.diag(folded[:, :3]))) == 0:
+            levels = np.arange(256, dtype=np.float32)
+            lut = np.stack([levels * folded[c, c] + folded[c, 3] for c in range(3)])
+            return rgb.point(np.clip(np.rint(lut), 0, 255).astype(np.uint8).reshape(-1).tolist())
+
+        # Identical rows (grayscale) only need a single-channel pass
+        if np.allclose(folded, folded[0]):
+            return rgb.convert('L', tuple(folded[0])).convert('RGB')
+
+        # One pass of PIL's float32 colour-matrix conversion, clipped to uint8
+        return rgb.convert('RGB', tuple(folded.reshape(-1)))
+
+@lru_cache(maxsize=128)
+def compile_filter_chain(filter_names: Tuple[str, ...]) -> CompiledFilterChain:
+    """Compile filter names into fused passes; unknown names are skipped"""
+    chain = CompiledFilterChain(labels=[])
+    pending: List[FilterOp] = []
+
+    def flush():
+        if pending:
+            chain.steps.append(('matrices', list(pending)))
+            pending.clear()
+
+    for name in filter_names:
+        spec = FILTER_REGISTRY.get(name)
+        if spec is None:
+            continue
+        chain.labels.append(spec.label)
+        for op in spec.ops:
+            if op.kind == 'matrix':
+                pending.append(op)
+            else:
+                flush()
+                chain.steps.append((op.kind, op))
+        if spec.alpha != 'keep':
+            # Alpha changes are independent of colour, so they don't break fusion
+            chain.steps.append(('alpha', spec.alpha))
+
+    flush()
+    return chain
+
+# PIL's radius-2 Gaussian is three box passes; this covers their combined reach
+BLUR_HALO = 8
+
+def _gaussian_blur(image: Image.Image) -> Image.Image:
+    return image.filter(ImageFilter.GaussianBlur(radius=2))
+
+register_filter('vintage', [matrix_op([
+    [0.393, 0.769, 0.189],
+    [0.349, 0.686, 0.168],
+    [0.272, 0.534, 0.131],
+])], alpha='add')
+register_filter('bw', [matrix_op(np.outer(np.ones(3), LUMA_WEIGHTS))], label='black_white', alpha='opaque')
+register_filter('blur', [FilterOp(kind='spatial', spatial=_gaussian_blur, halo=BLUR_HALO)])
+register_filter('enhance', [matrix_op(saturation_matrix(1.2)), contrast_op(1.1)])
+register_filter('retro', [matrix_op(saturation_matrix(0.8)), matrix_op(np.diag([1.1, 1.0, 0.9]))], alpha='drop')
+
+class ImageProcessor:
+    """Handle image processing and filter applications"""
+    
+    @staticmethod
+    def apply_filters(image: Image.Image, filter_list: List[str], tile_pixels: Optional[int] = None):
+        """Apply filters as one compiled chain; returns the image and the names of filters applied
+        
+        Images larger than ``tile_pixels`` (default PHOTOBOOTH_FILTER_TILE_PIXELS)
+        are filtered in row strips.
+        """
+        chain = compile_filter_chain(tuple(filter_list))
+        if tile_pixels is None:
+            tile_pixels = FILTER_TILE_PIXELS
+        return chain.apply(image, tile_pixels), list(chain.labels)
+
+class LRUCache:
+    """Small thread-safe least-recently-used cache"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+    
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+
+@dataclass(frozen=True)
+class StripLayout:
+    name: str = "classic"
+    strip_width: int = 400
+    strip_height: int = 1200
+    photo_width: int = 350
+    photo_height: int = 250
+    margin: int = 25
+    photos_per_strip: int = 4
+    header_text: str = "PHOTOBOOTH"
+
+STRIP_LAYOUTS: Dict[str, StripLayout] = {"classic": StripLayout()}
+
+@lru_cache(maxsize=1)
+def load_strip_fonts():
+    """Load header and small fonts once per process"""
+    try:
+        # Try to use a nice font, fall back to default if not available
+        return ImageFont.truetype("arial.ttf", 24), ImageFont.truetype("arial.ttf", 16)
+    except OSError:
+        return ImageFont.load_default(), ImageFont.load_default()
+
+class PhotoStripGenerator:
+    """Generate formatted photo strips
+    
+    The static parts of a strip (header and photo frames) are rendered
+    once per layout into a template, and slot-sized thumbnails are kept
+    in an LRU cache keyed by image id.
+    """
+    
+    def __init__(self, layout: StripLayout = STRIP_LAYOUTS["classic"]):
+        self.layout = layout
+        self.strip_width = layout.strip_width
+        self.strip_height = layout.strip_height
+        self.photo_width = layout.photo_width
+        self.photo_height = layout.photo_height
+        self.margin = layout.margin
+        self.photos_per_strip = layout.photos_per_strip
+        self.font, self.small_font = load_strip_fonts()
+        self._templates: Dict[int, Image.Image] = {}
+        self._thumbnails = LRUCache(STRIP_THUMBNAIL_CACHE_SIZE)
+    
+    def slot_positions(self) -> List[Tuple[int, int]]:
+        """Top-left corner of each photo slot"""
+        x_position = (self.strip_width - self.photo_width) // 2
+        return [
+            (x_position, 80 + i * (self.photo_height + self.margin))
+            for i in range(self.photos_per_strip)
+        ]
+    
+    def template(self, photo_count: int) -> Image.Image:
+        """Blank strip with header and frames for ``photo_count`` photos, built once"""
+        if photo_count not in self._templates:
+            strip = Image.new('RGB', (self.strip_width, self.strip_height), 'white')
+            draw = ImageDraw.Draw(strip)
+            self._draw_centered(draw, self.layout.header_text, 10, 'black', self.font)
+            
+            # Frames sit just outside each slot, so photos never cover them
+            for x_position, y_position in self.slot_positions()[:photo_count]:
+                draw.rectangle([
+                    x_position - 2, y_position - 2,
+                    x_position + self.photo_width + 2, y_position + self.photo_height + 2
+                ], outline='black', width=2)
+            self._templates[photo_count] = strip
+        return self._templates[photo_count]
+    
+    def _draw_centered(self, draw: ImageDraw.ImageDraw, text: str, y: int, fill: str, font):
+        bbox = draw.textbbox((0, 0), text, font=font)
+        text_width = bbox[2] - bbox[0]
+        draw.text(((self.strip_width - text_width) // 2, y), text, fill=fill, font=font)
+    
+    def fit_to_slot(self, image: Image.Image) -> Image.Image:
+        """Resize an image to the slot size"""
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        # reducing_gap lets Pillow shrink by an integer factor before the LANCZOS pass
+        return image.resize((self.photo_width, self.photo_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    
+    def thumbnail(self, image_id: str, loader: Callable[[], Image.Image]) -> Image.Image:
+        """Slot-sized version of an image, cached by image id"""
+        cached = self._thumbnails.get(image_id)
+        if cached is None:
+            cached = self.fit_to_slot(loader())
+            self._thumbnails.put(image_id, cached)
+        return cached
+    
+    def create_photostrip(self, images: List[Image.Image], session_id: str) -> Image.Image:
+        """Create a formatted photostrip from multiple images"""
+        images = images[:self.photos_per_strip]
+        strip = self.template(len(images)).copy()
+        draw = ImageDraw.Draw(strip)
+        
+        # Date
+        date_text = datetime.now().strftime("%Y-%m-%d %H:%M")
+        self._draw_centered(draw, date_text, 40, 'gray', self.small_font)
+        
+        # Add photos
+        for img, position in zip(images, self.slot_positions()):
+            if img.size != (self.photo_width, self.photo_height):
+                img = self.fit_to_slot(img)
+            strip.paste(img, position)
+        
+        # Add footer
+        footer_text = f"Session: {session_id[:8]}"
+        self._draw_centered(draw, footer_text, self.strip_height - 30, 'gray', self.small_font)
+        
+        return strip
+
+_strip_generators: Dict[str, PhotoStripGenerator] = {}
+
+def get_strip_generator(layout_name: str) -> PhotoStripGenerator:
+    """Shared generator (and its template and thumbnail cache) for a layout"""
+    if layout_name not in _strip_generators:
+        _strip_generators[layout_name] = PhotoStripGenerator(STRIP_LAYOUTS[layout_name])
+    return _strip_generators[layout_name]
+
+def photostrip_key(image_ids: List[str], layout_name: str, fmt: str, profile: str) -> str:
+    """Cache key for a strip rendered from these images with this layout, format and encoding profile"""
+    return hashlib.sha256(json.dumps([layout_name, image_ids, fmt, profile]).encode()).hexdigest()
+
+# Image descriptors
+#
+# Each descriptor maps a batch of small RGB feature inputs (N, 64, 64, 3)
+# uint8 to an (N, dim) float32 block. Blocks are L2-normalized and
+# concatenated; the combination is recorded in metadata as ``descriptor``
+# so stored embeddings can be recognised and re-indexed when it changes.
+
+DESCRIPTOR_INPUT_SIZE = 64
+
+class ImageDescriptor:
+    name = ""
+    dim = 0
+    
+    def compute(self, batch: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+def _luma(batch: np.ndarray) -> np.ndarray:
+    return batch.astype(np.float32) @ LUMA_WEIGHTS.astype(np.float32)
+
+class HSVHistogramDescriptor(ImageDescriptor):
+    """Joint hue/saturation/value histogram (square-rooted for L2 comparison)"""
+    name = "hsv_hist"
+    bins = (12, 3, 3)
+    dim = 12 * 3 * 3
+    
+    def compute(self, batch: np.ndarray) -> np.ndarray:
+        rgb = batch.astype(np.float32) / 255.0
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        maxc = rgb.max(axis=-1)
+        delta = maxc - rgb.min(axis=-1)
+        safe = np.maximum(delta, 1e-6)
+        
+        hue = np.where(maxc == r, ((g - b) / safe) % 6,
+              np.where(maxc == g, (b - r) / safe + 2, (r - g) / safe + 4)) / 6
+        hue = np.where(delta > 0, hue, 0)
+        sat = np.where(maxc > 0, delta / np.maximum(maxc, 1e-6), 0)
+        
+        h_bins, s_bins, v_bins = self.bins
+        index = (np.minimum((hue * h_bins).astype(np.intp), h_bins - 1) * s_bins
+                 + np.minimum((sat * s_bins).astype(np.intp), s_bins - 1)) * v_bins \
+                 + np.minimum((maxc * v_bins).astype(np.intp), v_bins - 1)
+        
+        # One bincount for the whole batch: offset each image into its own range
+        count = len(batch)
+        index = index.reshape(count, -1) + (np.arange(count) * self.dim)[:, np.newaxis]
+        hist = np.bincount(index.ravel(), minlength=count * self.dim).reshape(count, self.dim)
+        return np.sqrt(hist / index.shape[1]).astype(np.float32)
+
+class LumaGridDescriptor(ImageDescriptor):
+    """8x8 grid of mean brightness, zero-mean so it captures layout, not exposure"""
+    name = "luma_grid"
+    grid = 8
+    dim = 8 * 8
+    
+    def compute(self, batch: np.ndarray) -> np.ndarray:
+        luma = _luma(batch)
+        count, size = len(batch), luma.shape[1]
+        block = size // self.grid
+        cells = luma.reshape(count, self.grid, block, self.grid, block).mean(axis=(2, 4)).reshape(count, -1)
+        return cells - cells.mean(axis=1, keepdims=True)
+
+class PerceptualHashDescriptor(ImageDescriptor):
+    """64-bit DCT perceptual hash, as +-1 components"""
+    name = "phash"
+    dim = 64
+    
+    def __init__(self, size: int = 32, low: int = 8):
+        self.size = size
+        self.low = low
+        k = np.arange(size)[:, np.newaxis]
+        n = np.arange(size)[np.newaxis, :]
+        dct = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+        dct[0] /= np.sqrt(2.0)
+        self._dct = dct.astype(np.float32)
+    
+    def bits(self, batch: np.ndarray) -> np.ndarray:
+        """(N, 64) booleans: low-frequency DCT coefficients above their median"""
+        luma = _luma(batch)
+        count, size = len(batch), luma.shape[1]
+        factor = size // self.size
+        small = luma.reshape(count, self.size, factor, self.size, factor).mean(axis=(2, 4))
+        coeffs = (self._dct @ small @ self._dct.T)[:, :self.low, :self.low].reshape(count, -1)
+        # The DC term only reflects overall brightness, so keep it out of the median
+        median = np.median(coeffs[:, 1:], axis=1, keepdims=True)
+        return coeffs > median
+    
+    def hashes(self, batch: np.ndarray) -> List[int]:
+        """Pack the hash bits of each image into a 64-bit integer"""
+        packed = np.packbits(self.bits(batch), axis=1)
+        return [int.from_bytes(row.tobytes(), "big") for row in packed]
+    
+    def compute(self, batch: np.ndarray) -> np.ndarray:
+        return np.where(self.bits(batch), 1.0, -1.0).astype(np.float32)
+
+DESCRIPTORS: Dict[str, ImageDescriptor] = {
+    descriptor.name: descriptor
+    for descriptor in (HSVHistogramDescriptor(), LumaGridDescriptor(), PerceptualHashDescriptor())
+}
+
+class DescriptorPipeline:
+    """Concatenation of named descriptors into one unit-length embedding"""
+    
+    version_prefix = "v2"
+    
+    def __init__(self, names: List[str]):
+        unknown = [name for name in names if name not in DESCRIPTORS]
+        if unknown or not names:
+            raise ValueError(f"Unknown image descriptors: {unknown or names}")
+        self.descriptors = [DESCRIPTORS[name] for name in names]
+        self.version = f"{self.version_prefix}:{'+'.join(names)}"
+        self.dim = sum(d.dim for d in self.descriptors)
+    
+    def compute(self, batch: np.ndarray) -> np.ndarray:
+        blocks = []
+        for descriptor in self.descriptors:
+            block = descriptor.compute(batch)
+            norms = np.linalg.norm(block, axis=1, keepdims=True)
+            blocks.append(block / np.maximum(norms, 1e-6))
+        # Each block has unit length, so scale the concatenation back to unit length
+        return (np.hstack(blocks) / np.sqrt(len(blocks))).astype(np.float32)
+
+descriptor_pipeline = DescriptorPipeline(DESCRIPTOR_NAMES)
+
+@storage.on_open
+def _check_descriptor_version(store):
+    # Embeddings from other descriptors, of another size or in another
+    # distance space can't be compared with new ones: adds fail and scores
+    # come out wrong, so writes and searches are refused until a reindex
+    reasons = []
+    if store.distance_space != "cosine":
+        reasons.append(f"the store uses {store.distance_space} distance, not cosine")
+    sample = store.get(limit=1, include=["metadatas", "embeddings"])
+    if sample['ids']:
+        if len(sample['embeddings'][0]) != descriptor_pipeline.dim:
+            reasons.append(f"stored embeddings have {len(sample['embeddings'][0])} dimensions, "
+                           f"not {descriptor_pipeline.dim}")
+        elif sample['metadatas'][0].get('descriptor') != descriptor_pipeline.version:
+            reasons.append("stored embeddings use different descriptors")
+    storage.incompatible = "; ".join(reasons) or None
+    if storage.incompatible:
+        logger.warning("%s; run 'python app.py reindex'", storage.incompatible)
+
+def require_compatible_store():
+    """Refuse writes and searches while stored embeddings need a reindex"""
+    if storage.incompatible:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Stored embeddings are incompatible: {storage.incompatible}. Run 'python app.py reindex'"
+        )
+
+def perceptual_hash(feature_input: np.ndarray) -> int:
+    """64-bit perceptual hash of a single feature input"""
+    return DESCRIPTORS["phash"].hashes(feature_input[np.newaxis])[0]
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes for Hamming-radius queries"""
+    
+    def __init__(self):
+        # Node: [hash, payloads, {distance: child}]
+        self._root: Optional[list] = None
+        self.size = 0
+    
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        return (a ^ b).bit_count()
+    
+    def add(self, value: int, payload):
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [payload], {}]
+            return
+        node = self._root
+        while True:
+            d = self.distance(value, node[0])
+            if d == 0:
+                node[1].append(payload)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [payload], {}]
+                return
+            node = child
+    
+    def search(self, value: int, radius: int) -> List[Tuple[int, int, object]]:
+        """(distance, hash, payload) for every entry within ``radius``, nearest first"""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            d = self.distance(value, node[0])
+            if d <= radius:
+                found.extend((d, node[0], payload) for payload in node[1])
+            # Triangle inequality: only children at distance d +- radius can match
+            for child_distance, child in node[2].items():
+                if d - radius <= child_distance <= d + radius:
+                    stack.append(child)
+        found.sort(key=lambda item: item[0])
+        return found
+
+class HashIndex:
+    """Perceptual hashes of stored images, searchable by Hamming distance
+    
+    Entries are appended to a JSON-lines file and replayed into a BK-tree.
+    Lookups first read whatever was appended since the last one, so
+    entries added by other web workers are seen too. Deleted images are
+    appended as ``{"removed": [...]}`` lines and skipped until ``compact``
+    rewrites the file without them.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._tree = BKTree()
+        self._by_session: Dict[str, List[Tuple[int, str]]] = {}
+        self._removed: set = set()
+        self._lock = threading.Lock()
+        # Appends and rewrites exclude each other across processes
+        self._file_lock = ProcessLock(path + ".lock")
+        self._offset = 0
+        self._inode: Optional[int] = None
+    
+    def load(self):
+        """Replay the file now rather than on the first lookup"""
+        with self._lock:
+            self._catch_up()
+    
+    def _insert(self, value: int, image_id: str, session_id: str):
+        self._tree.add(value, (image_id, session_id))
+        self._by_session.setdefault(session_id, []).append((value, image_id))
+    
+    def _catch_up(self):
+        """Replay entries appended to the file since it was last read, by any process"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            # Replaced by a rebuild or compaction: start over
+            self._tree, self._by_session, self._removed = BKTree(), {}, set()
+            self._offset, self._inode = 0, stat.st_ino
+        if stat.st_size == self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # A line another process is still writing is picked up next time
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                if 'removed' in entry:
+                    self._removed.update(entry['removed'])
+                else:
+                    self._insert(int(entry['hash'], 16), entry['image_id'], entry['session_id'])
+        self._offset += len(complete)
+    
+    def _append(self, entry: dict):
+        line = json.dumps(entry) + "\n"
+        with self._lock, self._file_lock.hold():
+            # One O_APPEND write per entry, so lines from concurrent workers never interleave
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+            self._catch_up()
+    
+    def add(self, value: int, image_id: str, session_id: str):
+        self._append({'hash': f"{value:016x}", 'image_id': image_id, 'session_id': session_id})
+    
+    def remove(self, image_ids: List[str]):
+        """Forget deleted images"""
+        if image_ids:
+            self._append({'removed': list(image_ids)})
+    
+    def _write(self, entries: List[Tuple[int, str, str]]):
+        """Replace the file with ``entries``; call with both locks held"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for value, image_id, session_id in entries:
+                f.write(json.dumps({'hash': f"{value:016x}", 'image_id': image_id, 'session_id': session_id}) + "\n")
+        os.replace(tmp_path, self.path)
+        self._catch_up()
+    
+    def compact(self) -> int:
+        """Rewrite the file without removed images; returns the number of entries dropped"""
+        with self._lock, self._file_lock.hold():
+            self._catch_up()
+            if not self._removed:
+                return 0
+            live = [
+                (value, image_id, session_id)
+                for session_id, entries in self._by_session.items()
+                for value, image_id in entries
+                if image_id not in self._removed
+            ]
+            dropped = sum(len(entries) for entries in self._by_session.values()) - len(live)
+            self._write(live)
+        return dropped
+    
+    def rebuild(self, source, batch_size: int = 256) -> int:
+        """Re-create the index from the collection's single images; returns the entry count"""
+        entries = []
+        offset = 0
+        while True:
+            page = source.get(include=["metadatas"], limit=batch_size, offset=offset)
+            if not page['ids']:
+                break
+            offset += len(page['ids'])
+            for record_id, metadata in zip(page['ids'], page['metadatas']):
+                if metadata.get('type') == 'photostrip':
+                    continue
+                if metadata.get('phash'):
+                    value = int(metadata['phash'], 16)
+                else:
+                    img_data = load_image_bytes(metadata)
+                    if img_data is None:
+                        continue
+                    image = Image.open(io.BytesIO(img_data))
+                    value = perceptual_hash(VectorImageDatabase.prepare_feature_input(image))
+                entries.append((value, record_id, metadata.get('session_id', '')))
+        
+        with self._lock, self._file_lock.hold():
+            self._write(entries)
+        return len(entries)
+    
+    def matches(self, value: int, radius: int) -> List[Tuple[int, str]]:
+        """(distance, image id) of every stored image within ``radius`` bits, nearest first"""
+        with self._lock:
+            self._catch_up()
+            return [
+                (distance, payload[0]) for distance, _, payload in self._tree.search(value, radius)
+                if payload[0] not in self._removed
+            ]
+    
+    def nearest(self, value: int, radius: int) -> Optional[str]:
+        """Id of the closest stored image within ``radius`` bits, if any"""
+        matches = self.matches(value, radius)
+        return matches[0][1] if matches else None
+    
+    def session_clusters(self, session_id: str, radius: int) -> List[List[str]]:
+        """Groups of near-identical images within a session (size > 1)"""
+        with self._lock:
+            self._catch_up()
+            entries = [entry for entry in self._by_session.get(session_id, []) if entry[1] not in self._removed]
+            neighbours = {
+                image_id: [
+                    payload[0] for _, _, payload in self._tree.search(value, radius)
+                    if payload[1] == session_id and payload[0] not in self._removed
+                ]
+                for value, image_id in entries
+            }
+        
+        # Union-find over the within-radius pairs
+        parent = {image_id: image_id for _, image_id in entries}
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+        for image_id, near in neighbours.items():
+            for other in near:
+                parent[find(other)] = find(image_id)
+        
+        clusters: Dict[str, List[str]] = {}
+        for _, image_id in entries:
+            clusters.setdefault(find(image_id), []).append(image_id)
+        return [members for members in clusters.values() if len(members) > 1]
+
+hash_index = HashIndex(HASH_INDEX_PATH)
+
+@storage.on_open
+def _load_hash_index(store):
+    # Replayed with the store during warm-up instead of at import
+    hash_index.load()
+
+class VectorImageDatabase:
+    """Handle vector database operations for images"""
+    
+    @staticmethod
+    def extract_image_features(image: Image.Image) -> List[float]:
+        """Extract features from image for vector embedding"""
+        feature_input = VectorImageDatabase.prepare_feature_input(image)
+        return VectorImageDatabase.features_from_arrays(feature_input[np.newaxis])[0].tolist()
+    
+    @staticmethod
+    def prepare_feature_input(image: Image.Image) -> np.ndarray:
+        """Resize an image to the small RGB input shared by all descriptors"""
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        size = (DESCRIPTOR_INPUT_SIZE, DESCRIPTOR_INPUT_SIZE)
+        return np.asarray(image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0), dtype=np.uint8)
+    
+    @staticmethod
+    def features_from_arrays(batch: np.ndarray) -> np.ndarray:
+        """Compute embeddings for a stacked batch of feature inputs (N, 64, 64, 3)"""
+        return descriptor_pipeline.compute(batch)
+    
+    @staticmethod
+    def generate_image_description(metadata: PhotoMetadata) -> str:
+        """Generate description for text embedding"""
+        filters_str = ", ".join(metadata.filters_applied) if metadata.filters_applied else "none"
+        return f"Image {metadata.filename} with filters: {filters_str}, size: {metadata.dimensions}, taken at {metadata.timestamp}"
+
+# Initialize processors
+image_processor = ImageProcessor()
+strip_generator = get_strip_generator("classic")
+strip_results = LRUCache(STRIP_RESULT_CACHE_SIZE)  # photostrip_key -> strip id
+vector_db = VectorImageDatabase()
+
+class SimilaritySearch:
+    """Nearest-neighbour search with cached embeddings and results
+    
+    Target embeddings are cached by image id and results by query, filter,
+    limit and cutoff. Every store write clears the cached results, since a
+    new record may rank higher, and drops the embeddings of the records
+    written. A search that overlaps a write doesn't cache what it found.
+    Lookups sync the store first, so writes from other web workers
+    invalidate this worker's cache too.
+    """
+    
+    def __init__(self, cache_size: int):
+        self.embeddings = LRUCache(cache_size)
+        self.results = LRUCache(cache_size)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def invalidate(self, ids: Optional[List[str]] = None):
+        """Forget results, and the embeddings of ``ids`` (all of them when None)"""
+        self.generation += 1
+        self.results.clear()
+        if ids is None:
+            self.embeddings.clear()
+        else:
+            for image_id in ids:
+                self.embeddings.pop(image_id)
+    
+    def embeddings_for(self, image_ids: List[str]) -> Dict[str, np.ndarray]:
+        """Stored embeddings by id, fetching those not cached in one call; unknown ids are left out"""
+        storage.store.sync()
+        found, missing = {}, []
+        for image_id in dict.fromkeys(image_ids):
+            embedding = self.embeddings.get(image_id)
+            if embedding is None:
+                missing.append(image_id)
+            else:
+                found[image_id] = embedding
+        
+        if missing:
+            generation = self.generation
+            with timed_chroma("get"):
+                result = storage.store.get(ids=missing, include=["embeddings"])
+            for image_id, embedding in zip(result['ids'], result['embeddings']):
+                found[image_id] = np.asarray(embedding, dtype=np.float32)
+                if generation == self.generation:
+                    self.embeddings.put(image_id, found[image_id])
+        return found
+    
+    def search(self, queries: List[Tuple[Optional[str], np.ndarray]], limit: int, where: Optional[dict] = None,
+               min_similarity: Optional[float] = None) -> List[List[dict]]:
+        """Similar images for each (image_id, embedding) query, most similar first
+        
+        A query's own image is left out of its results. Queries that aren't
+        cached go to the store together as one multi-vector query.
+        """
+        storage.store.sync()
+        filter_key = json.dumps(where, sort_keys=True)
+        keys = [
+            (image_id or hashlib.sha1(embedding.tobytes()).hexdigest(), image_id is None,
+             limit, filter_key, min_similarity)
+            for image_id, embedding in queries
+        ]
+        results = [self.results.get(key) for key in keys]
+        pending = [i for i, cached in enumerate(results) if cached is None]
+        self.hits += len(queries) - len(pending)
+        self.misses += len(pending)
+        if not pending:
+            return results
+        
+        generation = self.generation
+        with timed_chroma("query"):
+            found = storage.store.query(
+                query_embeddings=np.stack([queries[i][1] for i in pending]).tolist(),
+                n_results=limit + 1,  # +1 because it may include the target image
+                where=where,
+                include=["metadatas", "distances"]
+            )
+        
+        for i, metadatas, distances in zip(pending, found['metadatas'], found['distances']):
+            similar_images = []
+            for metadata, distance in zip(metadatas, distances):
+                similarity = 1 - distance  # Convert distance to similarity
+                if metadata['id'] == queries[i][0]:  # Exclude the target image
+                    continue
+                if min_similarity is not None and similarity < min_similarity:
+                    break
+                similar_images.append({
+                    "image_id": metadata['id'],
+                    "similarity_score": similarity,
+                    "filters_applied": metadata.get('filters_applied', []),
+                    "timestamp": metadata.get('timestamp'),
+                    "session_id": metadata.get('session_id')
+                })
+            results[i] = similar_images[:limit]
+            if generation == self.generation:
+                self.results.put(keys[i], results[i])
+        return results
+    
+    def stats(self) -> dict:
+        return {
+            "cached_embeddings": len(self.embeddings),
+            "cached_results": len(self.results),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+similarity_search = SimilaritySearch(SEARCH_CACHE_SIZE)
+
+@storage.on_open
+def _invalidate_search_on_write(store):
+    store.on_change(similarity_search.invalidate)
+
+def search_filter(type: Optional[str] = None, session_id: Optional[str] = None) -> Optional[dict]:
+    """Store ``where`` filter for a record type and/or session"""
+    conditions = []
+    if type == "photostrip":
+        conditions.append({"type": "photostrip"})
+    elif type == "single_image":
+        # Records from before types were recorded are single images
+        conditions.append({"type": {"$ne": "photostrip"}})
+    elif type is not None:
+        raise ValueError(f"Unknown type: {type} (choose single_image or photostrip)")
+    if session_id:
+        conditions.append({"session_id": session_id})
+    
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+class IngestPolicy:
+    """Decode uploads no larger than needed
+    
+    Oversized uploads are shrunk to ``max_edge`` before any filter runs:
+    JPEGs decode directly at 1/2, 1/4 or 1/8 scale via DCT scaling
+    (``Image.draft``), then ``Image.reduce`` takes whole-factor steps and
+    a final resample lands on the target size. Palette, bilevel and 16-bit
+    images are converted first, since neither step handles those modes.
+    """
+    
+    def __init__(self, max_edge: int, preserve_originals: bool):
+        self.max_edge = max_edge
+        self.preserve_originals = preserve_originals
+    
+    def open(self, source) -> Tuple[Image.Image, Tuple[int, int]]:
+        """Decode an upload; returns the working image and the original size"""
+        image = Image.open(source)
+        original_size = image.size
+        if not self.max_edge or max(original_size) <= self.max_edge:
+            return image, original_size
+        
+        scale = self.max_edge / max(original_size)
+        target = (max(1, round(original_size[0] * scale)), max(1, round(original_size[1] * scale)))
+        
+        # Picks the smallest DCT scale that still covers the target; no-op for non-JPEG
+        image.draft(None, target)
+        image = self._resizable(image)
+        
+        factor = min(image.size[0] // target[0], image.size[1] // target[1])
+        if factor > 1:
+            image = image.reduce(factor)
+        if image.size != target:
+            image = image.resize(target, Image.Resampling.LANCZOS)
+        return image, original_size
+    
+    # Modes Image.reduce and LANCZOS resampling work on directly
+    RESIZABLE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr', 'I', 'F')
+    
+    @classmethod
+    def _resizable(cls, image: Image.Image) -> Image.Image:
+        """Convert palette, bilevel and 16-bit images to a mode that can be resampled"""
+        if image.mode in cls.RESIZABLE_MODES:
+            return image
+        if image.mode == '1':
+            return image.convert('L')
+        if image.mode.startswith('I;16'):
+            return image.convert('I')
+        return image.convert('RGBA' if image.mode.endswith('A') or 'transparency' in image.info else 'RGB')
+    
+    # Working images alive at once per upload: decoded, filtered and the encoder's copy
+    WORKING_COPIES = 3
+    
+    def estimate_memory(self, path: str) -> int:
+        """Rough peak bytes needed to process an upload, from its header alone"""
+        try:
+            with Image.open(path) as image:
+                width, height = image.size
+        except Exception:
+            # Not decodable; the worker will reject it without allocating much
+            return os.path.getsize(path)
+        if self.max_edge and max(width, height) > self.max_edge:
+            scale = self.max_edge / max(width, height)
+            width, height = width * scale, height * scale
+        return int(width * height) * 4 * self.WORKING_COPIES
+
+ingest_policy = IngestPolicy(MAX_WORKING_EDGE, PRESERVE_ORIGINALS)
+
+class WorkerPool:
+    """Run CPU-bound jobs off the event loop with bounded queueing
+
+    At most ``queue_depth`` jobs may be queued or running; further
+    submissions are rejected with 503 and a Retry-After estimate. Jobs
+    that exceed ``timeout`` seconds fail with 504. The executor is created
+    on first use so importing the app stays cheap.
+    """
+
+    def __init__(self, kind: str, workers: int, queue_depth: int, timeout: float):
+        if kind not in ("process", "thread"):
+            raise ValueError(f"Unknown worker pool kind: {kind!r}")
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.queue_depth = max(self.workers, queue_depth)
+        self.timeout = timeout
+        self._executor: Optional[Executor] = None
+        # Guards the queue counters and creating or replacing the executor
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._avg_duration = 1.0
+
+    def _get_executor(self) -> Executor:
+        # Under the lock, so concurrent first jobs or rebuilds share one executor
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="photobooth")
+            return self._executor
+
+    def _retry_after(self) -> int:
+        """Seconds until a slot is likely to free up"""
+        backlog = self._in_flight / self.workers
+        return max(1, int(backlog * self._avg_duration + 0.5))
+
+    def _discard(self, executor: Executor):
+        """Drop a broken executor so the next job starts a fresh one"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _release(self, started: float):
+        duration = time.monotonic() - started
+        with self._lock:
+            self._in_flight -= 1
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+
+    async def run(self, fn: Callable, *args):
+        """Run ``fn(*args)`` in the pool and await its result"""
+        with self._lock:
+            if self._in_flight >= self.queue_depth:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server busy processing images, please retry",
+                    headers={"Retry-After": str(self._retry_after())}
+                )
+            self._in_flight += 1
+
+        started = time.monotonic()
+        try:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # A worker died; start a fresh pool for this and later jobs
+                self._discard(executor)
+                executor = self._get_executor()
+                future = executor.submit(fn, *args)
+        except BaseException:
+            self._release(started)
+            raise
+        # The slot is freed only when the job really finishes, even after a timeout
+        future.add_done_callback(lambda _: self._release(started))
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Image processing timed out")
+        except BrokenProcessPool:
+            # A worker died mid-job, which breaks the whole pool; later jobs get a fresh one
+            self._discard(executor)
+            raise HTTPException(
+                status_code=503,
+                detail="Image worker stopped unexpectedly, please retry",
+                headers={"Retry-After": "1"}
+            )
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "in_flight": self._in_flight,
+        }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+class MemoryBudget:
+    """Admit concurrent work only while its estimated memory fits a budget
+    
+    Jobs larger than the whole budget still run, but only alone. Waiting
+    longer than ``timeout`` seconds is answered with 503.
+    """
+    
+    def __init__(self, limit: int, timeout: float):
+        self.limit = limit
+        self.timeout = timeout
+        self.in_use = 0
+        self.peak = 0
+        self.waiting = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def _get_condition(self) -> asyncio.Condition:
+        # asyncio primitives belong to one loop; the app may be started on a new one
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._condition, self._loop = asyncio.Condition(), loop
+        return self._condition
+    
+    @asynccontextmanager
+    async def reserve(self, nbytes: int):
+        condition = self._get_condition()
+        async with condition:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(
+                    condition.wait_for(lambda: self.in_use == 0 or self.in_use + nbytes <= self.limit),
+                    timeout=self.timeout
+                )
+            except asyncio.TimeoutError:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server busy processing images, please retry",
+                    headers={"Retry-After": "1"}
+                )
+            finally:
+                self.waiting -= 1
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+        try:
+            yield
+        finally:
+            async with condition:
+                self.in_use -= nbytes
+                condition.notify_all()
+    
+    def stats(self) -> dict:
+        return {
+            "budget_bytes": self.limit,
+            "in_use_bytes": self.in_use,
+            "peak_bytes": self.peak,
+            "waiting": self.waiting,
+        }
+
+ingest_budget = MemoryBudget(INGEST_MEMORY_BUDGET, WORKER_JOB_TIMEOUT)
+
+worker_pool = WorkerPool(WORKER_POOL_KIND, WORKER_COUNT, WORKER_QUEUE_DEPTH, WORKER_JOB_TIMEOUT)
+
+class JobQueue:
+    """Background jobs persisted in SQLite, run by a fixed number of asyncio workers
+    
+    Submitting a job whose ``dedupe_key`` matches one still queued or
+    running returns that job instead. Handlers are coroutines taking the
+    job's params and returning a JSON-serializable result; they typically
+    await ``worker_pool.run``, and a busy pool (503) puts the job back in
+    the queue.
+    
+    Every web worker runs its own queue workers against the shared
+    database. A running job holds a lease its process renews every
+    ``lease_seconds / 3``; jobs whose lease lapsed (the server stopped, or
+    a web worker died) are queued again, up to ``max_attempts`` runs.
+    """
+    
+    FINISHED = ("done", "failed")
+    
+    def __init__(self, path: str, workers: int, retention_hours: float, max_attempts: int = 3,
+                 lease_seconds: float = 30.0):
+        self.workers = max(1, workers)
+        self.retention_hours = retention_hours
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        # Identifies this process's claims; a pid could be reused after a restart
+        self.owner = uuid.uuid4().hex
+        self._handlers: Dict[str, Callable] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._changed = asyncio.Condition()
+        self._conn = connect_sqlite(path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    dedupe_key TEXT,
+                    status TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at TEXT NOT NULL,
+                    started_at TEXT,
+                    finished_at TEXT,
+                    owner TEXT,
+                    lease_until REAL
+                )
+            """)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columns:
+                # Job databases from before leases
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, created_at)")
+            # At most one unfinished job per key
+            self._conn.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_key ON jobs (dedupe_key)
+                WHERE status IN ('queued', 'running')
+            """)
+    
+    def handler(self, kind: str):
+        """Register a coroutine ``handler(params) -> result`` for jobs of ``kind``"""
+        def register(fn: Callable):
+            self._handlers[kind] = fn
+            return fn
+        return register
+    
+    @staticmethod
+    def _as_dict(row) -> dict:
+        job_id, kind, status, result, error, attempts, created_at, started_at, finished_at = row
+        return {
+            "job_id": job_id,
+            "kind": kind,
+            "status": status,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "attempts": attempts,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+    
+    def _fetch(self, where: str, params) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, status, result, error, attempts, created_at, started_at, finished_at"
+                f" FROM jobs WHERE {where}", params
+            ).fetchone()
+        return self._as_dict(row) if row else None
+    
+    def get(self, job_id: str) -> Optional[dict]:
+        return self._fetch("id = ?", (job_id,))
+    
+    def submit(self, kind: str, params: dict, dedupe_key: Optional[str] = None) -> Tuple[dict, bool]:
+        """Queue a job; returns (job, created), where created is False for a duplicate"""
+        job_id = str(uuid.uuid4())
+        with self._lock, self._conn:
+            created = self._conn.execute(
+                "INSERT OR IGNORE INTO jobs (id, kind, dedupe_key, status, params, created_at)"
+                " VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, dedupe_key, json.dumps(params), datetime.now().isoformat())
+            ).rowcount == 1
+        if not created:
+            existing = self._fetch("dedupe_key = ? AND status IN ('queued', 'running')", (dedupe_key,))
+            if existing:
+                return existing, False
+            # Finished between the insert and the lookup; queue it after all
+            return self.submit(kind, params, dedupe_key)
+        self._wakeup.set()
+        return self.get(job_id), True
+    
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        """The job once finished, or as it stands after ``timeout`` seconds"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] in self.FINISHED or remaining <= 0:
+                return job
+            # Also re-read once a second, for jobs finished by another process
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=min(1.0, remaining))
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def watch(self, job_id: str, heartbeat: float = 15.0):
+        """Yield the job each time its state changes, until it finishes
+        
+        Yields None after ``heartbeat`` seconds without a change.
+        """
+        last, quiet_since = None, time.monotonic()
+        while True:
+            job = self.get(job_id)
+            if job != last:
+                yield job
+                if job is None or job["status"] in self.FINISHED:
+                    return
+                last, quiet_since = job, time.monotonic()
+            elif time.monotonic() - quiet_since >= heartbeat:
+                yield None
+                quiet_since = time.monotonic()
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+    
+    def _claim(self) -> Optional[tuple]:
+        with self._lock, self._conn:
+            return self._conn.execute("""
+                UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1,
+                    owner = ?, lease_until = ?
+                WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)
+                RETURNING id, kind, params
+            """, (datetime.now().isoformat(), self.owner, time.time() + self.lease_seconds)).fetchone()
+    
+    def _finish(self, job_id: str, status: str, result=None, error: Optional[str] = None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error,
+                 datetime.now().isoformat() if status in self.FINISHED else None, job_id)
+            )
+    
+    def _requeue(self, job_id: str):
+        """Return a job that couldn't start to the queue without counting the attempt"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, attempts = attempts - 1, owner = NULL"
+                " WHERE id = ?",
+                (job_id,)
+            )
+    
+    async def _worker(self):
+        while True:
+            claimed = self._claim()
+            if claimed is None:
+                self._wakeup.clear()
+                # Also look again once a second, for jobs queued by other processes
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job_id, kind, params = claimed
+            await self._notify()
+            
+            timer = RequestTimer()
+            token = _request_timer.set(timer)
+            retry_after = 0
+            try:
+                handler = self._handlers.get(kind)
+                if handler is None:
+                    raise ValueError(f"No handler for job kind {kind!r}")
+                await storage.wait_open()
+                result = await handler(json.loads(params))
+                self._finish(job_id, "done", result=result)
+            except HTTPException as e:
+                if e.status_code == 503:
+                    # Worker pool full: back in the queue, and let it drain first
+                    self._requeue(job_id)
+                    retry_after = int((e.headers or {}).get("Retry-After", "1"))
+                else:
+                    self._finish(job_id, "failed", error=str(e.detail))
+            except Exception as e:
+                self._finish(job_id, "failed", error=str(e))
+            finally:
+                _request_timer.reset(token)
+            
+            for stage, seconds in timer.stages.items():
+                METRICS["stage"].observe(seconds, route=f"job:{kind}", stage=stage)
+            await self._notify()
+            if retry_after:
+                await asyncio.sleep(retry_after)
+    
+    def recover(self) -> int:
+        """Requeue jobs whose lease lapsed and drop old finished ones; returns the number requeued"""
+        cutoff = datetime.fromtimestamp(time.time() - self.retention_hours * 3600).isoformat()
+        lapsed = "status = 'running' AND COALESCE(lease_until, 0) < ?"
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Interrupted too many times', finished_at = ?"
+                f" WHERE {lapsed} AND attempts >= ?",
+                (datetime.now().isoformat(), now, self.max_attempts)
+            )
+            requeued = self._conn.execute(
+                f"UPDATE jobs SET status = 'queued', owner = NULL WHERE {lapsed}", (now,)
+            ).rowcount
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,)
+            )
+        return requeued
+    
+    async def _keep_leases(self):
+        """Renew the leases of this process's running jobs and requeue lapsed ones from others"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "UPDATE jobs SET lease_until = ? WHERE status = 'running' AND owner = ?",
+                    (time.time() + self.lease_seconds, self.owner)
+                )
+            if self.recover():
+                self._wakeup.set()
+    
+    def start(self):
+        """Start the workers on the running event loop"""
+        if not self._tasks:
+            self.recover()
+            # asyncio primitives belong to one loop; the app may be started on a new one
+            self._wakeup, self._changed = asyncio.Event(), asyncio.Condition()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._keep_leases()))
+            self._wakeup.set()
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Interrupted jobs needn't wait for their leases to lapse before running again
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET lease_until = 0 WHERE status = 'running' AND owner = ?", (self.owner,))
+    
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {"workers": self.workers, **{status: counts.get(status, 0) for status in ("queued", "running", "done", "failed")}}
+
+job_queue = JobQueue(JOB_DB_PATH, STRIP_JOB_WORKERS, JOB_RETENTION_HOURS)
+
+def _directory_size(path: str) -> int:
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return total
+
+class RetentionManager:
+    """Deletes expired and over-budget sessions, and reclaims the space they leave
+
+    Sessions are ranked by when they were last written or read. Deleting a
+    session removes its records at once; its blobs are left for the next
+    compaction, which sweeps every blob no record names and rebuilds the
+    vector index once enough of it is deleted records. Each web worker runs
+    passes in the background, one at a time across processes.
+    """
+
+    def __init__(self, ttl_hours: float, budget_bytes: int, interval: float, compact_ratio: float,
+                 grace_seconds: float):
+        self.ttl_hours = ttl_hours
+        self.budget_bytes = budget_bytes
+        self.interval = interval
+        self.compact_ratio = compact_ratio
+        self.grace_seconds = grace_seconds
+        self._accessed: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        os.makedirs(BLOB_PATH, exist_ok=True)
+        self._pass_lock = ProcessLock(os.path.join(BLOB_PATH, ".retention.lock"))
+        self._task: Optional[asyncio.Task] = None
+        self.sessions_deleted = {"manual": 0, "expired": 0, "evicted": 0}
+        self.bytes_reclaimed = 0
+        self.last_pass: Optional[str] = None
+        self.last_compaction: Optional[dict] = None
+
+    def touch(self, session_id: Optional[str]):
+        """Note a read of the session; saved to the session index on the next pass"""
+        if session_id:
+            with self._lock:
+                self._accessed[session_id] = datetime.now().isoformat()
+
+    def _flush_touches(self):
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            session_index.touch(accessed)
+
+    def delete_session(self, session_id: str, reason: str = "manual") -> Optional[dict]:
+        """Delete a session's images and photostrips; None if there was no such session"""
+        store = storage.store
+        with timed_chroma("get"):
+            ids = store.get(where={"session_id": session_id}, include=["metadatas"])["ids"]
+        for start in range(0, len(ids), store.max_batch_size):
+            with timed_chroma("delete"):
+                store.delete(ids[start:start + store.max_batch_size])
+        hash_index.remove(ids)
+        summary = session_index.forget(session_id)
+        if summary is None and not ids:
+            return None
+        with self._lock:
+            self._accessed.pop(session_id, None)
+        session_index.add_to_counter("records_deleted", len(ids))
+        self.sessions_deleted[reason] += 1
+        return {"session_id": session_id, "records_deleted": len(ids), "bytes": (summary or {}).get("bytes") or 0}
+
+    def expire(self) -> List[str]:
+        """Delete sessions past their TTL"""
+        expired = session_index.expired(self.ttl_hours, datetime.now())
+        for session_id in expired:
+            self.delete_session(session_id, reason="expired")
+        return expired
+
+    def evict(self) -> List[str]:
+        """Delete least recently used sessions until storage is within budget"""
+        evicted: List[str] = []
+        if not self.budget_bytes:
+            return evicted
+        excess = session_index.total_bytes() - self.budget_bytes
+        while excess > 0:
+            candidates = session_index.least_recent(16)
+            if not candidates:
+                break
+            for session_id, size in candidates:
+                if excess <= 0:
+                    break
+                self.delete_session(session_id, reason="evicted")
+                evicted.append(session_id)
+                excess -= size or 0
+        return evicted
+
+    def _sweep_blobs(self) -> Tuple[int, int]:
+        """Remove blobs and derivatives no record refers to; returns (files, bytes)"""
+        live = set()
+        for chunk in storage.store.paged(500):
+            for metadata in chunk["metadatas"]:
+                live.update(metadata[key] for key in ("blob_ref", "original_blob_ref") if metadata.get(key))
+        removed, reclaimed = blob_store.sweep(live, self.grace_seconds)
+        derivatives, derivative_bytes = derivative_store.sweep(self.grace_seconds)
+        return removed + derivatives, reclaimed + derivative_bytes
+
+    @staticmethod
+    def _index_bytes() -> int:
+        """Disk used by the vector store and the hash index"""
+        size = _directory_size(DB_PATH if storage.store.backend == "chroma" else LOCAL_STORE_PATH)
+        if os.path.exists(hash_index.path):
+            size += os.path.getsize(hash_index.path)
+        return size
+
+    def compact(self, force: bool = False) -> Optional[dict]:
+        """Rebuild the index and sweep blobs if deletions call for it (or always with ``force``)
+
+        Only ``force``, used by the offline ``retention`` command, rebuilds a
+        store that can't be compacted while the server writes to it.
+        Returns a report of what was reclaimed, or None when there was nothing to do.
+        """
+        store = storage.store
+        rebuild = force or (store.compacts_online and store.tombstone_ratio() > self.compact_ratio)
+        deleted = session_index.take_counter("records_deleted")
+        if not (rebuild or deleted):
+            return None
+
+        started = time.perf_counter()
+        before = self._index_bytes()
+        try:
+            records = store.compact() if rebuild else 0
+            hashes = hash_index.compact()
+            files, blob_bytes = self._sweep_blobs()
+        except BaseException:
+            # Leave the sweep owed to the next pass
+            session_index.add_to_counter("records_deleted", deleted)
+            raise
+        after = self._index_bytes()
+        duration = time.perf_counter() - started
+
+        report = {
+            "records_reclaimed": records,
+            "hash_entries_reclaimed": hashes,
+            "index_rebuilt": bool(records),
+            "blobs_removed": files,
+            "bytes_reclaimed": blob_bytes + max(0, before - after),
+            "duration_seconds": round(duration, 3),
+            "finished_at": datetime.now().isoformat(),
+        }
+        METRICS["compaction"].observe(duration)
+        self.bytes_reclaimed += report["bytes_reclaimed"]
+        self.last_compaction = report
+        logger.info("Compaction reclaimed %d bytes (%d files, %d index records) in %.2fs",
+                    report['bytes_reclaimed'], files, records, duration)
+        return report
+
+    def run_once(self, force_compact: bool = False) -> dict:
+        """One retention pass: save reads, expire, evict, then compact"""
+        self._flush_touches()
+        with self._pass_lock.hold():
+            storage.store.sync()
+            expired = self.expire()
+            evicted = self.evict()
+            compaction = self.compact(force=force_compact)
+        self.last_pass = datetime.now().isoformat()
+        return {"expired": expired, "evicted": evicted, "compaction": compaction}
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception:
+                logger.exception("Retention pass failed")
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._flush_touches()
+
+    def stats(self) -> dict:
+        return {
+            "session_ttl_hours": self.ttl_hours,
+            "budget_bytes": self.budget_bytes,
+            "stored_bytes": session_index.total_bytes(),
+            "sessions_deleted": dict(self.sessions_deleted),
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "last_pass": self.last_pass,
+            "last_compaction": self.last_compaction,
+        }
+
+retention = RetentionManager(SESSION_TTL_HOURS, STORAGE_BUDGET_BYTES, RETENTION_INTERVAL, COMPACT_TOMBSTONE_RATIO,
+                             ORPHAN_GRACE_SECONDS)
+
+@app.on_event("startup")
+def warm_storage():
+    if WARM_STORAGE:
+        storage.warm()
+
+@app.on_event("startup")
+async def start_job_queue():
+    job_queue.start()
+
+@app.on_event("shutdown")
+async def stop_job_queue():
+    await job_queue.stop()
+
+@app.on_event("startup")
+async def start_retention():
+    retention.start()
+
+@app.on_event("shutdown")
+async def stop_retention():
+    await retention.stop()
+
+@app.on_event("shutdown")
+def shutdown_worker_pool():
+    worker_pool.shutdown()
+
+# Worker jobs: module-level functions so they can be pickled into a process pool
+
+def process_upload_job(source_path: str, filter_list: List[str], output_format: str = "png") -> dict:
+    """Decode, filter and encode a spooled upload
+
+    The encoded image is streamed into a blob store staging file rather
+    than returned, so large results never cross the process boundary; the
+    caller commits or discards it. Returns the resized feature input rather
+    than features so callers can extract features for many images in one
+    vectorized pass.
+    """
+    timings = {}
+    started = time.perf_counter()
+    with open(source_path, "rb") as source:
+        try:
+            image, original_size = ingest_policy.open(source)
+        except UnidentifiedImageError:
+            raise ValueError("Unsupported or corrupt image file")
+        image.load()
+    timings["decode"] = time.perf_counter() - started
     
-    @staticmethod
-    def apply_black_white_filter(image: Image.Image) -> Image.Image:
-        """Apply black and white filter"""
-        return image.convert('L').convert('RGBA')
+    started = time.perf_counter()
+    image, filters_applied = image_processor.apply_filters(image, filter_list)
+    timings["filter"] = time.perf_counter() - started
     
-    @staticmethod
-    def apply_blur_filter(image: Image.Image) -> Image.Image:
-        """Apply blur filter"""
-        return image.filter(ImageFilter.GaussianBlur(radius=2))
+    started = time.perf_counter()
+    feature_input = vector_db.prepare_feature_input(image)
+    timings["feature_input"] = time.perf_counter() - started
     
-    @staticmethod
-    def apply_enhance_filter(image: Image.Image) -> Image.Image:
-        """Enhance colors and contrast"""
-        enhancer = ImageEnhance.Color(image)
-        image = enhancer.enhance(1.2)  # Boost color
-        
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(1.1)  # Boost contrast
-        
-        return image
+    started = time.perf_counter()
+    writer = blob_store.writer()
+    try:
+        encoding = image_encoder.encode_to(image, output_format, writer)
+        blob_ref = writer.close()
+    except BaseException:
+        writer.close()
+        blob_store.discard(writer.staged_path)
+        raise
+    timings["encode"] = time.perf_counter() - started
     
-    @staticmethod
-    def apply_retro_filter(image: Image.Image) -> Image.Image:
-        """Apply retro filter with vignette"""
-        # Convert to RGB if not already
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Reduce saturation slightly
-        enhancer = ImageEnhance.Color(image)
-        image = enhancer.enhance(0.8)
-        
-        # Add slight warmth
-        pixels = np.array(image)
-        pixels[:,:,0] = np.clip(pixels[:,:,0] * 1.1, 0, 255)  # Red
-        pixels[:,:,2] = np.clip(pixels[:,:,2] * 0.9, 0, 255)  # Blue
-        
-        return Image.fromarray(pixels.astype(np.uint8), 'RGB')
+    if EAGER_DERIVATIVES:
+        # The decoded image is at hand, so downscaling now is cheaper than later
+        for size in DERIVATIVE_SIZES:
+            derivative_store.render(image, blob_ref, size)
+    
+    return {
+        "staged_path": writer.staged_path,
+        "blob_ref": blob_ref,
+        "blob_size": writer.size,
+        "encoding": encoding,
+        "feature_input": feature_input,
+        "phash": perceptual_hash(feature_input),
+        "original_size": original_size,
+        "stored_size": image.size,
+        "filters_applied": filters_applied,
+        "timings": timings,
+    }
 
-class PhotoStripGenerator:
-    """Generate formatted photo strips"""
+def render_photostrip_job(sources: List[Tuple[str, str]], session_id: str, layout_name: str = "classic",
+                          output_format: str = "png") -> dict:
+    """Render a photostrip from (image_id, blob_ref) pairs and encode it"""
+    timings = {}
+    started = time.perf_counter()
+    generator = get_strip_generator(layout_name)
+    slots = [
+        generator.thumbnail(image_id, lambda ref=blob_ref: Image.open(blob_store.path(ref)))
+        for image_id, blob_ref in sources
+    ]
+    timings["thumbnails"] = time.perf_counter() - started
     
-    def __init__(self):
-        self.strip_width = 400
-        self.strip_height = 1200
-        self.photo_width = 350
-        self.photo_height = 250
-        self.margin = 25
-        self.photos_per_strip = 4
+    started = time.perf_counter()
+    photostrip = generator.create_photostrip(slots, session_id)
+    timings["compose"] = time.perf_counter() - started
     
-    def create_photostrip(self, images: List[Image.Image], session_id: str) -> Image.Image:
-        """Create a formatted photostrip from multiple images"""
-        # Create strip canvas
-        strip = Image.new('RGB', (self.strip_width, self.strip_height), 'white')
-        draw = ImageDraw.Draw(strip)
-        
-        # Add header
-        try:
-            # Try to use a nice font, fall back to default if not available
-            font = ImageFont.truetype("arial.ttf", 24)
-            small_font = ImageFont.truetype("arial.ttf", 16)
-        except:
-            font = ImageFont.load_default()
-            small_font = ImageFont.load_default()
-        
-        # Header text
-        header_text = "PHOTOBOOTH"
-        bbox = draw.textbbox((0, 0), header_text, font=font)
-        text_width = bbox[2] - bbox[0]
-        draw.text(
-            ((self.strip_width - text_width) // 2, 10),
-            header_text,
-            fill='black',
-            font=font
-        )
-        
-        # Date
-        date_text = datetime.now().strftime("%Y-%m-%d %H:%M")
-        bbox = draw.textbbox((0, 0), date_text, font=small_font)
-        text_width = bbox[2] - bbox[0]
-        draw.text(
-            ((self.strip_width - text_width) // 2, 40),
-            date_text,
-            fill='gray',
-            font=small_font
-        )
-        
-        # Add photos
-        y_position = 80
-        for i, img in enumerate(images[:self.photos_per_strip]):
-            # Resize image to fit
-            img_resized = img.resize((self.photo_width, self.photo_height), Image.Resampling.LANCZOS)
-            
-            # Calculate position to center the image
-            x_position = (self.strip_width - self.photo_width) // 2
-            
-            # Paste image
-            strip.paste(img_resized, (x_position, y_position))
-            
-            # Add border
-            draw.rectangle([
-                x_position - 2, y_position - 2,
-                x_position + self.photo_width + 2, y_position + self.photo_height + 2
-            ], outline='black', width=2)
-            
-            y_position += self.photo_height + self.margin
-        
-        # Add footer
-        footer_text = f"Session: {session_id[:8]}"
-        bbox = draw.textbbox((0, 0), footer_text, font=small_font)
-        text_width = bbox[2] - bbox[0]
-        draw.text(
-            ((self.strip_width - text_width) // 2, self.strip_height - 30),
-            footer_text,
-            fill='gray',
-            font=small_font
-        )
-        
-        return strip
+    started = time.perf_counter()
+    encoded, encoding = image_encoder.encode(photostrip, output_format)
+    timings["encode"] = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    features = vector_db.extract_image_features(photostrip)
+    timings["features"] = time.perf_counter() - started
+    
+    return {
+        "encoded": encoded,
+        "encoding": encoding,
+        "features": features,
+        "size": photostrip.size,
+        "timings": timings,
+    }
 
-class VectorImageDatabase:
-    """Handle vector database operations for images"""
+def record_job_timings(result: dict, started: float):
+    """Report a worker job's own stage timings, and the rest of its wall time as queueing"""
+    timings = result.get("timings", {})
+    record_stages(timings)
+    record_stages({"queue": max(0.0, time.perf_counter() - started - sum(timings.values()))})
+
+def render_preview_job(frame: bytes, filter_list: List[str], max_edge: int, quality: int) -> dict:
+    """Filter one live preview frame at preview resolution and encode it as JPEG"""
+    timings = {}
+    started = time.perf_counter()
+    try:
+        image = Image.open(io.BytesIO(frame))
+        # JPEG frames decode straight to about the preview size
+        image.draft('RGB', (max_edge, max_edge))
+        image = image.convert('RGB')
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        raise ValueError("Unsupported or corrupt image frame")
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.Resampling.BILINEAR)
+    timings["decode"] = time.perf_counter() - started
     
-    @staticmethod
-    def extract_image_features(image: Image.Image) -> List[float]:
-        """Extract features from image for vector embedding"""
-        # Convert to RGB and resize for consistent feature extraction
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Resize to standard size
-        image = image.resize((224, 224))
-        
-        # Convert to numpy array and flatten
-        pixels = np.array(image).flatten()
-        
-        # Normalize pixel values
-        pixels = pixels / 255.0
-        
-        # Reduce dimensionality by taking every nth pixel to avoid too large vectors
-        step = len(pixels) // 512  # Reduce to ~512 dimensions
-        features = pixels[::step][:512].tolist()
-        
-        return features
+    started = time.perf_counter()
+    image, _ = image_processor.apply_filters(image, filter_list, tile_pixels=0)
+    timings["filter"] = time.perf_counter() - started
     
-    @staticmethod
-    def generate_image_description(metadata: PhotoMetadata) -> str:
-        """Generate description for text embedding"""
-        filters_str = ", ".join(metadata.filters_applied) if metadata.filters_applied else "none"
-        return f"Image {metadata.filename} with filters: {filters_str}, size: {metadata.dimensions}, taken at {metadata.timestamp}"
+    started = time.perf_counter()
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, format="JPEG", quality=quality)
+    timings["encode"] = time.perf_counter() - started
+    
+    return {"encoded": buffer.getvalue(), "size": image.size, "timings": timings}
 
-# Initialize processors
-image_processor = ImageProcessor()
-strip_generator = PhotoStripGenerator()
-vector_db = VectorImageDatabase()
+def render_derivative_job(ref: str, size: str) -> str:
+    """Generate a derivative of a stored blob; returns its path"""
+    return derivative_store.ensure(ref, size)
 
 # NEW: Main route to serve the HTML page
 @app.get("/", response_class=HTMLResponse)
@@ -249,16 +3484,186 @@ async def read_root(request: Request):
     """Serve the main photobooth application page"""
     return templates.TemplateResponse("index.html", {"request": request})
 
+# Hash matches checked against full embeddings per upload
+DEDUP_MAX_CANDIDATES = 16
+
+def output_signature(metadata: dict) -> tuple:
+    """What decides a stored image's bytes besides its source: filters and encoding"""
+    return (
+        metadata.get('filters_applied') or '',
+        metadata.get('format', 'png'),
+        metadata.get('quality'),
+        metadata.get('encoding_profile'),
+    )
+
+def _find_duplicate(phash: int, features: np.ndarray, signature: tuple,
+                    pending: Optional[Dict[str, tuple]] = None) -> Optional[dict]:
+    """Metadata of a stored near-duplicate of an image, if any
+    
+    The perceptual hash only sees brightness structure, so a hash match
+    must also agree on the full embedding (which includes colour), and on
+    the ``output_signature``: the same photo filtered or encoded
+    differently is stored as its own image. ``pending`` maps ids to
+    (phash, metadata, features) of records built but not yet written;
+    they are only added to the hash index once the store write succeeds.
+    """
+    if DEDUP_MODE == "off":
+        return None
+    candidates = sorted(
+        (BKTree.distance(phash, entry[0]), image_id) for image_id, entry in (pending or {}).items()
+    )
+    candidates = [candidate for candidate in candidates if candidate[0] <= DEDUP_THRESHOLD]
+    candidates = sorted(candidates + hash_index.matches(phash, DEDUP_THRESHOLD))[:DEDUP_MAX_CANDIDATES]
+    if not candidates:
+        return None
+    
+    found: Dict[str, tuple] = {}
+    stored_ids = [image_id for _, image_id in candidates if not (pending and image_id in pending)]
+    if stored_ids:
+        with timed_chroma("get"):
+            result = storage.store.get(ids=stored_ids, include=["metadatas", "embeddings"])
+        found = {
+            image_id: (metadata, np.asarray(embedding))
+            for image_id, metadata, embedding in zip(result['ids'], result['metadatas'], result['embeddings'])
+        }
+    for _, image_id in candidates:
+        if pending and image_id in pending:
+            _, metadata, match_features = pending[image_id]
+        elif image_id in found:
+            metadata, match_features = found[image_id]
+        else:
+            continue
+        if output_signature(metadata) != signature:
+            continue
+        if len(match_features) == len(features) and float(features @ match_features) >= DEDUP_MIN_SIMILARITY:
+            return metadata
+    return None
+
+def upload_signature(result: dict) -> tuple:
+    """``output_signature`` of a processed upload, before it has a record"""
+    filters_applied = result["filters_applied"]
+    return output_signature({
+        'filters_applied': ', '.join(filters_applied) if filters_applied else '',
+        **result["encoding"],
+    })
+
+def _build_image_record(image_id: str, filename: str, session_id: str, file_size: int, result: dict,
+                        duplicate: Optional[dict] = None):
+    """Store a processed upload's bytes and build its ChromaDB document and metadata
+    
+    A near-duplicate reuses the stored bytes of ``duplicate`` instead.
+    """
+    original_size = result["original_size"]
+    filters_applied = result["filters_applied"]
+    
+    # Create metadata
+    metadata = PhotoMetadata(
+        id=image_id,
+        filename=filename,
+        timestamp=datetime.now(),
+        filters_applied=filters_applied,
+        dimensions=original_size,
+        file_size=file_size
+    )
+    image_description = vector_db.generate_image_description(metadata)
+    
+    # Prepare metadata for ChromaDB (simple primitive types only)
+    metadata_dict = asdict(metadata)
+    metadata_dict['timestamp'] = metadata.timestamp.isoformat()
+    metadata_dict['session_id'] = session_id
+    metadata_dict['type'] = 'single_image'
+    metadata_dict['phash'] = f"{result['phash']:016x}"
+    stored_size = result.get("stored_size", original_size)
+    metadata_dict['stored_dimensions'] = f"{stored_size[0]}x{stored_size[1]}"
+    
+    if duplicate and duplicate.get('blob_ref'):
+        # Link to the bytes already stored for the near-identical image
+        metadata_dict['duplicate_of'] = duplicate.get('duplicate_of') or duplicate['id']
+        metadata_dict['blob_ref'] = duplicate['blob_ref']
+        blob_store.touch(duplicate['blob_ref'])
+        metadata_dict['blob_size'] = duplicate.get('blob_size', 0)
+        for key in ('content_type', 'format', 'quality', 'encoding_profile'):
+            if key in duplicate:
+                metadata_dict[key] = duplicate[key]
+    else:
+        # Move the encoded image the worker staged into the blob store
+        metadata_dict['blob_ref'] = blob_store.commit(result["staged_path"], result["blob_ref"])
+        metadata_dict['blob_size'] = result["blob_size"]
+        metadata_dict.update(result["encoding"])
+    metadata_dict['descriptor'] = descriptor_pipeline.version
+    metadata_dict['filters_applied'] = ', '.join(filters_applied) if filters_applied else ''
+    metadata_dict['dimensions'] = f"{original_size[0]}x{original_size[1]}"
+    
+    return image_description, metadata_dict
+
+# Upload bodies are copied to disk in chunks of this size; a multiple of 3 so
+# each chunk base64-encodes on its own
+UPLOAD_CHUNK_SIZE = 3 * 64 * 1024
+
+async def spool_upload(file: UploadFile) -> Tuple[str, str, int]:
+    """Copy an upload into a blob store staging file in chunks
+    
+    Returns (staged_path, blob_ref, size). Workers decode straight from the
+    staged file, and preserved originals are committed without a copy.
+    """
+    writer = blob_store.writer()
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.write(chunk)
+        return writer.staged_path, writer.close(), writer.size
+    except BaseException:
+        writer.close()
+        blob_store.discard(writer.staged_path)
+        raise
+
+def inline_image_response(payload: dict, key: str, path: str, content_type: str) -> StreamingResponse:
+    """JSON response whose ``key`` field is a data URI streamed from ``path``
+    
+    Encodes the file to base64 chunk by chunk instead of building the data
+    URI and the serialized response in memory.
+    """
+    placeholder = f"inline-{uuid.uuid4().hex}"
+    document = json.dumps({**payload, key: placeholder}, ensure_ascii=False, separators=(",", ":"))
+    head, tail = document.split(json.dumps(placeholder), 1)
+    
+    def body():
+        yield f'{head}"data:{content_type};base64,'.encode()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield base64.b64encode(chunk)
+        yield f'"{tail}'.encode()
+    
+    return StreamingResponse(body(), media_type="application/json")
+
 @app.post("/upload-image/")
 async def upload_image(
+    request: Request,
     file: UploadFile = File(...),
     filters: Optional[str] = Form(None),
-    session_id: Optional[str] = Form(None)
+    session_id: Optional[str] = Form(None),
+    inline_image: bool = Form(True),
+    output_format: Optional[str] = Form(None)
 ):
-    """Upload and process a single image with optional filters"""
+    """Upload and process a single image with optional filters
+    
+    The stored format comes from ``output_format`` (png, jpeg, webp) or
+    the Accept header. Set ``inline_image`` to false to get only URLs
+    back instead of the full image as a data URI.
+    """
+    require_compatible_store()
     
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
+    try:
+        fmt = image_encoder.negotiate(output_format, request.headers.get("accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     try:
         # Generate unique ID
@@ -266,264 +3671,921 @@ async def upload_image(
         if not session_id:
             session_id = str(uuid.uuid4())
         
-        # Read and process image
-        image_bytes = await file.read()
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Store original image info
-        original_size = image.size
-        file_size = len(image_bytes)
-        
-        # Apply filters if specified
-        filters_applied = []
-        if filters:
-            filter_list = [f.strip() for f in filters.split(',')]
-            for filter_name in filter_list:
-                if filter_name == 'vintage':
-                    image = image_processor.apply_vintage_filter(image)
-                    filters_applied.append('vintage')
-                elif filter_name == 'bw':
-                    image = image_processor.apply_black_white_filter(image)
-                    filters_applied.append('black_white')
-                elif filter_name == 'blur':
-                    image = image_processor.apply_blur_filter(image)
-                    filters_applied.append('blur')
-                elif filter_name == 'enhance':
-                    image = image_processor.apply_enhance_filter(image)
-                    filters_applied.append('enhance')
-                elif filter_name == 'retro':
-                    image = image_processor.apply_retro_filter(image)
-                    filters_applied.append('retro')
-        
-        # Create metadata
-        metadata = PhotoMetadata(
-            id=image_id,
-            filename=file.filename,
-            timestamp=datetime.now(),
-            filters_applied=filters_applied,
-            dimensions=original_size,
-            file_size=file_size
-        )
-        
-        # Extract features for vector database
-        image_features = vector_db.extract_image_features(image)
-        image_description = vector_db.generate_image_description(metadata)
-        
-        # Convert processed image to base64 for storage and return
-        img_buffer = io.BytesIO()
-        image.save(img_buffer, format='PNG')
-        img_base64 = base64.b64encode(img_buffer.getvalue()).decode()
-        
-        # Prepare metadata for ChromaDB (simple primitive types only)
-        metadata_dict = asdict(metadata)
-        metadata_dict['timestamp'] = metadata.timestamp.isoformat()
-        metadata_dict['session_id'] = session_id
-        metadata_dict['image_data'] = img_base64
-        metadata_dict['filters_applied'] = ', '.join(filters_applied) if filters_applied else ''
-        metadata_dict['dimensions'] = f"{original_size[0]}x{original_size[1]}"
-        
-        # Store in vector database
-        collection.add(
-            embeddings=[image_features],
-            documents=[image_description],
-            metadatas=[metadata_dict],
-            ids=[image_id]
-        )
+        # Spool the upload to disk and process it in the worker pool
+        filter_list = [f.strip() for f in filters.split(',')] if filters else []
+        with timed_stage("spool"):
+            upload_path, upload_ref, file_size = await spool_upload(file)
+        result = None
+        try:
+            started = time.perf_counter()
+            async with ingest_budget.reserve(ingest_policy.estimate_memory(upload_path)):
+                result = await worker_pool.run(process_upload_job, upload_path, filter_list, fmt)
+            record_job_timings(result, started)
+            
+            with timed_stage("features"):
+                image_features = vector_db.features_from_arrays(result["feature_input"][np.newaxis])[0]
+            
+            # Check for a near-identical stored image before writing anything
+            with timed_stage("dedup"):
+                duplicate = await asyncio.to_thread(
+                    _find_duplicate, result["phash"], image_features, upload_signature(result)
+                )
+            if duplicate and DEDUP_MODE == "reject":
+                raise HTTPException(status_code=409, detail=f"Duplicate of image {duplicate['id']}")
+            
+            with timed_stage("store"):
+                image_description, metadata_dict = _build_image_record(
+                    image_id, file.filename, session_id, file_size, result, duplicate
+                )
+                if ingest_policy.preserve_originals:
+                    metadata_dict['original_blob_ref'] = blob_store.commit(upload_path, upload_ref)
+                    metadata_dict['original_content_type'] = file.content_type
+            
+            # Store in vector database
+            with timed_chroma("add"):
+                await asyncio.to_thread(
+                    storage.store.add,
+                    embeddings=[image_features.tolist()],
+                    documents=[image_description],
+                    metadatas=[metadata_dict],
+                    ids=[image_id]
+                )
+            with timed_stage("index"):
+                session_index.record([metadata_dict])
+                hash_index.add(result["phash"], image_id, session_id)
+        finally:
+            # Whatever wasn't committed above is no longer needed
+            blob_store.discard(upload_path)
+            if result is not None:
+                blob_store.discard(result["staged_path"])
         
-        return JSONResponse({
+        original_size = result["original_size"]
+        METRICS["bytes_in"].observe(file_size)
+        METRICS["megapixels"].observe(original_size[0] * original_size[1] / 1e6, kind="upload")
+        if not duplicate:
+            METRICS["bytes_out"].observe(result["blob_size"], kind="image")
+        payload = {
             "success": True,
             "image_id": image_id,
             "session_id": session_id,
-            "filters_applied": filters_applied,
-            "processed_image": f"data:image/png;base64,{img_base64}",
+            "filters_applied": result["filters_applied"],
+            "processed_image": None,
+            **image_urls(image_id),
+            "duplicate_of": metadata_dict.get('duplicate_of'),
             "metadata": {
                 "dimensions": original_size,
                 "file_size": file_size,
-                "timestamp": metadata.timestamp.isoformat()
+                "timestamp": metadata_dict['timestamp']
             }
-        })
+        }
+        if inline_image:
+            return inline_image_response(
+                payload, "processed_image", blob_store.path(metadata_dict['blob_ref']),
+                metadata_dict.get('content_type', 'image/png')
+            )
+        return JSONResponse(payload)
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
+@app.post("/upload-images/")
+async def upload_images(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    filters: Optional[str] = Form(None),
+    session_id: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None)
+):
+    """Upload and process several images with shared filters in one request
+    
+    Files are processed concurrently, features are extracted for the whole
+    batch at once and all records are written with a single store add.
+    Each file gets its own status so one bad file doesn't fail the batch.
+    """
+    require_compatible_store()
+    
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_FILES} files per batch")
+    try:
+        fmt = image_encoder.negotiate(output_format, request.headers.get("accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if not session_id:
+        session_id = str(uuid.uuid4())
+    filter_list = [f.strip() for f in filters.split(',')] if filters else []
+    
+    # Keep a single batch from monopolising the worker queue
+    batch_slots = asyncio.Semaphore(worker_pool.workers)
+    
+    async def process(file: UploadFile):
+        if not (file.content_type or "").startswith("image/"):
+            raise ValueError("File must be an image")
+        with timed_stage("spool"):
+            upload_path, upload_ref, file_size = await spool_upload(file)
+        staged.append(upload_path)
+        started = time.perf_counter()
+        async with batch_slots, ingest_budget.reserve(ingest_policy.estimate_memory(upload_path)):
+            result = await worker_pool.run(process_upload_job, upload_path, filter_list, fmt)
+        staged.append(result["staged_path"])
+        record_job_timings(result, started)
+        METRICS["bytes_in"].observe(file_size)
+        METRICS["megapixels"].observe(result["original_size"][0] * result["original_size"][1] / 1e6, kind="upload")
+        return (upload_path, upload_ref, file_size), result
+    
+    # Staging files to clean up once the batch is stored
+    staged: List[str] = []
+    outcomes = await asyncio.gather(*(process(f) for f in files), return_exceptions=True)
+    
+    try:
+        # One vectorized feature pass for every file that processed
+        succeeded = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+        if succeeded:
+            with timed_stage("features"):
+                batch_features = iter(vector_db.features_from_arrays(
+                    np.stack([result["feature_input"] for _, result in succeeded])
+                ))
+        
+        statuses, processed = [], []
+        pending: Dict[str, tuple] = {}
+        for file, outcome in zip(files, outcomes):
+            if isinstance(outcome, BaseException):
+                detail = outcome.detail if isinstance(outcome, HTTPException) else str(outcome)
+                statuses.append({"filename": file.filename, "success": False, "error": detail})
+                continue
+            (upload_path, upload_ref, file_size), result = outcome
+            features = next(batch_features)
+            
+            # Earlier files in this batch are compared too, so bursts are caught
+            duplicate = await asyncio.to_thread(
+                _find_duplicate, result["phash"], features, upload_signature(result), pending
+            )
+            if duplicate and DEDUP_MODE == "reject":
+                statuses.append({
+                    "filename": file.filename,
+                    "success": False,
+                    "error": f"Duplicate of image {duplicate['id']}"
+                })
+                continue
+            
+            image_id = str(uuid.uuid4())
+            description, metadata_dict = _build_image_record(
+                image_id, file.filename, session_id, file_size, result, duplicate
+            )
+            if ingest_policy.preserve_originals:
+                metadata_dict['original_blob_ref'] = blob_store.commit(upload_path, upload_ref)
+                metadata_dict['original_content_type'] = file.content_type
+            pending[image_id] = (result["phash"], metadata_dict, features)
+            processed.append((image_id, description, metadata_dict, features))
+            statuses.append({
+                "filename": file.filename,
+                "success": True,
+                "image_id": image_id,
+                **image_urls(image_id),
+                "duplicate_of": metadata_dict.get('duplicate_of'),
+                "filters_applied": result["filters_applied"],
+                "dimensions": result["original_size"],
+            })
+        
+        if processed:
+            # One insert for the whole batch
+            metadatas = [metadata_dict for _, _, metadata_dict, _ in processed]
+            with timed_chroma("add"):
+                await asyncio.to_thread(
+                    storage.store.add,
+                    embeddings=np.stack([features for _, _, _, features in processed]).tolist(),
+                    documents=[description for _, description, _, _ in processed],
+                    metadatas=metadatas,
+                    ids=[image_id for image_id, _, _, _ in processed]
+                )
+            session_index.record(metadatas)
+            # Only records that were written may be matched as duplicates later
+            for image_id, _, _, _ in processed:
+                hash_index.add(pending[image_id][0], image_id, session_id)
+        
+        return JSONResponse({
+            "success": bool(processed),
+            "session_id": session_id,
+            "uploaded": len(processed),
+            "failed": len(files) - len(processed),
+            "results": statuses
+        })
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing images: {str(e)}")
+    finally:
+        for path in staged:
+            blob_store.discard(path)
+
+def _find_photostrip(strip_key: str) -> Optional[dict]:
+    """Metadata of an already rendered strip with this key, if any"""
+    strip_id = strip_results.get(strip_key)
+    with timed_chroma("get"):
+        if strip_id:
+            result = storage.store.get(ids=[strip_id], include=["metadatas"])
+        else:
+            result = storage.store.get(where={"strip_key": strip_key}, include=["metadatas"], limit=1)
+    
+    if not result['metadatas']:
+        strip_results.pop(strip_key)
+        return None
+    strip_results.put(strip_key, result['ids'][0])
+    return result['metadatas'][0]
+
+@job_queue.handler("photostrip")
+async def photostrip_job(params: dict) -> dict:
+    """Render and store a photostrip, or return the strip already rendered from the same images"""
+    session_id, strip_key = params["session_id"], params["strip_key"]
+    existing = await asyncio.to_thread(_find_photostrip, strip_key)
+    if existing:
+        return {
+            "photostrip_id": existing['id'],
+            "session_id": session_id,
+            "image_count": existing.get('image_count', params["image_count"]),
+            "content_type": existing.get('content_type', 'image/png'),
+            "photostrip_url": f"/get-image/{existing['id']}",
+            "cached": True
+        }
+    
+    # Render the photostrip in the worker pool and store it
+    sources = [tuple(source) for source in params["sources"]]
+    started = time.perf_counter()
+    result = await worker_pool.run(render_photostrip_job, sources, session_id, params["layout"], params["format"])
+    record_job_timings(result, started)
+    strip_bytes = result["encoded"]
+    with timed_stage("store"):
+        strip_ref = blob_store.put(strip_bytes)
+    METRICS["bytes_out"].observe(len(strip_bytes), kind="photostrip")
+    METRICS["megapixels"].observe(result["size"][0] * result["size"][1] / 1e6, kind="photostrip")
+    
+    # Store photostrip in vector database
+    strip_id = str(uuid.uuid4())
+    strip_metadata = {
+        'id': strip_id,
+        'type': 'photostrip',
+        'session_id': session_id,
+        'image_count': params["image_count"],
+        'layout': params["layout"],
+        'strip_key': strip_key,
+        'descriptor': descriptor_pipeline.version,
+        'timestamp': datetime.now().isoformat(),
+        'blob_ref': strip_ref,
+        'blob_size': len(strip_bytes),
+        **result["encoding"]
+    }
+    with timed_chroma("add"):
+        await asyncio.to_thread(
+            storage.store.add,
+            embeddings=[result["features"]],
+            documents=[f"Photostrip for session {session_id} containing {params['image_count']} images"],
+            metadatas=[strip_metadata],
+            ids=[strip_id]
+        )
+    session_index.record([strip_metadata])
+    strip_results.put(strip_key, strip_id)
+    
+    return {
+        "photostrip_id": strip_id,
+        "session_id": session_id,
+        "image_count": params["image_count"],
+        "content_type": strip_metadata['content_type'],
+        "photostrip_url": f"/get-image/{strip_id}",
+        "cached": False
+    }
+
+def job_response(job: dict, status_code: int = 200, **extra) -> JSONResponse:
+    """A job's state as returned by the job endpoints"""
+    return JSONResponse(
+        {"success": job["status"] != "failed", **job, "status_url": f"/jobs/{job['job_id']}", **extra},
+        status_code=status_code
+    )
+
 @app.post("/create-photostrip/")
-async def create_photostrip(session_id: str = Form(...)):
-    """Create a photostrip from images in a session"""
+async def create_photostrip(
+    request: Request,
+    session_id: str = Form(...),
+    layout: str = Form("classic"),
+    output_format: Optional[str] = Form(None),
+    wait: bool = Form(False)
+):
+    """Queue a photostrip of a session's images; answers 202 with a job id
+    
+    Repeating the request while the job is queued or running returns the
+    same job, and once rendered the existing strip is reused instead of
+    storing a duplicate. With ``wait`` the response is held until the
+    strip is ready and includes it as a data URI, as before jobs.
+    """
+    require_compatible_store()
+    
+    if layout not in STRIP_LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"Unknown layout: {layout}")
+    try:
+        fmt = image_encoder.negotiate(output_format, request.headers.get("accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     try:
         # Query vector database for images from this session
-        results = collection.get(
-            where={"session_id": session_id},
-            include=["metadatas"]
-        )
+        with timed_chroma("get"):
+            results = await asyncio.to_thread(
+                storage.store.get,
+                where={"session_id": session_id},
+                include=["metadatas"]
+            )
         
         if not results['metadatas']:
             raise HTTPException(status_code=404, detail="No images found for this session")
+        retention.touch(session_id)
         
-        # Load images from stored base64 data
-        images = []
-        for metadata in results['metadatas']:
-            if 'image_data' in metadata:
-                img_data = base64.b64decode(metadata['image_data'])
-                image = Image.open(io.BytesIO(img_data))
-                images.append(image)
+        # Single images in capture order; earlier strips are not strip material
+        session_images = sorted(
+            (m for m in results['metadatas'] if m.get('type') != 'photostrip'),
+            key=lambda m: m.get('timestamp') or ''
+        )
+        sources = []
+        for metadata in session_images:
+            if metadata.get('blob_ref'):
+                sources.append((metadata['id'], metadata['blob_ref']))
+            elif metadata.get('image_data'):
+                # Record from before the blob store; move its bytes over
+                sources.append((metadata['id'], blob_store.put(load_image_bytes(metadata))))
         
-        if not images:
+        if not sources:
             raise HTTPException(status_code=404, detail="No valid images found")
         
-        # Create photostrip
-        photostrip = strip_generator.create_photostrip(images, session_id)
-        
-        # Convert to base64
-        strip_buffer = io.BytesIO()
-        photostrip.save(strip_buffer, format='PNG')
-        strip_base64 = base64.b64encode(strip_buffer.getvalue()).decode()
-        
-        # Store photostrip in vector database
-        strip_id = str(uuid.uuid4())
-        strip_features = vector_db.extract_image_features(photostrip)
-        
-        collection.add(
-            embeddings=[strip_features],
-            documents=[f"Photostrip for session {session_id} containing {len(images)} images"],
-            metadatas=[{
-                'id': strip_id,
-                'type': 'photostrip',
-                'session_id': session_id,
-                'image_count': len(images),
-                'timestamp': datetime.now().isoformat(),
-                'image_data': strip_base64
-            }],
-            ids=[strip_id]
-        )
+        image_count = len(sources)
+        sources = sources[:STRIP_LAYOUTS[layout].photos_per_strip]
+        strip_key = photostrip_key([image_id for image_id, _ in sources], layout, fmt, image_encoder.profile.name)
         
+        job, created = job_queue.submit("photostrip", {
+            "session_id": session_id,
+            "layout": layout,
+            "format": fmt,
+            "sources": sources,
+            "image_count": image_count,
+            "strip_key": strip_key,
+        }, dedupe_key=f"photostrip:{session_id}:{strip_key}")
+        
+        if not wait:
+            return job_response(job, status_code=202, deduplicated=not created)
+        
+        job = await job_queue.wait(job["job_id"], WORKER_JOB_TIMEOUT)
+        if job["status"] == "failed":
+            raise HTTPException(status_code=500, detail=f"Error creating photostrip: {job['error']}")
+        if job["status"] != "done":
+            return job_response(job, status_code=202, deduplicated=not created)
+        
+        strip = job["result"]
+        with timed_stage("base64"):
+            strip_bytes = load_image_bytes(await asyncio.to_thread(_get_image_record, strip["photostrip_id"]))
+            strip_base64 = base64.b64encode(strip_bytes).decode()
         return JSONResponse({
             "success": True,
-            "photostrip_id": strip_id,
-            "session_id": session_id,
-            "image_count": len(images),
-            "photostrip": f"data:image/png;base64,{strip_base64}"
+            "job_id": job["job_id"],
+            **{key: value for key, value in strip.items() if key != "content_type"},
+            "photostrip": f"data:{strip['content_type']};base64,{strip_base64}",
         })
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating photostrip: {str(e)}")
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """Status and result of a background job
+    
+    ``wait`` (seconds, at most 60) long-polls: the response is held until
+    the job finishes or the time is up.
+    """
+    
+    if not 0 <= wait <= 60:
+        raise HTTPException(status_code=400, detail="wait must be between 0 and 60 seconds")
+    job = await job_queue.wait(job_id, wait)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_response(job)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events with the job's state on every change, ending when it finishes"""
+    
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def events():
+        async for current in job_queue.watch(job_id):
+            if current is None:
+                # A comment line now and then keeps proxies from closing the stream
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {current['status']}\ndata: {json.dumps(current)}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.get("/search-similar/")
-async def search_similar_images(image_id: str, limit: int = 5):
-    """Find similar images using vector similarity search"""
+async def search_similar_images(image_id: str, limit: int = 5, type: Optional[str] = None,
+                                session_id: Optional[str] = None, min_similarity: Optional[float] = None):
+    """Find similar images using vector similarity search
+    
+    ``type`` (single_image or photostrip) and ``session_id`` restrict the
+    candidates; ``min_similarity`` drops weaker matches.
+    """
+    require_compatible_store()
+    
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    try:
+        where = search_filter(type, session_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     try:
         # Get the target image
-        target_result = collection.get(
-            ids=[image_id],
-            include=["embeddings", "metadatas"]
-        )
-        
-        if not target_result['embeddings']:
+        embeddings = await asyncio.to_thread(similarity_search.embeddings_for, [image_id])
+        if image_id not in embeddings:
             raise HTTPException(status_code=404, detail="Image not found")
         
-        # Query for similar images
-        results = collection.query(
-            query_embeddings=[target_result['embeddings'][0]],
-            n_results=limit + 1,  # +1 because it will include the target image
-            include=["metadatas", "distances"]
+        similar_images, = await asyncio.to_thread(
+            similarity_search.search, [(image_id, embeddings[image_id])], limit, where, min_similarity
         )
         
-        # Filter out the target image and prepare response
-        similar_images = []
-        for i, metadata in enumerate(results['metadatas'][0]):
-            if metadata['id'] != image_id:  # Exclude the target image
-                similar_images.append({
-                    "image_id": metadata['id'],
-                    "similarity_score": 1 - results['distances'][0][i],  # Convert distance to similarity
-                    "filters_applied": metadata.get('filters_applied', []),
-                    "timestamp": metadata.get('timestamp'),
-                    "session_id": metadata.get('session_id')
-                })
-        
         return JSONResponse({
             "success": True,
             "target_image_id": image_id,
-            "similar_images": similar_images[:limit]
+            "similar_images": similar_images
         })
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error searching similar images: {str(e)}")
 
-@app.get("/get-image/{image_id}")
-async def get_image(image_id: str):
-    """Retrieve a specific image by ID"""
+class SimilarSearchBatch(BaseModel):
+    """Body of POST /search-similar/batch"""
+    image_ids: List[str] = []
+    vectors: List[List[float]] = []
+    limit: int = 5
+    type: Optional[str] = None
+    session_id: Optional[str] = None
+    min_similarity: Optional[float] = None
+
+@app.post("/search-similar/batch")
+async def search_similar_batch(batch: SimilarSearchBatch):
+    """Find similar images for many stored images and/or raw query vectors at once
+    
+    Target embeddings are fetched with one store call and every query not
+    already cached runs in one multi-vector query. Results come back in
+    request order, image ids first, then vectors; an unknown image id
+    fails on its own without failing the batch.
+    """
+    require_compatible_store()
     
+    query_count = len(batch.image_ids) + len(batch.vectors)
+    if not 1 <= query_count <= SEARCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {SEARCH_MAX_QUERIES} image ids and vectors")
+    if not 1 <= batch.limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    if any(len(vector) != descriptor_pipeline.dim for vector in batch.vectors):
+        raise HTTPException(status_code=400, detail=f"vectors must have {descriptor_pipeline.dim} values")
     try:
-        result = collection.get(
+        where = search_filter(batch.type, batch.session_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        embeddings = await asyncio.to_thread(similarity_search.embeddings_for, batch.image_ids)
+        queries = [(image_id, embeddings[image_id]) for image_id in batch.image_ids if image_id in embeddings]
+        queries += [(None, np.asarray(vector, dtype=np.float32)) for vector in batch.vectors]
+        found = iter(await asyncio.to_thread(
+            similarity_search.search, queries, batch.limit, where, batch.min_similarity
+        ) if queries else [])
+        
+        results = []
+        for image_id in batch.image_ids:
+            if image_id not in embeddings:
+                results.append({"image_id": image_id, "success": False, "error": "Image not found"})
+            else:
+                results.append({"image_id": image_id, "success": True, "similar_images": next(found)})
+        for index in range(len(batch.vectors)):
+            results.append({"vector_index": index, "success": True, "similar_images": next(found)})
+        
+        return JSONResponse({"success": any(result["success"] for result in results), "results": results})
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching similar images: {str(e)}")
+
+def _get_image_record(image_id: str) -> dict:
+    """Fetch a record's metadata or raise 404"""
+    with timed_chroma("get"):
+        result = storage.store.get(
             ids=[image_id],
             include=["metadatas"]
         )
+    
+    if not result['metadatas']:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    retention.touch(result['metadatas'][0].get('session_id'))
+    return result['metadatas'][0]
+
+def image_urls(image_id: str) -> dict:
+    """URLs of every rendition of an image"""
+    urls = {"image_url": f"/get-image/{image_id}"}
+    for size in DERIVATIVE_SIZES:
+        urls[f"{size}_url"] = f"/get-image/{image_id}?size={size}"
+    return urls
+
+@app.get("/get-image/{image_id}")
+async def get_image(image_id: str, request: Request, size: str = "full"):
+    """Retrieve the raw bytes of a specific image by ID (supports ETag and Range)
+    
+    ``size`` selects a downscaled rendition ("thumb", "preview"), the
+    stored image ("full") or, when originals are preserved, the untouched
+    upload ("original").
+    """
+    
+    if size not in ("full", "original") and size not in DERIVATIVE_SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown size: {size}")
+    
+    try:
+        metadata = await asyncio.to_thread(_get_image_record, image_id)
+        media_type = metadata.get('content_type', 'image/png')
         
-        if not result['metadatas']:
-            raise HTTPException(status_code=404, detail="Image not found")
+        if size == "original":
+            original_ref = metadata.get('original_blob_ref')
+            if not original_ref or not blob_store.exists(original_ref):
+                raise HTTPException(status_code=404, detail="Original upload not preserved")
+            etag = f'"{original_ref}"'
+            headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers=headers)
+            media_type = metadata.get('original_content_type', 'application/octet-stream')
+            return FileResponse(blob_store.path(original_ref), media_type=media_type, headers=headers)
         
-        metadata = result['metadatas'][0]
+        if metadata.get('blob_ref'):
+            blob_ref = metadata['blob_ref']
+            if not blob_store.exists(blob_ref):
+                raise HTTPException(status_code=404, detail="Image data not found")
+            
+            # Content never changes for a blob reference, so it can be cached for good
+            etag = f'"{blob_ref}"' if size == "full" else f'"{blob_ref}-{size}"'
+            headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers=headers)
+            
+            if size == "full":
+                return FileResponse(blob_store.path(blob_ref), media_type=media_type, headers=headers)
+            
+            path = derivative_store.path(blob_ref, size)
+            if not os.path.exists(path):
+                path = await worker_pool.run(render_derivative_job, blob_ref, size)
+            return FileResponse(path, media_type="image/webp", headers=headers)
         
-        if 'image_data' not in metadata:
+        # Records written before the blob store migration have no renditions
+        if size != "full":
+            raise HTTPException(
+                status_code=409,
+                detail=f"No '{size}' rendition for images stored inline; run 'python app.py migrate-blobs'"
+            )
+        img_data = load_image_bytes(metadata)
+        if img_data is None:
             raise HTTPException(status_code=404, detail="Image data not found")
+        # The digest is the blob reference the image gets once migrated, so the ETag stays valid
+        etag = f'"{hashlib.sha256(img_data).hexdigest()}"'
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(content=img_data, media_type=media_type, headers=headers)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving image: {str(e)}")
+
+@app.get("/get-image/{image_id}/metadata")
+async def get_image_metadata(image_id: str):
+    """Retrieve metadata for a specific image by ID"""
+    
+    try:
+        metadata = await asyncio.to_thread(_get_image_record, image_id)
         
         return JSONResponse({
             "success": True,
             "image_id": image_id,
-            "image": f"data:image/png;base64,{metadata['image_data']}",
+            **image_urls(image_id),
             "metadata": {
                 "filename": metadata.get('filename'),
                 "filters_applied": metadata.get('filters_applied', []),
                 "timestamp": metadata.get('timestamp'),
                 "session_id": metadata.get('session_id'),
                 "dimensions": metadata.get('dimensions'),
-                "type": metadata.get('type', 'single_image')
+                "stored_dimensions": metadata.get('stored_dimensions'),
+                "original_preserved": bool(metadata.get('original_blob_ref')),
+                "type": metadata.get('type', 'single_image'),
+                "content_type": metadata.get('content_type', 'image/png'),
+                "format": metadata.get('format', 'png'),
+                "quality": metadata.get('quality'),
+                "size": metadata.get('blob_size')
             }
         })
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving image: {str(e)}")
 
 @app.get("/list-sessions/")
-async def list_sessions():
-    """List all available sessions"""
+async def list_sessions(limit: int = 50, cursor: Optional[str] = None):
+    """List sessions, most recent first, one page at a time"""
+    
+    if not 1 <= limit <= 500:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 500")
     
     try:
-        # Get all records
-        results = collection.get(include=["metadatas"])
-        
-        sessions = {}
-        for metadata in results['metadatas']:
-            session_id = metadata.get('session_id')
-            if session_id:
-                if session_id not in sessions:
-                    sessions[session_id] = {
-                        'session_id': session_id,
-                        'image_count': 0,
-                        'photostrip_count': 0,
-                        'latest_timestamp': None
-                    }
-                
-                if metadata.get('type') == 'photostrip':
-                    sessions[session_id]['photostrip_count'] += 1
-                else:
-                    sessions[session_id]['image_count'] += 1
-                
-                # Update latest timestamp
-                timestamp = metadata.get('timestamp')
-                if timestamp and (not sessions[session_id]['latest_timestamp'] or timestamp > sessions[session_id]['latest_timestamp']):
-                    sessions[session_id]['latest_timestamp'] = timestamp
+        try:
+            with timed_stage("session_index"):
+                sessions, next_cursor = session_index.page(limit, cursor)
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
         
         return JSONResponse({
             "success": True,
-            "sessions": list(sessions.values())
+            "sessions": sessions,
+            "next_cursor": next_cursor
         })
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing sessions: {str(e)}")
 
+@app.get("/sessions/{session_id}/duplicates")
+async def list_duplicates(session_id: str):
+    """List clusters of near-identical images within a session"""
+    
+    try:
+        clusters = hash_index.session_clusters(session_id, DEDUP_THRESHOLD)
+        return JSONResponse({
+            "success": True,
+            "session_id": session_id,
+            "threshold": DEDUP_THRESHOLD,
+            "clusters": [{"image_ids": members, "size": len(members)} for members in clusters]
+        })
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error listing duplicates: {str(e)}")
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Delete a session's images and photostrips
+    
+    Records go at once; the blob bytes are reclaimed by the next
+    compaction, which also rebuilds the index once deletions warrant it.
+    """
+    
+    try:
+        # Deleting may compact the store; keep that off the event loop
+        deleted = await asyncio.to_thread(retention.delete_session, session_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error deleting session: {str(e)}")
+    if deleted is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return JSONResponse({"success": True, **deleted})
+
+class SessionRetention(BaseModel):
+    """Body of PUT /sessions/{session_id}/retention"""
+    ttl_hours: Optional[float] = None  # None restores the default; 0 keeps the session forever
+
+@app.put("/sessions/{session_id}/retention")
+async def set_session_retention(session_id: str, body: SessionRetention):
+    """Give a session its own TTL; a TTL of 0 also exempts it from budget eviction"""
+    
+    if body.ttl_hours is not None and body.ttl_hours < 0:
+        raise HTTPException(status_code=400, detail="ttl_hours must not be negative")
+    if not session_index.set_ttl(session_id, body.ttl_hours):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return JSONResponse({
+        "success": True,
+        "session_id": session_id,
+        "ttl_hours": body.ttl_hours,
+        "default_ttl_hours": SESSION_TTL_HOURS
+    })
+
+def parse_filters(filters) -> List[str]:
+    """Filter names from a comma-separated string or a list"""
+    if isinstance(filters, str):
+        filters = filters.split(',')
+    return [f.strip() for f in filters or [] if f.strip()]
+
+@app.websocket("/ws/preview")
+async def live_preview(websocket: WebSocket, filters: Optional[str] = None, max_edge: int = PREVIEW_MAX_EDGE):
+    """Live filter preview: JPEG frames in, filtered JPEG frames out, nothing stored
+    
+    Send frames as binary messages and settings as JSON text, e.g.
+    ``{"filters": "vintage,enhance"}``. Each processed frame is answered
+    with a JSON message (``seq`` is the frame's position among those
+    received, plus timings and the running ``dropped`` count) followed
+    by the encoded frame. Only the newest frame waits to be processed;
+    older ones are dropped, so latency stays bounded when the client
+    sends faster than the server keeps up. Each connection gets at most
+    PHOTOBOOTH_PREVIEW_MAX_FPS frames per second and
+    PHOTOBOOTH_PREVIEW_CPU_SHARE of a core.
+    """
+    await websocket.accept()
+    settings = {"filters": parse_filters(filters), "max_edge": max(16, min(max_edge, PREVIEW_MAX_EDGE))}
+    latest: Optional[Tuple[int, bytes]] = None
+    arrived = asyncio.Event()
+    received = dropped = 0
+    
+    async def receive_frames():
+        nonlocal latest, received, dropped
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                if message.get("bytes") is not None:
+                    if len(message["bytes"]) > PREVIEW_MAX_FRAME_BYTES:
+                        await websocket.close(code=1009, reason="Frame too large")
+                        return
+                    received += 1
+                    if latest is not None:
+                        dropped += 1
+                    latest = (received, message["bytes"])
+                    arrived.set()
+                elif message.get("text"):
+                    try:
+                        changes = json.loads(message["text"])
+                        if "filters" in changes:
+                            settings["filters"] = parse_filters(changes["filters"])
+                        if "max_edge" in changes:
+                            settings["max_edge"] = max(16, min(int(changes["max_edge"]), PREVIEW_MAX_EDGE))
+                    except (json.JSONDecodeError, ValueError, TypeError, AttributeError):
+                        await websocket.send_json({"error": "Settings must be a JSON object"})
+        except WebSocketDisconnect:
+            # Gone while we were answering a settings message
+            return
+    
+    receiver = asyncio.create_task(receive_frames())
+    loop = asyncio.get_running_loop()
+    next_start = 0.0
+    try:
+        while True:
+            waiter = asyncio.create_task(arrived.wait())
+            await asyncio.wait({receiver, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            # Rate and CPU cap; frames arriving meanwhile replace the waiting one
+            if next_start > loop.time() and not receiver.done():
+                await asyncio.sleep(next_start - loop.time())
+            if receiver.done():
+                break
+            
+            arrived.clear()
+            (seq, frame), latest = latest, None
+            started = loop.time()
+            try:
+                result = await worker_pool.run(
+                    render_preview_job, frame, settings["filters"], settings["max_edge"], PREVIEW_JPEG_QUALITY
+                )
+            except HTTPException as e:
+                # Pool busy or job timed out: skip this frame
+                await websocket.send_json({"seq": seq, "error": e.detail})
+                next_start = loop.time() + 1.0
+                continue
+            except (ValueError, OSError) as e:
+                # Bad frame (or one the pool lost); report it and keep the connection
+                await websocket.send_json({"seq": seq, "error": str(e) or type(e).__name__})
+                continue
+            
+            latency = loop.time() - started
+            busy = sum(result["timings"].values())
+            next_start = started + max(1 / PREVIEW_MAX_FPS, busy / PREVIEW_CPU_SHARE)
+            for stage, seconds in result["timings"].items():
+                METRICS["stage"].observe(seconds, route="/ws/preview", stage=stage)
+            
+            await websocket.send_json({
+                "seq": seq,
+                "size": result["size"],
+                "process_ms": round(busy * 1000, 2),
+                "latency_ms": round(latency * 1000, 2),
+                "dropped": dropped,
+            })
+            await websocket.send_bytes(result["encoded"])
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+
 # NEW: Health check endpoint with API info
+_profile_lock = threading.Lock()
+
+# Routes that answer without the database, so they never wait for it to open
+STORAGE_FREE_PATHS = ("/", "/api/health", "/api/ready", "/metrics", "/docs", "/redoc", "/openapi.json")
+STORAGE_FREE_PREFIXES = ("/static/", "/jobs/")
+
+@app.middleware("http")
+async def wait_for_storage(request: Request, call_next):
+    """Let requests that use the database wait for it to open without blocking the event loop"""
+    path = request.url.path
+    if not storage.ready and path not in STORAGE_FREE_PATHS and not path.startswith(STORAGE_FREE_PREFIXES):
+        try:
+            await storage.wait_open()
+        except Exception as e:
+            return JSONResponse(
+                {"detail": f"Storage unavailable: {e}"}, status_code=503, headers={"Retry-After": "1"}
+            )
+    return await call_next(request)
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """Time every request: Server-Timing header, latency histograms and slow-request profiles
+    
+    The profiler sees everything the event loop runs meanwhile, including
+    other requests, but not work done in the worker pool.
+    """
+    timer = RequestTimer()
+    token = _request_timer.set(timer)
+    profiler = None
+    if PROFILE_THRESHOLD_MS and random.random() < PROFILE_SAMPLE_RATE and _profile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        elapsed = time.perf_counter() - started
+        if profiler is not None:
+            profiler.disable()
+            _profile_lock.release()
+        _request_timer.reset(token)
+    
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    METRICS["request"].observe(elapsed, route=route, status=response.status_code)
+    for stage, seconds in timer.stages.items():
+        METRICS["stage"].observe(seconds, route=route, stage=stage)
+    
+    if profiler is not None and elapsed * 1000 >= PROFILE_THRESHOLD_MS:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        slug = route.strip("/").replace("/", "_").replace("{", "").replace("}", "") or "root"
+        profiler.dump_stats(os.path.join(
+            PROFILE_DIR, f"{datetime.now():%Y%m%dT%H%M%S}-{slug}-{elapsed * 1000:.0f}ms.prof"
+        ))
+    
+    if timer.stages:
+        response.headers["Server-Timing"] = f"{timer.server_timing()}, total;dur={elapsed * 1000:.1f}"
+    return response
+
+@app.get("/metrics")
+async def metrics():
+    """Request, stage and ChromaDB latency histograms in Prometheus text format"""
+    lines = []
+    for histogram in METRICS.values():
+        lines.extend(histogram.render())
+    lines += [
+        "# HELP photobooth_worker_jobs_in_flight Image jobs queued or running",
+        "# TYPE photobooth_worker_jobs_in_flight gauge",
+        f"photobooth_worker_jobs_in_flight {worker_pool.stats()['in_flight']}",
+        "# HELP photobooth_ingest_memory_bytes Estimated decode memory reserved by uploads",
+        "# TYPE photobooth_ingest_memory_bytes gauge",
+        f"photobooth_ingest_memory_bytes {ingest_budget.stats()['in_use_bytes']}",
+        "# HELP photobooth_jobs Background jobs by status",
+        "# TYPE photobooth_jobs gauge",
+        *(f'photobooth_jobs{{status="{status}"}} {job_queue.stats()[status]}' for status in ("queued", "running")),
+        "# HELP photobooth_search_cache_lookups_total Similarity searches answered from or missing the cache",
+        "# TYPE photobooth_search_cache_lookups_total counter",
+        f'photobooth_search_cache_lookups_total{{result="hit"}} {similarity_search.hits}',
+        f'photobooth_search_cache_lookups_total{{result="miss"}} {similarity_search.misses}',
+        "# HELP photobooth_sessions_deleted_total Sessions deleted by this process, by reason",
+        "# TYPE photobooth_sessions_deleted_total counter",
+        *(f'photobooth_sessions_deleted_total{{reason="{reason}"}} {count}'
+          for reason, count in retention.sessions_deleted.items()),
+        "# HELP photobooth_reclaimed_bytes_total Bytes freed by compactions run in this process",
+        "# TYPE photobooth_reclaimed_bytes_total counter",
+        f"photobooth_reclaimed_bytes_total {retention.bytes_reclaimed}",
+        "# HELP photobooth_stored_session_bytes Bytes held by stored sessions",
+        "# TYPE photobooth_stored_session_bytes gauge",
+        f"photobooth_stored_session_bytes {session_index.total_bytes()}",
+    ]
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/api/ready")
+async def readiness():
+    """Readiness probe: 503 until the database is open, unlike /api/health
+    which only reports that the process is up"""
+    if not storage.ready:
+        storage.warm()
+        return JSONResponse(
+            {"status": "starting", **storage.status()},
+            status_code=503,
+            headers={"Retry-After": "1"}
+        )
+    return JSONResponse({"status": "ready", **storage.status()})
+
 @app.get("/api/health")
 async def api_health():
     """API health check and info"""
@@ -531,23 +4593,83 @@ async def api_health():
         "message": "Photobooth API",
         "version": "1.0.0",
         "status": "healthy",
+        "process": {"pid": os.getpid(), "web_workers": WEB_WORKERS},
+        "worker_pool": worker_pool.stats(),
+        "ingest_memory": ingest_budget.stats(),
+        "storage": storage.status(),
+        "jobs": job_queue.stats(),
+        "search_cache": similarity_search.stats(),
+        "retention": retention.stats(),
         "endpoints": {
             "GET /": "Main photobooth application",
             "POST /upload-image/": "Upload and process an image with filters",
-            "POST /create-photostrip/": "Create photostrip from session images",
+            "POST /upload-images/": "Upload and process a batch of images with shared filters",
+            "POST /create-photostrip/": "Queue a photostrip of session images (returns a job id)",
+            "GET /jobs/{job_id}": "Job status and result (?wait= long-polls)",
+            "GET /jobs/{job_id}/events": "Job status as server-sent events",
             "GET /search-similar/{image_id}": "Find similar images",
-            "GET /get-image/{image_id}": "Retrieve specific image",
-            "GET /list-sessions/": "List all available sessions",
+            "POST /search-similar/batch": "Find similar images for many image ids or vectors in one call",
+            "GET /get-image/{image_id}": "Retrieve specific image (raw bytes)",
+            "GET /get-image/{image_id}/metadata": "Retrieve image metadata",
+            "GET /list-sessions/": "List sessions by recency (cursor paginated)",
+            "GET /sessions/{session_id}/duplicates": "List near-duplicate image clusters in a session",
+            "DELETE /sessions/{session_id}": "Delete a session's images and photostrips",
+            "PUT /sessions/{session_id}/retention": "Set a session's TTL in hours (0 = keep forever)",
+            "GET /metrics": "Prometheus latency and size histograms",
+            "WS /ws/preview": "Live filter preview of JPEG frames (nothing stored)",
+            "GET /api/ready": "Readiness probe (503 until the database is open)",
             "GET /docs": "API documentation"
         },
-        "available_filters": ["vintage", "bw", "blur", "enhance", "retro"]
+        "available_filters": list(FILTER_REGISTRY)
     }
 
 if __name__ == "__main__":
     import uvicorn
     
+    # Warnings from the app (skipped records, recovered collections) go to the console like the rest
+    logging.basicConfig(format=" %(message)s")
+    
+    # One-shot maintenance commands
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-blobs":
+        count = migrate_inline_images()
+        print(f" Migrated {count} records to the blob store at {BLOB_PATH}")
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "reindex":
+        count = reindex_collection()
+        print(f" Re-indexed {count} records with descriptors {descriptor_pipeline.version}")
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-hash-index":
+        count = hash_index.rebuild(storage.store)
+        print(f" Rebuilt perceptual hash index with {count} images at {HASH_INDEX_PATH}")
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-session-index":
+        count = session_index.rebuild(storage.store)
+        print(f" Rebuilt session index with {count} sessions at {SESSION_INDEX_PATH}")
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-store":
+        # python app.py migrate-store chroma local
+        if len(sys.argv) != 4 or sys.argv[2] == sys.argv[3]:
+            sys.exit(" Usage: python app.py migrate-store <from> <to>   (backends: chroma, local)")
+        count = migrate_store(open_photo_store(sys.argv[2]), open_photo_store(sys.argv[3]))
+        print(f" Copied {count} records from the {sys.argv[2]} store to the {sys.argv[3]} store;"
+              f" set PHOTOBOOTH_STORE={sys.argv[3]} to use it")
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "compact-store":
+        count = storage.store.compact()
+        print(f" Compacted the {STORE_BACKEND} store, reclaiming {count} deleted records")
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "retention":
+        # Expire and evict now, then compact whether or not the thresholds are reached
+        result = retention.run_once(force_compact=True)
+        print(f" Expired {len(result['expired'])} sessions and evicted {len(result['evicted'])} over budget")
+        report = result["compaction"]
+        if report:
+            print(f" Compaction reclaimed {report['bytes_reclaimed']} bytes ({report['blobs_removed']} files,"
+                  f" {report['records_reclaimed']} index records) in {report['duration_seconds']:.2f}s")
+        sys.exit(0)
+    
     # Create necessary directories if they don't exist
-    os.makedirs("./photobooth_db", exist_ok=True)
+    os.makedirs(DB_PATH if STORE_BACKEND == "chroma" else LOCAL_STORE_PATH, exist_ok=True)
     os.makedirs("./static", exist_ok=True)
     os.makedirs("./templates", exist_ok=True)
     os.makedirs("./uploads", exist_ok=True)
@@ -556,6 +4678,7 @@ if __name__ == "__main__":
     print(" Main App: http://localhost:8000")
     print(" API Docs: http://localhost:8000/docs")
     print(" Health Check: http://localhost:8000/api/health")
+    print(" Readiness: http://localhost:8000/api/ready")
     
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
 
@@ -0,0 +1,94 @@
+"""Command line: ``python -m benchmarks run|compare``"""
+import argparse
+import asyncio
+import os
+import sys
+
+from . import load_app
+from .fixtures import SIZES, synthetic_jpeg
+from .preview import bench_preview, stream
+from .runner import Results, compare
+from .suites import SCALES, bench_database, bench_filters, bench_photostrip, bench_startup, bench_upload
+
+SUITES = ["startup", "filters", "photostrip", "upload", "preview", "database"]
+
+def _names(value: str, choices) -> list:
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in choices]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown: {', '.join(unknown)} (choose from {', '.join(choices)})")
+    return names
+
+def run(args) -> int:
+    # Benchmarks measure the real write path, not duplicate links
+    os.environ.setdefault("PHOTOBOOTH_DEDUP_MODE", "off")
+    app = load_app(args.workdir)
+    from fastapi.testclient import TestClient
+
+    results = Results()
+    if "startup" in args.suites:
+        bench_startup(results)
+    with TestClient(app.app) as client:
+        if "filters" in args.suites:
+            bench_filters(app, results, args.sizes)
+        if "photostrip" in args.suites:
+            bench_photostrip(app, results, args.sizes)
+        if "upload" in args.suites:
+            bench_upload(app, results, client, args.sizes)
+        if "preview" in args.suites:
+            bench_preview(app, results, client)
+        if "database" in args.suites:
+            bench_database(app, results, client, args.scales)
+
+    results.save(args.out)
+    print(f"\nwrote {len(results.entries)} results to {args.out}")
+    if args.baseline:
+        print()
+        return 1 if compare(args.baseline, args.out, args.tolerance) else 0
+    return 0
+
+def preview(args) -> int:
+    frames = [synthetic_jpeg("vga", seed, quality=80) for seed in range(3)]
+    report = asyncio.run(stream(args.url, frames, args.fps, args.seconds, args.filters))
+    print(f"sent {report['sent']}  received {report['received']}  dropped by server {report['dropped']}")
+    print(f"{report['fps']} frames/s  latency median {report['latency_median'] * 1000:.1f} ms"
+          f"  p95 {report['latency_p95'] * 1000:.1f} ms")
+    return 0
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run benchmarks and write JSON results")
+    run_parser.add_argument("--suites", type=lambda v: _names(v, SUITES), default=SUITES,
+                            help=f"comma-separated subset of {','.join(SUITES)}")
+    run_parser.add_argument("--sizes", type=lambda v: _names(v, list(SIZES)), default=list(SIZES),
+                            help=f"image fixtures, from {','.join(SIZES)}")
+    run_parser.add_argument("--scales", type=lambda v: _names(v, list(SCALES)), default=list(SCALES),
+                            help=f"collection sizes for database benchmarks, from {','.join(SCALES)}")
+    run_parser.add_argument("--out", default="benchmark-results.json")
+    run_parser.add_argument("--workdir", help="scratch directory for the database (default: a new temp dir)")
+    run_parser.add_argument("--baseline", help="compare against this results file when done")
+    run_parser.add_argument("--tolerance", type=float, default=0.15)
+
+    compare_parser = commands.add_parser("compare", help="flag regressions against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--tolerance", type=float, default=0.15,
+                                help="allowed slowdown of the median, as a fraction")
+
+    preview_parser = commands.add_parser("preview", help="stream webcam-sized frames to a running server")
+    preview_parser.add_argument("--url", default="ws://127.0.0.1:8000/ws/preview")
+    preview_parser.add_argument("--fps", type=float, default=30.0, help="frames sent per second")
+    preview_parser.add_argument("--seconds", type=float, default=10.0)
+    preview_parser.add_argument("--filters", default="vintage,retro,enhance")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        return run(args)
+    if args.command == "preview":
+        return preview(args)
+    return 1 if compare(args.baseline, args.current, args.tolerance) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
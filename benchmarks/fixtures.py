@@ -0,0 +1,58 @@
+"""Reproducible synthetic images
+
+Images are smooth colour gradients with seeded noise and a few hard edges,
+so they compress and filter like photos rather than like pure noise.
+"""
+import io
+from functools import lru_cache
+from typing import Dict, Tuple
+
+import numpy as np
+from PIL import Image
+
+SIZES: Dict[str, Tuple[int, int]] = {
+    "vga": (640, 480),
+    "12mp": (4000, 3000),
+    "48mp": (8000, 6000),
+}
+
+@lru_cache(maxsize=None)
+def synthetic_image(size_name: str, seed: int = 0) -> Image.Image:
+    """An RGB test image of a named size; identical for the same seed"""
+    width, height = SIZES[size_name]
+    rng = np.random.default_rng(seed)
+
+    x = np.linspace(0.0, 1.0, width, dtype=np.float32)
+    y = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, np.newaxis]
+    phase = rng.random(3, dtype=np.float32) * np.pi
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    for channel in range(3):
+        wave = 0.5 + 0.25 * np.sin(6 * x + phase[channel]) + 0.25 * np.cos(4 * y + phase[channel])
+        noise = rng.normal(0.0, 0.03, (height, width)).astype(np.float32)
+        pixels[..., channel] = np.clip((wave + noise) * 255, 0, 255).astype(np.uint8)
+
+    # A few solid blocks give the image real edges
+    for _ in range(6):
+        left, top = int(rng.integers(0, width * 3 // 4)), int(rng.integers(0, height * 3 // 4))
+        pixels[top:top + height // 6, left:left + width // 6] = rng.integers(0, 256, 3, dtype=np.uint8)
+
+    return Image.fromarray(pixels, "RGB")
+
+@lru_cache(maxsize=None)
+def synthetic_jpeg(size_name: str, seed: int = 0, quality: int = 90) -> bytes:
+    """The synthetic image encoded as a JPEG, as a camera or phone would upload it"""
+    buffer = io.BytesIO()
+    synthetic_image(size_name, seed).save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+@lru_cache(maxsize=None)
+def synthetic_palette_png(size_name: str, seed: int = 0) -> bytes:
+    """The synthetic image quantized to a 256-colour palette PNG, like a screenshot or GIF export"""
+    buffer = io.BytesIO()
+    synthetic_image(size_name, seed).quantize(256).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def random_embeddings(count: int, dim: int, seed: int = 0) -> np.ndarray:
+    """Unit-length random vectors for seeding a collection"""
+    vectors = np.random.default_rng(seed).random((count, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
@@ -0,0 +1,91 @@
+"""Live preview client: streams frames to /ws/preview and measures frames/sec and latency
+
+Run against a live server:
+
+    python -m benchmarks preview --url ws://127.0.0.1:8000/ws/preview --fps 30 --seconds 10
+"""
+import asyncio
+import json
+import statistics
+import time
+from typing import List
+
+from .fixtures import synthetic_jpeg
+
+PREVIEW_CHAINS = ["vintage,retro,enhance", "bw,blur"]
+
+def summarize(latencies: List[float], sent: int, received: int, elapsed: float, dropped: int) -> dict:
+    """Frames/sec and round-trip latency figures (seconds) from one stream"""
+    ordered = sorted(latencies) or [0.0]
+    return {
+        "sent": sent,
+        "received": received,
+        "dropped": dropped,
+        "fps": round(received / elapsed, 2) if elapsed else 0.0,
+        "latency_median": statistics.median(ordered),
+        "latency_p95": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+    }
+
+async def stream(url: str, frames: List[bytes], fps: float, seconds: float, filters: str) -> dict:
+    """Send frames at ``fps`` for ``seconds`` without waiting for replies, as a webcam would
+
+    Latency is measured from sending a frame to receiving its processed
+    copy; frames the server dropped as stale have no reply.
+    """
+    import websockets
+
+    sent_at = {}
+    latencies = []
+    report = {"received": 0, "dropped": 0}
+
+    async with websockets.connect(url, max_size=None) as websocket:
+        await websocket.send(json.dumps({"filters": filters}))
+
+        async def receive():
+            header = None
+            async for message in websocket:
+                if isinstance(message, str):
+                    header = json.loads(message)
+                    report["dropped"] = header.get("dropped", report["dropped"])
+                elif header is not None:
+                    latencies.append(time.perf_counter() - sent_at.pop(header["seq"]))
+                    report["received"] += 1
+
+        receiver = asyncio.create_task(receive())
+        started = time.perf_counter()
+        sent = 0
+        while time.perf_counter() - started < seconds:
+            sent += 1
+            sent_at[sent] = time.perf_counter()
+            await websocket.send(frames[sent % len(frames)])
+            await asyncio.sleep(max(0.0, started + sent / fps - time.perf_counter()))
+        # Give the last frame time to come back
+        await asyncio.sleep(min(1.0, statistics.median(latencies) * 2 if latencies else 1.0))
+        elapsed = time.perf_counter() - started
+        receiver.cancel()
+
+    return summarize(latencies, sent, report["received"], elapsed, report["dropped"])
+
+def bench_preview(app, results, client, frame_count: int = 30):
+    """Round trip of VGA webcam frames through /ws/preview, one frame in flight at a time
+
+    Frames are sent no faster than the server's per-connection frame rate
+    cap, so latency measures processing rather than pacing.
+    """
+    frames = [synthetic_jpeg("vga", seed, quality=80) for seed in range(3)]
+    interval = 1 / app.PREVIEW_MAX_FPS
+    for chain in PREVIEW_CHAINS:
+        latencies, process_times = [], []
+        with client.websocket_connect("/ws/preview", params={"filters": chain}) as websocket:
+            started = time.perf_counter()
+            for index in range(frame_count):
+                time.sleep(max(0.0, started + index * interval - time.perf_counter()))
+                sent = time.perf_counter()
+                websocket.send_bytes(frames[index % len(frames)])
+                header = websocket.receive_json()
+                websocket.receive_bytes()
+                latencies.append(time.perf_counter() - sent)
+                process_times.append(header["process_ms"])
+            elapsed = time.perf_counter() - started
+        results.add(f"preview.{chain.replace(',', '+')}.vga", latencies,
+                    fps=round(frame_count / elapsed, 2), process_ms=statistics.median(process_times))
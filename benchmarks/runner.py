@@ -0,0 +1,105 @@
+"""Timing, result files and baseline comparison"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+class Results:
+    """Benchmark results keyed by name, saved as JSON"""
+
+    def __init__(self):
+        self.entries: Dict[str, dict] = {}
+
+    def add(self, name: str, samples: List[float], **extra):
+        """Record timing samples (seconds) plus any extra figures, e.g. throughput"""
+        ordered = sorted(samples)
+        entry = {
+            "unit": "s",
+            "runs": len(samples),
+            "median": statistics.median(ordered),
+            "min": ordered[0],
+            "max": ordered[-1],
+            "p95": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        }
+        entry.update(extra)
+        self.entries[name] = entry
+        print(f"{name:<48} median {entry['median'] * 1000:10.2f} ms  "
+              + "  ".join(f"{key} {value}" for key, value in extra.items()), flush=True)
+        return entry
+
+    def save(self, path: str):
+        document = {"meta": environment(), "results": self.entries}
+        with open(path, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+def measure(fn: Callable[[], object], repeat: int = 5, warmup: int = 1) -> List[float]:
+    """Wall-clock seconds of ``repeat`` calls after ``warmup`` untimed calls"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def environment() -> dict:
+    """What the numbers were measured on"""
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "git_revision": revision,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def compare(baseline_path: str, current_path: str, tolerance: float = 0.15,
+            min_delta: float = 0.0005) -> int:
+    """Print median changes against a baseline; returns the number of regressions
+
+    A benchmark regresses when its median is more than ``tolerance`` slower
+    and at least ``min_delta`` seconds slower, which keeps sub-millisecond
+    jitter from failing a run. A current result that saw any status other
+    than 200 always counts: timing error responses proves nothing.
+    """
+    with open(baseline_path) as f:
+        baseline_document = json.load(f)
+    with open(current_path) as f:
+        current_document = json.load(f)
+    baseline, current = baseline_document["results"], current_document["results"]
+    print(f"baseline {baseline_document['meta'].get('git_revision')} "
+          f"vs current {current_document['meta'].get('git_revision')}\n")
+
+    regressions = 0
+    for name in sorted(set(baseline) | set(current)):
+        if name not in current:
+            print(f"{name:<48} missing from current run")
+            continue
+        statuses = current[name].get("statuses", [200])
+        if any(status != 200 for status in statuses):
+            regressions += 1
+            print(f"{name:<48} FAILED  statuses {statuses}")
+            continue
+        if name not in baseline:
+            print(f"{name:<48} new")
+            continue
+        before, after = baseline[name]["median"], current[name]["median"]
+        change = (after - before) / before if before else 0.0
+        regressed = change > tolerance and after - before > min_delta
+        regressions += regressed
+        flag = "REGRESSION" if regressed else ("improved" if change < -tolerance else "")
+        print(f"{name:<48} {before * 1000:10.2f} -> {after * 1000:10.2f} ms  {change:+7.1%}  {flag}")
+
+    print(f"\n{regressions} regression(s) beyond {tolerance:.0%} or failed")
+    return regressions
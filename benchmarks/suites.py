@@ -0,0 +1,319 @@
+"""Benchmark suites: filters, photostrips, uploads and database queries at scale"""
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime, timedelta
+from typing import List
+
+from . import REPO_ROOT
+from .fixtures import random_embeddings, synthetic_image, synthetic_jpeg, synthetic_palette_png
+from .runner import Results, measure
+
+CHAINS = ["vintage,retro,enhance", "vintage,blur,enhance", "bw,blur"]
+
+# Repeats per fixture size; big images are slow enough that a few runs are stable
+REPEATS = {"vga": 20, "12mp": 5, "48mp": 3}
+
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+
+def bench_filters(app, results: Results, sizes: List[str]):
+    """Throughput of each registered filter and of common chains"""
+    for size_name in sizes:
+        image = synthetic_image(size_name)
+        megapixels = image.width * image.height / 1e6
+        repeat = REPEATS[size_name]
+
+        for name in app.FILTER_REGISTRY:
+            samples = measure(lambda: app.image_processor.apply_filters(image, [name]), repeat)
+            results.add(f"filter.{name}.{size_name}", samples,
+                        megapixels_per_s=round(megapixels / statistics.median(samples), 2))
+
+        for chain in CHAINS:
+            filter_list = chain.split(",")
+            samples = measure(lambda: app.image_processor.apply_filters(image, filter_list), repeat)
+            results.add(f"chain.{chain.replace(',', '+')}.{size_name}", samples,
+                        megapixels_per_s=round(megapixels / statistics.median(samples), 2))
+
+def bench_photostrip(app, results: Results, sizes: List[str]):
+    """Strip rendering from source images: cold (thumbnails resized) and warm (cached)"""
+    for size_name in sizes:
+        generator = app.PhotoStripGenerator(app.STRIP_LAYOUTS["classic"])
+        sources = [synthetic_image(size_name, seed) for seed in range(generator.photos_per_strip)]
+        repeat = REPEATS[size_name]
+
+        def render(image_ids):
+            slots = [
+                generator.thumbnail(image_id, lambda source=source: source)
+                for image_id, source in zip(image_ids, sources)
+            ]
+            return generator.create_photostrip(slots, "benchmark")
+
+        # Fresh ids every run so nothing comes from the thumbnail cache
+        samples = measure(lambda: render([str(uuid.uuid4()) for _ in sources]), repeat)
+        results.add(f"photostrip.cold.{size_name}", samples)
+
+        warm_ids = [f"warm-{size_name}-{i}" for i in range(len(sources))]
+        samples = measure(lambda: render(warm_ids), max(repeat, 10))
+        results.add(f"photostrip.warm.{size_name}", samples)
+
+# Run in a fresh interpreter so the high-water mark isn't raised by earlier suites
+PEAK_RSS_SCRIPT = """
+import json, sys
+from benchmarks import load_app
+app = load_app()
+from fastapi.testclient import TestClient
+
+def status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+def upload(client, path):
+    with open(path, "rb") as f:
+        payload = f.read()
+    return client.post("/upload-image/", files={"file": ("upload.jpg", payload, "image/jpeg")},
+                       data={"filters": "vintage,enhance", "session_id": "bench-rss"})
+
+with TestClient(app.app) as client:
+    # Imports, storage and the pool warm up on a small image first
+    upload(client, sys.argv[1])
+    # Writing 5 resets the high-water mark (VmHWM) to the current RSS, so
+    # the peak read afterwards belongs to this upload alone
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    before = status_kb("VmRSS")
+    status = upload(client, sys.argv[2]).status_code
+    peak = status_kb("VmHWM")
+print(json.dumps({"status": status, "before": before, "peak": peak}))
+"""
+
+def upload_peak_rss(size_name: str) -> dict:
+    """Peak resident memory of a server process handling one upload of this size
+
+    Returns the peak in MB during the upload and how far it rose above the
+    resident size just before. Measured through ``/proc/self/clear_refs``
+    and ``VmHWM``, so empty where ``/proc`` is unavailable (macOS, Windows).
+    """
+    if not os.path.exists("/proc/self/clear_refs"):
+        return {}
+    workdir = tempfile.mkdtemp(prefix="photobooth-bench-rss-")
+    paths = []
+    for name in ("vga", size_name):
+        path = os.path.join(workdir, f"{name}.jpg")
+        with open(path, "wb") as f:
+            f.write(synthetic_jpeg(name))
+        paths.append(path)
+    env = dict(os.environ, PHOTOBOOTH_WARM_STORAGE="0")
+    output = subprocess.run(
+        [sys.executable, "-c", PEAK_RSS_SCRIPT, *paths],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    report = json.loads(output.strip().splitlines()[-1])
+    if report["status"] != 200:
+        raise RuntimeError(f"peak RSS upload ({size_name}) answered {report['status']}")
+    increase = report["peak"] - report["before"]
+    if increase <= 0:
+        raise RuntimeError(f"peak RSS upload ({size_name}) reported no increase; the measurement is broken")
+    return {
+        "peak_rss_mb": round(report["peak"] * 1024 / 1e6, 1),
+        "upload_rss_increase_mb": round(increase * 1024 / 1e6, 1),
+    }
+
+def bench_upload(app, results: Results, client, sizes: List[str]):
+    """End-to-end POST /upload-image/ through the in-process ASGI client, with its peak memory"""
+    for size_name in sizes:
+        payload = synthetic_jpeg(size_name)
+        statuses = set()
+
+        def upload():
+            response = client.post(
+                "/upload-image/",
+                files={"file": (f"{size_name}.jpg", payload, "image/jpeg")},
+                data={"filters": "vintage,enhance", "session_id": f"bench-{size_name}"},
+            )
+            statuses.add(response.status_code)
+            response.read()
+
+        samples = measure(upload, REPEATS[size_name])
+        results.add(f"upload.{size_name}", samples, upload_bytes=len(payload), statuses=sorted(statuses),
+                    **upload_peak_rss(size_name))
+        require_ok(f"upload.{size_name}", statuses)
+
+        # Palette images can't be reduced directly; they must still be accepted once downscaled
+        palette_payload = synthetic_palette_png(size_name)
+        palette_statuses = set()
+
+        def upload_palette():
+            response = client.post(
+                "/upload-image/",
+                files={"file": (f"{size_name}-palette.png", palette_payload, "image/png")},
+                data={"filters": "vintage", "session_id": f"bench-{size_name}-palette"},
+            )
+            palette_statuses.add(response.status_code)
+            response.read()
+
+        samples = measure(upload_palette, max(1, REPEATS[size_name] // 2))
+        results.add(f"upload.palette_png.{size_name}", samples, upload_bytes=len(palette_payload),
+                    statuses=sorted(palette_statuses))
+        require_ok(f"upload.palette_png.{size_name}", palette_statuses)
+
+def seed_collection(app, target: int, images_per_session: int = 8):
+    """Grow the collection to ``target`` records of synthetic sessions"""
+    existing = app.storage.store.count()
+    if existing >= target:
+        return
+    batch_size = min(5000, app.storage.store.max_batch_size)
+    started = datetime(2024, 1, 1)
+
+    for offset in range(existing, target, batch_size):
+        count = min(batch_size, target - offset)
+        embeddings = random_embeddings(count, app.descriptor_pipeline.dim, seed=offset)
+        ids, metadatas = [], []
+        for index in range(offset, offset + count):
+            image_id = f"seed-{index:07d}"
+            ids.append(image_id)
+            metadatas.append({
+                "id": image_id,
+                "type": "single_image",
+                "session_id": f"seed-session-{index // images_per_session:06d}",
+                "timestamp": (started + timedelta(seconds=index)).isoformat(),
+                "filters_applied": "vintage" if index % 3 == 0 else "",
+                "descriptor": app.descriptor_pipeline.version,
+            })
+        app.storage.store.add(
+            ids=ids,
+            embeddings=embeddings.tolist(),
+            documents=[f"Seeded image {image_id}" for image_id in ids],
+            metadatas=metadatas,
+        )
+        app.session_index.record(metadatas)
+
+def sample_image_ids(app, count: int = 20) -> List[str]:
+    """Ids of ``count`` stored single images spread across the collection"""
+    total = app.storage.store.count()
+    image_ids = []
+    for offset in range(0, total, max(1, total // count)):
+        found = app.storage.store.get(where={"type": "single_image"}, limit=1, offset=offset,
+                                      include=("metadatas",))
+        image_ids.extend(image_id for image_id in found["ids"] if image_id not in image_ids)
+    return image_ids[:count]
+
+def require_ok(name: str, statuses: set):
+    """Abort the run when a benchmarked endpoint answered anything but 200"""
+    if statuses != {200}:
+        raise RuntimeError(f"{name} answered {sorted(statuses)}")
+
+def bench_database(app, results: Results, client, scales: List[str]):
+    """list_sessions and search_similar latency as the collection grows"""
+    for scale_name in scales:
+        target = SCALES[scale_name]
+        seeding = measure(lambda: seed_collection(app, target), repeat=1, warmup=0)
+        print(f"seeded {app.storage.store.count()} records in {seeding[0]:.1f}s", flush=True)
+
+        first_page_statuses = set()
+        samples = measure(lambda: first_page_statuses.add(
+            client.get("/list-sessions/", params={"limit": 50}).status_code), 20)
+        results.add(f"list_sessions.first_page.{scale_name}", samples, statuses=sorted(first_page_statuses))
+        require_ok(f"list_sessions.first_page.{scale_name}", first_page_statuses)
+
+        # A cursor ten pages in, to catch pagination that degrades with depth
+        cursor = None
+        for _ in range(10):
+            cursor = client.get("/list-sessions/", params={"limit": 50, "cursor": cursor}).json()["next_cursor"]
+            if cursor is None:
+                break
+        page_statuses = set()
+        samples = measure(lambda: page_statuses.add(
+            client.get("/list-sessions/", params={"limit": 50, "cursor": cursor}).status_code), 20)
+        results.add(f"list_sessions.page_10.{scale_name}", samples, statuses=sorted(page_statuses))
+        require_ok(f"list_sessions.page_10.{scale_name}", page_statuses)
+
+        statuses = set()
+        # Seeded ids are numbered from whatever was stored before, so ask the store
+        query_ids = sample_image_ids(app)
+
+        def search():
+            # Measure the store, not the result cache
+            app.similarity_search.invalidate()
+            for image_id in query_ids:
+                response = client.get("/search-similar/", params={"image_id": image_id, "limit": 10})
+                statuses.add(response.status_code)
+
+        samples = [elapsed / len(query_ids) for elapsed in measure(search, 3)]
+        results.add(f"search_similar.{scale_name}", samples, statuses=sorted(statuses))
+        require_ok(f"search_similar.{scale_name}", statuses)
+
+        # The same queries as one batch
+        batch_statuses = set()
+
+        def search_batch():
+            app.similarity_search.invalidate()
+            response = client.post("/search-similar/batch", json={"image_ids": query_ids, "limit": 10})
+            batch_statuses.add(response.status_code)
+
+        samples = [elapsed / len(query_ids) for elapsed in measure(search_batch, 3)]
+        results.add(f"search_similar_batch.{scale_name}", samples, statuses=sorted(batch_statuses))
+        require_ok(f"search_similar_batch.{scale_name}", batch_statuses)
+
+def _wait_for(url: str, deadline: float) -> float:
+    """Poll until ``url`` answers 200; returns when it did (perf_counter)
+
+    A 404 also ends the wait, so builds without the endpoint can be compared.
+    """
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.01)
+    raise TimeoutError(f"{url} not answering")
+
+def bench_startup(results: Results, repeat: int = 3, timeout: float = 120.0):
+    """Time from launching uvicorn to the first answered request and to readiness
+
+    Each run boots a fresh server process on a fresh scratch database.
+    """
+    to_first_request, to_ready = [], []
+    for _ in range(repeat):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        workdir = tempfile.mkdtemp(prefix="photobooth-bench-startup-")
+        env = dict(
+            os.environ,
+            PHOTOBOOTH_DB_PATH=os.path.join(workdir, "db"),
+            PHOTOBOOTH_LOCAL_STORE_PATH=os.path.join(workdir, "store"),
+            PHOTOBOOTH_BLOB_PATH=os.path.join(workdir, "blobs"),
+            PHOTOBOOTH_SESSION_INDEX=os.path.join(workdir, "sessions.sqlite3"),
+            PHOTOBOOTH_JOB_DB=os.path.join(workdir, "jobs.sqlite3"),
+            PHOTOBOOTH_HASH_INDEX=os.path.join(workdir, "hashes.jsonl"),
+        )
+        started = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port)],
+            cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            base = f"http://127.0.0.1:{port}"
+            to_first_request.append(_wait_for(f"{base}/api/health", started + timeout) - started)
+            to_ready.append(_wait_for(f"{base}/api/ready", started + timeout) - started)
+        finally:
+            server.terminate()
+            server.wait()
+
+    results.add("startup.first_request", to_first_request)
+    results.add("startup.ready", to_ready)
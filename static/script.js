@@ -23,6 +23,8 @@ class PhotoboothApp {
         this.ctx            = null;
         this.isProcessing   = false;
         this.magicMenuOpen  = false;
+        this.previewSocket  = null;   // WebSocket to /ws/preview while the camera runs with a filter
+        this.previewBusy    = false;  // a live preview frame is in flight
 
         this._init();
     }
@@ -163,6 +165,7 @@ class PhotoboothApp {
             this._setCameraUI(true);
             this._hideLoading();
             this._toast('Camera ready!', 'success');
+            this._startLivePreview();
         } catch (err) {
             this._hideLoading();
             const msgs = { NotFoundError: 'No camera found', NotAllowedError: 'Camera access denied', NotReadableError: 'Camera in use by another app' };
@@ -189,6 +192,7 @@ class PhotoboothApp {
     }
 
     stopCamera() {
+        this._stopLivePreview();
         if (this.stream) { this.stream.getTracks().forEach(t => t.stop()); this.stream = null; }
         const video = this._el('video');
         if (video) video.srcObject = null;
@@ -203,6 +207,74 @@ class PhotoboothApp {
         show('stopCamera',    on);
     }
 
+    /* ─── Live filter preview ────────────────────────────────────── */
+
+    // Small webcam frames go to /ws/preview and come back filtered, drawn over
+    // the video. One frame is in flight at a time, so a slow server lowers the
+    // frame rate instead of building a backlog.
+    _startLivePreview() {
+        if (this.previewSocket || !this.stream || this.currentFilter === 'none') return;
+        const proto = location.protocol === 'https:' ? 'wss' : 'ws';
+        const ws = new WebSocket(`${proto}://${location.host}/ws/preview?filters=${encodeURIComponent(this.currentFilter)}`);
+        ws.binaryType = 'blob';
+        this.previewSocket = ws;
+        this.previewBusy = false;
+
+        ws.onopen = () => this._sendPreviewFrame();
+        ws.onmessage = e => {
+            if (typeof e.data === 'string') {
+                // Frame header; on an error no frame follows, so try again shortly
+                if (JSON.parse(e.data).error) { this.previewBusy = false; setTimeout(() => this._sendPreviewFrame(), 250); }
+                return;
+            }
+            const img = this._el('livePreview');
+            if (img) {
+                const url = URL.createObjectURL(e.data);
+                img.onload = () => URL.revokeObjectURL(url);
+                img.src = url;
+                img.style.display = 'block';
+            }
+            this.previewBusy = false;
+            requestAnimationFrame(() => this._sendPreviewFrame());
+        };
+        ws.onclose = () => { if (this.previewSocket === ws) this._stopLivePreview(); };
+    }
+
+    _sendPreviewFrame() {
+        const ws = this.previewSocket, video = this._el('video');
+        if (!ws || ws.readyState !== WebSocket.OPEN || this.previewBusy || !video || video.videoWidth === 0) return;
+
+        const scale = Math.min(1, 480 / Math.max(video.videoWidth, video.videoHeight));
+        const frame = this.previewCanvas || (this.previewCanvas = document.createElement('canvas'));
+        frame.width  = Math.round(video.videoWidth * scale);
+        frame.height = Math.round(video.videoHeight * scale);
+        frame.getContext('2d').drawImage(video, 0, 0, frame.width, frame.height);
+
+        this.previewBusy = true;
+        frame.toBlob(blob => {
+            if (blob && ws.readyState === WebSocket.OPEN) ws.send(blob);
+            else this.previewBusy = false;
+        }, 'image/jpeg', 0.7);
+    }
+
+    _stopLivePreview() {
+        const ws = this.previewSocket;
+        this.previewSocket = null;
+        if (ws) ws.close();
+        const img = this._el('livePreview');
+        if (img) { img.style.display = 'none'; img.removeAttribute('src'); }
+    }
+
+    _updateLivePreview() {
+        if (!this.stream) return;
+        if (this.currentFilter === 'none') { this._stopLivePreview(); return; }
+        if (this.previewSocket && this.previewSocket.readyState === WebSocket.OPEN) {
+            this.previewSocket.send(JSON.stringify({ filters: this.currentFilter }));
+        } else {
+            this._startLivePreview();
+        }
+    }
+
     /* ─── File upload ────────────────────────────────────────────── */
 
     async _processFiles(files) {
@@ -317,6 +389,7 @@ class PhotoboothApp {
         document.querySelectorAll('.filter-btn').forEach(b => b.classList.remove('active'));
         e.currentTarget.classList.add('active');
         this.currentFilter = e.currentTarget.dataset.filter || 'none';
+        this._updateLivePreview();
         // Auto-apply if image loaded
         if (this.currentImage && !this.isProcessing) setTimeout(() => this.processImage(), 150);
     }
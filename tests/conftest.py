@@ -0,0 +1,18 @@
+"""Shared fixtures: the app on a scratch database, and a client for it"""
+import os
+
+import pytest
+
+from benchmarks import load_app
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """The app module with every store in a temporary directory"""
+    os.environ.setdefault("PHOTOBOOTH_STORE", "local")
+    return load_app(str(tmp_path_factory.mktemp("photobooth")))
+
+@pytest.fixture(scope="session")
+def client(app):
+    from fastapi.testclient import TestClient
+    with TestClient(app.app) as client:
+        yield client
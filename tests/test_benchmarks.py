@@ -0,0 +1,33 @@
+"""The benchmark harness: memory measurement and result comparison"""
+import json
+import os
+
+import pytest
+
+from benchmarks.runner import compare
+from benchmarks.suites import upload_peak_rss
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="needs Linux /proc")
+def test_upload_peak_rss_is_measured():
+    report = upload_peak_rss("vga")
+    assert report["upload_rss_increase_mb"] > 0
+    assert report["peak_rss_mb"] > report["upload_rss_increase_mb"]
+
+def write_results(path, entries: dict) -> str:
+    with open(path, "w") as f:
+        json.dump({"meta": {}, "results": entries}, f)
+    return str(path)
+
+def entry(median: float, statuses=(200,)) -> dict:
+    return {"median": median, "statuses": list(statuses)}
+
+def test_compare_flags_slower_medians(tmp_path):
+    baseline = write_results(tmp_path / "baseline.json", {"a": entry(1.0), "b": entry(1.0)})
+    current = write_results(tmp_path / "current.json", {"a": entry(1.5), "b": entry(1.05)})
+    assert compare(baseline, current) == 1
+
+def test_compare_fails_results_with_errors(tmp_path):
+    baseline = write_results(tmp_path / "baseline.json", {"a": entry(1.0)})
+    # Faster, but only because the endpoint failed
+    current = write_results(tmp_path / "current.json", {"a": entry(0.1, (200, 500)), "new": entry(0.1, (404,))})
+    assert compare(baseline, current) == 2
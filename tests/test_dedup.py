@@ -0,0 +1,48 @@
+"""Duplicate detection only links uploads whose stored bytes would match"""
+from benchmarks.fixtures import synthetic_jpeg
+
+def upload(client, payload: bytes, session_id: str, filters: str = ""):
+    response = client.post(
+        "/upload-image/",
+        files={"file": ("photo.jpg", payload, "image/jpeg")},
+        data={"session_id": session_id, "filters": filters, "inline_image": "false", "output_format": "png"},
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def test_same_photo_and_filters_is_linked(client):
+    payload = synthetic_jpeg("vga", seed=11)
+    first = upload(client, payload, "dedup-same", "vintage")
+    again = upload(client, payload, "dedup-same", "vintage")
+    assert first["duplicate_of"] is None
+    assert again["duplicate_of"] == first["image_id"]
+
+def test_other_filters_are_not_linked(client):
+    payload = synthetic_jpeg("vga", seed=12)
+    plain = upload(client, payload, "dedup-filters")
+    blurred = upload(client, payload, "dedup-filters", "blur")
+    enhanced = upload(client, payload, "dedup-filters", "enhance")
+    assert blurred["duplicate_of"] is None
+    assert enhanced["duplicate_of"] is None
+    # Each variant is now its own match
+    assert upload(client, payload, "dedup-filters", "blur")["duplicate_of"] == blurred["image_id"]
+    assert upload(client, payload, "dedup-filters")["duplicate_of"] == plain["image_id"]
+
+def test_blobs_differ_between_filter_variants(client):
+    payload = synthetic_jpeg("vga", seed=13)
+    plain = upload(client, payload, "dedup-bytes")
+    blurred = upload(client, payload, "dedup-bytes", "blur")
+    assert client.get(plain["image_url"]).content != client.get(blurred["image_url"]).content
+
+def test_batch_links_within_the_batch_by_filters(client):
+    payload = synthetic_jpeg("vga", seed=14)
+    response = client.post(
+        "/upload-images/",
+        files=[("files", ("a.jpg", payload, "image/jpeg")), ("files", ("b.jpg", payload, "image/jpeg"))],
+        data={"session_id": "dedup-batch", "filters": "retro", "output_format": "png"},
+    )
+    assert response.status_code == 200, response.text
+    first, second = response.json()["results"]
+    assert second["duplicate_of"] == first["image_id"]
+    # The unfiltered photo is not the batch's retro version
+    assert upload(client, payload, "dedup-batch")["duplicate_of"] is None
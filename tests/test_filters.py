@@ -0,0 +1,96 @@
+"""Fused filter chains against the per-filter implementations they replaced"""
+import numpy as np
+import pytest
+from PIL import Image, ImageEnhance, ImageFilter
+
+from benchmarks.fixtures import synthetic_image
+
+# Levels the fused passes may differ by: they round once, not after every step
+TOLERANCE = 4
+
+def reference_vintage(image):
+    image = image.convert('RGBA')
+    sepia = np.array([
+        [0.393, 0.769, 0.189, 0],
+        [0.349, 0.686, 0.168, 0],
+        [0.272, 0.534, 0.131, 0],
+        [0, 0, 0, 1],
+    ])
+    return Image.fromarray(np.clip(np.array(image) @ sepia.T, 0, 255).astype(np.uint8))
+
+def reference_bw(image):
+    return image.convert('L').convert('RGBA')
+
+def reference_blur(image):
+    return image.filter(ImageFilter.GaussianBlur(radius=2))
+
+def reference_enhance(image):
+    image = ImageEnhance.Color(image).enhance(1.2)
+    return ImageEnhance.Contrast(image).enhance(1.1)
+
+def reference_retro(image):
+    image = ImageEnhance.Color(image.convert('RGB')).enhance(0.8)
+    pixels = np.array(image)
+    pixels[:, :, 0] = np.clip(pixels[:, :, 0] * 1.1, 0, 255)
+    pixels[:, :, 2] = np.clip(pixels[:, :, 2] * 0.9, 0, 255)
+    return Image.fromarray(pixels.astype(np.uint8))
+
+REFERENCES = {
+    'vintage': reference_vintage,
+    'bw': reference_bw,
+    'blur': reference_blur,
+    'enhance': reference_enhance,
+    'retro': reference_retro,
+}
+
+def max_difference(a: Image.Image, b: Image.Image) -> int:
+    assert a.mode == b.mode and a.size == b.size
+    return int(np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)).max())
+
+def mid_tones(image: Image.Image) -> Image.Image:
+    """The image squeezed into 64-127 so no step of a chain clips"""
+    return image.point(lambda value: 64 + value // 4)
+
+@pytest.mark.parametrize("name", sorted(REFERENCES))
+def test_single_filter_matches_reference(app, name):
+    image = synthetic_image("vga")
+    fused, _ = app.ImageProcessor.apply_filters(image, [name], tile_pixels=0)
+    assert max_difference(fused, REFERENCES[name](image)) <= TOLERANCE
+
+@pytest.mark.parametrize("chain", [
+    ["enhance", "retro"],
+    ["vintage", "bw"],
+    ["enhance", "vintage"],
+    ["vintage", "retro"],
+    ["retro", "enhance"],
+    ["enhance", "blur", "vintage"],
+])
+def test_chain_matches_reference(app, chain):
+    # Fused matrices don't clip between filters, so the references only
+    # agree on images where no intermediate result leaves 0-255
+    image = mid_tones(synthetic_image("vga"))
+    fused, labels = app.ImageProcessor.apply_filters(image, chain, tile_pixels=0)
+    expected = image
+    for name in chain:
+        expected = REFERENCES[name](expected)
+    assert max_difference(fused, expected.convert(fused.mode)) <= TOLERANCE
+    assert len(labels) == len(chain)
+
+@pytest.mark.parametrize("chain", [
+    ["vintage"],
+    ["blur"],
+    ["enhance", "blur"],
+    ["blur", "enhance", "vintage"],
+    ["bw", "blur", "blur"],
+    ["retro", "blur"],
+])
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+def test_tiled_matches_untiled(app, chain, mode):
+    image = synthetic_image("vga").convert(mode)
+    if mode == "RGBA":
+        image.putalpha(image.getchannel("R"))
+    untiled, _ = app.ImageProcessor.apply_filters(image, chain, tile_pixels=0)
+    # Strips of 37 rows, so the last one is short and every halo is clipped somewhere
+    tiled, _ = app.ImageProcessor.apply_filters(image, chain, tile_pixels=image.width * 37)
+    assert tiled.mode == untiled.mode
+    assert np.array_equal(np.asarray(tiled), np.asarray(untiled))
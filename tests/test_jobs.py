@@ -0,0 +1,43 @@
+"""Job leases: lapsed jobs are queued again, up to the attempt limit"""
+import time
+
+import pytest
+
+@pytest.fixture
+def queue(app, tmp_path):
+    return app.JobQueue(str(tmp_path / "jobs.sqlite3"), workers=1, retention_hours=1, max_attempts=2,
+                        lease_seconds=0.05)
+
+def test_lapsed_lease_is_requeued(queue):
+    job, _ = queue.submit("photostrip", {"session_id": "s"})
+    assert queue._claim()[0] == job["job_id"]
+    assert queue.get(job["job_id"])["status"] == "running"
+    time.sleep(0.1)
+    assert queue.recover() == 1
+    assert queue.get(job["job_id"])["status"] == "queued"
+
+def test_live_lease_is_kept(queue):
+    queue.lease_seconds = 60
+    job, _ = queue.submit("photostrip", {"session_id": "s"})
+    queue._claim()
+    assert queue.recover() == 0
+    assert queue.get(job["job_id"])["status"] == "running"
+
+def test_lapsing_too_often_fails_the_job(queue):
+    job, _ = queue.submit("photostrip", {"session_id": "s"})
+    for _ in range(queue.max_attempts):
+        assert queue._claim()[0] == job["job_id"]
+        time.sleep(0.1)
+        queue.recover()
+    failed = queue.get(job["job_id"])
+    assert failed["status"] == "failed"
+    assert failed["error"] == "Interrupted too many times"
+
+def test_requeued_job_keeps_its_dedupe_key(queue):
+    job, _ = queue.submit("photostrip", {"session_id": "s"}, dedupe_key="strip:s")
+    queue._claim()
+    time.sleep(0.1)
+    queue.recover()
+    again, created = queue.submit("photostrip", {"session_id": "s"}, dedupe_key="strip:s")
+    assert not created
+    assert again["job_id"] == job["job_id"]
@@ -0,0 +1,64 @@
+"""LocalPhotoStore filters, which follow ChromaDB's ``where`` semantics"""
+import pytest
+
+from benchmarks.fixtures import random_embeddings
+
+RECORDS = [
+    ("a", {"session_id": "s1", "type": "single_image", "rank": 1}),
+    ("b", {"session_id": "s1", "type": "photostrip", "rank": 2}),
+    ("c", {"session_id": "s2", "type": "single_image", "rank": 3}),
+    ("d", {"session_id": "s2", "type": "single_image"}),
+]
+
+@pytest.fixture
+def store(app, tmp_path):
+    store = app.LocalPhotoStore(str(tmp_path / "store"))
+    store.add(
+        ids=[image_id for image_id, _ in RECORDS],
+        embeddings=random_embeddings(len(RECORDS), 8).tolist(),
+        documents=[f"record {image_id}" for image_id, _ in RECORDS],
+        metadatas=[metadata for _, metadata in RECORDS],
+    )
+    return store
+
+def matching(store, where) -> set:
+    return set(store.get(where=where, include=("metadatas",))["ids"])
+
+@pytest.mark.parametrize("where, expected", [
+    ({"session_id": "s1"}, {"a", "b"}),
+    ({"session_id": {"$eq": "s2"}}, {"c", "d"}),
+    ({"type": {"$ne": "photostrip"}}, {"a", "c", "d"}),
+    ({"rank": {"$gt": 1}}, {"b", "c"}),
+    ({"rank": {"$lte": 2}}, {"a", "b"}),
+    ({"session_id": {"$in": ["s1", "s3"]}}, {"a", "b"}),
+    ({"session_id": {"$nin": ["s1"]}}, {"c", "d"}),
+    ({"session_id": {"$in": []}}, set()),
+    # Like ChromaDB, $ne and $nin also match records without the key
+    ({"rank": {"$ne": 1}}, {"b", "c", "d"}),
+    ({"rank": {"$nin": [1, 2]}}, {"c", "d"}),
+    ({"$and": [{"session_id": "s2"}, {"type": "single_image"}]}, {"c", "d"}),
+    ({"$or": [{"session_id": "s1"}, {"rank": 3}]}, {"a", "b", "c"}),
+    ({"$and": [{"$or": [{"rank": 1}, {"rank": 3}]}, {"type": "single_image"}]}, {"a", "c"}),
+    ({"$and": []}, {"a", "b", "c", "d"}),
+    ({"$or": []}, set()),
+    ({"$and": [{"session_id": "s1"}, {"$or": []}]}, set()),
+    ({"$or": [{"session_id": "s2"}, {"$and": []}]}, {"a", "b", "c", "d"}),
+])
+def test_where(store, where, expected):
+    assert matching(store, where) == expected
+
+def test_where_applies_to_query(store):
+    found = store.query(random_embeddings(1, 8, seed=1).tolist(), n_results=10, where={"session_id": "s2"})
+    assert set(found["ids"][0]) == {"c", "d"}
+
+def test_where_skips_deleted_records(store):
+    store.delete(["c"])
+    assert matching(store, {"session_id": "s2"}) == {"d"}
+
+@pytest.mark.parametrize("where", [
+    {"session_id": {"$like": "s%"}},
+    {"bad key": "x"},
+])
+def test_unsupported_where_is_rejected(store, where):
+    with pytest.raises(ValueError):
+        store.get(where=where)